@@ -113,6 +113,13 @@ class FrontendTestCase(base.TestCase):
         self.assertEqual(resp.json['_id'], frontend['_id'])
         self.assertEqual(resp.json['public'], True)
         self.assertEqual(resp.json['memLimit'], '1024m')
+        self.assertEqual(resp.json['poolSize'], 0)
+
+        # Pool size cannot be negative
+        resp = self.request(
+            path='/frontend/{_id}'.format(**frontend), method='PUT',
+            params={'poolSize': -1}, user=self.admin)
+        self.assertValidationError(resp, 'poolSize')
 
         # Verify that anyone can see public frontend
         resp = self.request(
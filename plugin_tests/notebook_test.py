@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from bson import ObjectId
+import datetime
 import mock
+import socket
+import threading
+import time
 from tests import base
+from girder.constants import AccessType
 from girder.models.model_base import ValidationException
 
 
@@ -19,7 +25,7 @@ class FakeAsyncResult(object):
     def __init__(self):
         self.task_id = 'fake_id'
 
-    def get(self):
+    def get(self, timeout=None):
         return dict(
             nodeId='123456',
             volumeId='blah_volume',
@@ -32,7 +38,7 @@ class FakeAsyncResult2(object):
     def __init__(self):
         self.task_id = 'fake_id'
 
-    def get(self):
+    def get(self, timeout=None):
         return dict(
             nodeId='654321',
             volumeId='foobar_volume',
@@ -45,7 +51,7 @@ class FakeAsyncResult3(object):
     def __init__(self):
         self.task_id = 'fake_id'
 
-    def get(self):
+    def get(self, timeout=None):
         return dict(
             nodeId='162534',
             volumeId='foobaz_volume',
@@ -88,6 +94,27 @@ class NotebookTestCase(base.TestCase):
         })
         self.admin, self.user = [self._getUser(user) for user in users]
 
+    @staticmethod
+    def _probeReady(url, callback, timeout=30):
+        callback(True, {'dns': 0.0, 'boot': 0.0})
+
+    def _waitForNotebook(self, notebook, timeout=60):
+        from girder.plugins.ythub.constants import NotebookStatus
+        model = self.model('notebook', 'ythub')
+        startTime = time.time()
+        while time.time() - startTime < timeout:
+            doc = model.load(notebook['_id'], force=True)
+            if doc['status'] != NotebookStatus.STARTING:
+                break
+            time.sleep(0.1)
+        else:
+            raise AssertionError('Notebook %s did not start' % notebook['_id'])
+        resp = self.request(
+            path='/notebook/{_id}'.format(**notebook), method='GET',
+            user=self.admin)
+        self.assertStatusOk(resp)
+        return resp.json
+
     def testNotebooks(self):
         # Grab the default user folders
         resp = self.request(
@@ -120,7 +147,9 @@ class NotebookTestCase(base.TestCase):
         frontend = resp.json
 
         with mock.patch('celery.Celery') as celeryMock:
-            with mock.patch('urllib.request.urlopen') as urllibMock:
+            with mock.patch(
+                    'girder.plugins.ythub.readiness.prober.probe',
+                    side_effect=self._probeReady):
                 instance = celeryMock.return_value
                 instance.send_task.side_effect = [
                     FakeAsyncResult(), FakeAsyncResult(),
@@ -128,8 +157,6 @@ class NotebookTestCase(base.TestCase):
                     FakeAsyncResult3(), FakeAsyncResult3(),
                     FakeAsyncResult(), FakeAsyncResult()
                 ]
-                req = urllibMock.return_value
-                req.fetch.return_value = {}
 
                 params = {
                     'frontendId': str(frontend['_id']),
@@ -138,8 +165,12 @@ class NotebookTestCase(base.TestCase):
                 resp = self.request(
                     '/notebook', method='POST',
                     user=self.user, params=params)
-                self.assertStatus(resp, 200)
-                notebook = resp.json
+                self.assertStatus(resp, 202)
+                self.assertEqual(resp.json['status'], 0)
+                self.assertNotIn('url', resp.json)
+                notebook = self._waitForNotebook(resp.json)
+
+        self.assertEqual(notebook['status'], 1)
 
         self.assertEqual(notebook['serviceInfo']['nodeId'], '123456')
         self.assertEqual(notebook['serviceInfo']['volumeId'], 'blah_volume')
@@ -150,7 +181,9 @@ class NotebookTestCase(base.TestCase):
         self.assertEqual(notebook['creatorId'], str(self.user['_id']))
 
         with mock.patch('celery.Celery') as celeryMock:
-            with mock.patch('urllib.request.urlopen') as urllibMock:
+            with mock.patch(
+                    'girder.plugins.ythub.readiness.prober.probe',
+                    side_effect=self._probeReady):
                 params = {
                     'frontendId': str(frontend['_id']),
                     'folderId': str(privateFolder['_id'])
@@ -167,16 +200,16 @@ class NotebookTestCase(base.TestCase):
                 resp = self.request(
                     path='/notebook', method='POST', user=self.user,
                     params=params)
-                self.assertStatus(resp, 200)
-                other_notebook = resp.json
+                self.assertStatus(resp, 202)
+                other_notebook = self._waitForNotebook(resp.json)
 
                 # Create admin nb
                 params['folderId'] = str(publicFolder['_id'])
                 resp = self.request(
                     path='/notebook', method='POST', user=self.admin,
                     params=params)
-                self.assertStatus(resp, 200)
-                admin_notebook = resp.json
+                self.assertStatus(resp, 202)
+                admin_notebook = self._waitForNotebook(resp.json)
 
         # By default user can list only his/her notebooks
         resp = self.request(
@@ -184,6 +217,15 @@ class NotebookTestCase(base.TestCase):
         self.assertStatus(resp, 200)
         self.assertEqual([_['_id'] for _ in resp.json],
                          [other_notebook['_id'], notebook['_id']])
+        self.assertEqual(int(resp.headers['Girder-Total-Count']), 2)
+
+        # Paging keeps the total count
+        resp = self.request(
+            path='/notebook', method='GET', user=self.user,
+            params={'limit': 1, 'offset': 1})
+        self.assertStatus(resp, 200)
+        self.assertEqual([_['_id'] for _ in resp.json], [notebook['_id']])
+        self.assertEqual(int(resp.headers['Girder-Total-Count']), 2)
 
         # Filter by folder
         resp = self.request(
@@ -234,6 +276,396 @@ class NotebookTestCase(base.TestCase):
             user=self.admin)
         self.assertStatus(resp, 400)
 
+    def testCulling(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        model = self.model('notebook', 'ythub')
+        now = datetime.datetime.utcnow()
+        notebooks = []
+        for hours in (5, 0):
+            notebooks.append(model.save({
+                'folderId': ObjectId(),
+                'creatorId': self.user['_id'],
+                'frontendId': self.user['_id'],
+                'status': NotebookStatus.RUNNING,
+                'created': now,
+                'lastActivity': now - datetime.timedelta(hours=hours),
+                'serviceInfo': {'nodeId': '123456'}
+            }))
+        idle, active = notebooks
+        # Created before activity was recorded
+        legacy = model.save({
+            'folderId': ObjectId(),
+            'creatorId': self.user['_id'],
+            'frontendId': self.user['_id'],
+            'status': NotebookStatus.RUNNING,
+            'created': now - datetime.timedelta(hours=5),
+            'serviceInfo': {'nodeId': '123456'}
+        })
+        # Idle as far as Girder knows, but in use according to its server
+        reporting = model.save({
+            'folderId': ObjectId(),
+            'creatorId': self.user['_id'],
+            'frontendId': self.user['_id'],
+            'status': NotebookStatus.RUNNING,
+            'created': now - datetime.timedelta(hours=5),
+            'lastActivity': now - datetime.timedelta(hours=5),
+            'url': 'http://tmp-used.tmpnb.null/?token=foo',
+            'serviceInfo': {'nodeId': '123456'}
+        })
+
+        def getStatus(url, **kwargs):
+            self.assertEqual(url, 'http://tmp-used.tmpnb.null/api/status?token=foo')
+            resp = mock.Mock()
+            resp.json.return_value = {
+                'last_activity': now.isoformat() + 'Z'}
+            return resp
+
+        with mock.patch('celery.Celery'), mock.patch(
+                'girder.plugins.ythub.models.notebook.requests.get',
+                side_effect=getStatus):
+            self.assertEqual(model.cullNotebooks(1.0), 2)
+
+        self.assertIsNone(model.load(idle['_id'], force=True))
+        self.assertIsNone(model.load(legacy['_id'], force=True))
+        self.assertIsNotNone(model.load(active['_id'], force=True))
+        reporting = model.load(reporting['_id'], force=True)
+        self.assertEqual(reporting['lastActivity'].replace(microsecond=0),
+                         now.replace(microsecond=0))
+        model.remove(reporting)
+
+        # Recording activity keeps a notebook alive
+        model.setUserAccess(active, self.user, AccessType.ADMIN, save=True)
+        model.update({'_id': active['_id']}, {'$set': {
+            'lastActivity': now - datetime.timedelta(hours=5)}})
+        resp = self.request(
+            path='/notebook/{_id}/activity'.format(**active), method='PUT',
+            user=self.user)
+        self.assertStatusOk(resp)
+        with mock.patch('celery.Celery'):
+            self.assertEqual(model.cullNotebooks(1.0), 0)
+        model.remove(active)
+
+    def testLaunchCoalescing(self):
+        model = self.model('notebook', 'ythub')
+        folder = {'_id': ObjectId()}
+        frontend = {'_id': ObjectId()}
+        token = {'_id': 'token'}
+        results = []
+
+        def launch():
+            results.append(model.createNotebook(
+                folder, self.user, token, frontend))
+
+        with mock.patch('girder.plugins.ythub.models.notebook._launchExecutor'
+                        ) as executorMock:
+            threads = [threading.Thread(target=launch) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(set(nb['_id'] for nb in results)), 1)
+        self.assertEqual(executorMock.submit.call_count, 1)
+        self.assertEqual(model.find({'folderId': folder['_id']}).count(), 1)
+        model.remove(results[0])
+
+    def testRelaunchAfterFailure(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        model = self.model('notebook', 'ythub')
+        folder = self.model('folder').findOne({'parentId': self.user['_id']})
+        resp = self.request(
+            path='/frontend', method='POST', user=self.admin, params={
+                'imageName': 'xarthisius/ythub', 'command': './perform_magic',
+                'memLimit': '2048m', 'port': 12345, 'user': 'user',
+                'targetMount': '/blah', 'urlPath': '?token={token}',
+                'description': 'foo', 'public': True})
+        self.assertStatusOk(resp)
+        frontend = resp.json
+        failed = model.save({
+            'folderId': folder['_id'],
+            'creatorId': self.user['_id'],
+            'frontendId': ObjectId(frontend['_id']),
+            'status': NotebookStatus.ERROR,
+            'created': datetime.datetime.utcnow()
+        })
+
+        # The failed record is neither returned nor blocking a new launch
+        with mock.patch('girder.plugins.ythub.models.notebook._launchExecutor'
+                        ) as executorMock:
+            resp = self.request(
+                path='/notebook', method='POST', user=self.user, params={
+                    'frontendId': frontend['_id'],
+                    'folderId': str(folder['_id'])})
+        self.assertStatus(resp, 202)
+        self.assertNotEqual(resp.json['_id'], str(failed['_id']))
+        self.assertEqual(resp.json['status'], NotebookStatus.STARTING)
+        self.assertEqual(executorMock.submit.call_count, 1)
+        model.remove(failed)
+        model.remove(model.load(resp.json['_id'], force=True))
+        self.model('frontend', 'ythub').remove(
+            self.model('frontend', 'ythub').load(frontend['_id'], force=True))
+
+    def testLaunchCancel(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        model = self.model('notebook', 'ythub')
+        folder = {'_id': ObjectId()}
+        frontend = {'_id': ObjectId()}
+        token = {'_id': 'token'}
+        with mock.patch('girder.plugins.ythub.models.notebook._launchExecutor'):
+            notebook = model.createNotebook(folder, self.user, token, frontend)
+
+        # Removed while the volume was being created
+        model.remove(notebook)
+        with mock.patch('celery.Celery') as celeryMock:
+            instance = celeryMock.return_value
+            instance.send_task.side_effect = [
+                FakeAsyncResult(), FakeAsyncResult(), FakeAsyncResult()]
+            model.launchNotebook(notebook, folder, self.user, token, frontend)
+            tasks = [(call[0][0], call[1].get('queue'))
+                     for call in instance.send_task.call_args_list]
+        self.assertEqual(tasks, [
+            ('gwvolman.tasks.create_volume', None),
+            ('gwvolman.tasks.shutdown_container', 'manager'),
+            ('gwvolman.tasks.remove_volume', '123456')])
+        self.assertIsNone(model.load(notebook['_id'], force=True))
+
+        # Launches left STARTING past the deadline are expired
+        stale = model.save({
+            'folderId': ObjectId(),
+            'creatorId': self.user['_id'],
+            'frontendId': frontend['_id'],
+            'status': NotebookStatus.STARTING,
+            'created': datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        })
+        self.assertEqual(model.expireLaunches(), 1)
+        self.assertEqual(model.load(stale['_id'], force=True)['status'],
+                         NotebookStatus.ERROR)
+        model.remove(stale)
+
+    def testDuplicateMigration(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        model = self.model('notebook', 'ythub')
+        collection = model.collection
+        # Start from a collection left by a release without the unique index
+        for name, info in collection.index_information().items():
+            if info.get('unique'):
+                collection.drop_index(name)
+        now = datetime.datetime.utcnow()
+        key = {'folderId': ObjectId(), 'creatorId': self.user['_id'],
+               'frontendId': ObjectId()}
+        records = (
+            (NotebookStatus.STARTING, now),
+            (NotebookStatus.RUNNING, now - datetime.timedelta(hours=2)),
+            (NotebookStatus.RUNNING, now - datetime.timedelta(hours=1)),
+            (NotebookStatus.ERROR, now))
+        ids = collection.insert_many([
+            dict(key, status=status, created=created)
+            for status, created in records]).inserted_ids
+
+        model.reconnect()
+        statuses = [collection.find_one({'_id': _id})['status'] for _id in ids]
+        self.assertEqual(statuses, [NotebookStatus.ERROR, NotebookStatus.ERROR,
+                                    NotebookStatus.RUNNING, NotebookStatus.ERROR])
+        self.assertTrue(any(
+            info.get('unique') and 'partialFilterExpression' in info
+            for info in collection.index_information().values()))
+        # Running the migration again changes nothing
+        self.assertEqual(model.resolveDuplicates(collection), 0)
+        collection.delete_many({'folderId': key['folderId']})
+
+    def testPoolMaintenance(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        from girder.plugins.ythub.models import pool
+        now = datetime.datetime.utcnow()
+        frontend = {'_id': ObjectId(), 'poolSize': 2}
+        stale, fresh = [pool.Pool().save({
+            'frontendId': frontend['_id'],
+            'status': NotebookStatus.STARTING,
+            'memLimit': 0,
+            'created': created
+        }) for created in (now - datetime.timedelta(hours=1), now)]
+
+        # Entries left starting by a restart are dropped
+        pool.Pool().maintain()
+        self.assertIsNone(pool.Pool().load(stale['_id'], force=True))
+        self.assertIsNotNone(pool.Pool().load(fresh['_id'], force=True))
+
+        # Without the worker tasks pooling relies on, the pool is emptied
+        with mock.patch('celery.Celery') as celeryMock, \
+                mock.patch.object(pool, '_support', {'checked': None,
+                                                     'value': False}):
+            inspect = celeryMock.return_value.control.inspect.return_value
+            inspect.registered.return_value = {
+                'worker': ['gwvolman.tasks.launch_container']}
+            self.assertFalse(pool.workersSupportPooling())
+            pool.Pool().fill(frontend)
+            self.assertEqual(pool.Pool().find(
+                {'frontendId': frontend['_id']}).count(), 0)
+
+            inspect.registered.return_value = {
+                'worker': ['gwvolman.tasks.update_container']}
+            pool._support['checked'] = None
+            self.assertTrue(pool.workersSupportPooling())
+
+        # Concurrent refills do not overfill the pool, and a bad memory
+        # limit does not break them
+        frontend['memLimit'] = 'lots'
+        with mock.patch.object(pool, 'workersSupportPooling',
+                               return_value=True), \
+                mock.patch.object(pool, '_poolExecutor') as executorMock:
+            threads = [threading.Thread(target=pool.Pool().fill,
+                                        args=(frontend,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(executorMock.submit.call_count, 2)
+        self.assertEqual(pool.Pool().find(
+            {'frontendId': frontend['_id']}).count(), 2)
+        pool.Pool().collection.delete_many({'frontendId': frontend['_id']})
+
+    def testVolumeRetention(self):
+        from girder.plugins.ythub.models.volume import Volume
+        folder = {'_id': ObjectId()}
+        notebook = {
+            'creatorId': self.user['_id'],
+            'folderId': folder['_id'],
+            'volumeInfo': {'nodeId': '123456', 'volumeId': 'blah_volume'}
+        }
+
+        # Retention is disabled by default
+        self.assertFalse(Volume().retain(notebook))
+        self.assertIsNone(Volume().claim(self.user, folder))
+
+        self.model('setting').set(PluginSettings.VOLUME_RETENTION_TTL, '1')
+        self.assertTrue(Volume().retain(notebook))
+        self.assertEqual(Volume().claim(self.user, folder),
+                         notebook['volumeInfo'])
+        # A volume can only be claimed once
+        self.assertIsNone(Volume().claim(self.user, folder))
+
+        # Expired volumes are removed rather than reused
+        self.assertTrue(Volume().retain(notebook))
+        Volume().update({'folderId': folder['_id']}, {'$set': {
+            'lastUsed': datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        }})
+        with mock.patch('celery.Celery'):
+            self.assertIsNone(Volume().claim(self.user, folder))
+        self.model('setting').unset(PluginSettings.VOLUME_RETENTION_TTL)
+
+    def testReadinessProbe(self):
+        from girder.plugins.ythub.readiness import ReadinessProber
+        prober = ReadinessProber(initialDelay=0, baseDelay=0.01, maxDelay=0.05,
+                                 requestTimeout=0.1)
+        for attempt in range(10):
+            self.assertLessEqual(prober.backoff(attempt), 0.075)
+        self.assertGreaterEqual(prober.backoff(0), 0.005)
+
+        # Nothing listens on a port that was just released
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        done = threading.Event()
+        result = {}
+
+        def callback(ready, timings):
+            result.update(ready=ready, timings=timings)
+            done.set()
+
+        start = time.time()
+        prober.probe('http://127.0.0.1:%d/' % port, callback, timeout=0.5)
+        self.assertTrue(done.wait(5))
+        self.assertFalse(result['ready'])
+        # Refused connections count as resolved, and the deadline holds
+        self.assertIn('boot', result['timings'])
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        self.assertLess(time.time() - start, 2)
+
+    def testPlacement(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        from girder.plugins.ythub.models.placement import Placement
+        model = self.model('notebook', 'ythub')
+        frontend = {'_id': ObjectId()}
+        notebook = {'_id': ObjectId(), 'memLimit': 1024}
+
+        # Without a capacity the worker pool decides
+        placement = Placement().place(notebook, frontend)
+        self.assertIsNone(placement['nodeId'])
+
+        busy = [model.save({
+            'folderId': ObjectId(),
+            'creatorId': self.user['_id'],
+            'frontendId': frontend['_id'],
+            'status': NotebookStatus.RUNNING,
+            'memLimit': memLimit,
+            'created': datetime.datetime.utcnow(),
+            'serviceInfo': {'nodeId': nodeId}
+        }) for nodeId, memLimit in (('node1', 4096), ('node1', 4096),
+                                    ('node2', 2048))]
+
+        self.model('setting').set(PluginSettings.NODE_MEMORY_CAPACITY, '16k')
+        placement = Placement().place(notebook, frontend)
+        self.assertEqual(placement['nodeId'], 'node2')
+        self.assertEqual(placement['reason'], 'load')
+        self.assertEqual(len(placement['candidates']), 2)
+
+        # Full nodes are skipped
+        self.model('setting').set(PluginSettings.NODE_MEMORY_CAPACITY, '2k')
+        placement = Placement().place(notebook, frontend)
+        self.assertIsNone(placement['nodeId'])
+        self.assertEqual(placement['reason'], 'default')
+
+        self.model('setting').unset(PluginSettings.NODE_MEMORY_CAPACITY)
+        for doc in busy:
+            model.remove(doc)
+
+    def testBulkDelete(self):
+        from girder.plugins.ythub.constants import NotebookStatus
+        model = self.model('notebook', 'ythub')
+        now = datetime.datetime.utcnow()
+        notebooks = [model.save({
+            'folderId': ObjectId(),
+            'creatorId': self.user['_id'],
+            'frontendId': self.user['_id'],
+            'status': NotebookStatus.RUNNING,
+            'created': now - datetime.timedelta(hours=hours),
+            'lastActivity': now,
+            'serviceInfo': {'nodeId': nodeId}
+        }) for hours, nodeId in ((5, '123456'), (3, '654321'), (0, '123456'))]
+
+        resp = self.request(path='/notebook', method='DELETE', user=self.admin)
+        self.assertStatus(resp, 400)
+
+        resp = self.request(path='/notebook', method='DELETE', user=self.user,
+                            params={'userId': self.user['_id']})
+        self.assertStatus(resp, 403)
+
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        with mock.patch('celery.Celery'):
+            resp = self.request(
+                path='/notebook', method='DELETE', user=self.admin,
+                params={'userId': self.user['_id'], 'olderThan': 1})
+            self.assertStatusOk(resp)
+            for _ in range(100):
+                job = Job().load(resp.json['_id'], force=True,
+                                 includeLog=True)
+                if job['status'] in (JobStatus.SUCCESS, JobStatus.ERROR):
+                    break
+                time.sleep(0.1)
+        self.assertEqual(job['status'], JobStatus.SUCCESS)
+        log = ''.join(job['log'])
+        for notebook in notebooks[:2]:
+            self.assertIn('%s: shutdown ' % notebook['_id'], log)
+        self.assertNotIn(str(notebooks[2]['_id']), log)
+
+        self.assertIsNone(model.load(notebooks[0]['_id'], force=True))
+        self.assertIsNone(model.load(notebooks[1]['_id'], force=True))
+        self.assertIsNotNone(model.load(notebooks[2]['_id'], force=True))
+        model.remove(notebooks[2])
+
     def tearDown(self):
         self.model('user').remove(self.user)
         self.model('user').remove(self.admin)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import zipfile
+
+from bson import ObjectId
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('ythub')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class QMCTestCase(base.TestCase):
+
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.admin = self.model('user').createUser(
+            'qmcadmin', 'passwd', 'Q', 'Admin', 'qmcadmin@dev.null',
+            admin=True)
+        self.user = self.model('user').createUser(
+            'qmcuser', 'passwd', 'Q', 'User', 'qmcuser@dev.null')
+        self.public = self.model('folder').createFolder(
+            self.admin, 'public', parentType='user', public=True)
+        self.private = self.model('folder').createFolder(
+            self.admin, 'private', parentType='user', public=False)
+        self.configId = ObjectId()
+        self.sims = []
+        for i, (folder, tkelvin, pgpa) in enumerate((
+                (self.public, 300, 10), (self.public, 300, 10),
+                (self.public, 1000, 50), (self.private, 2000, 100))):
+            item = self.model('item').createItem(
+                'sim%d' % i, self.admin, folder)
+            item = self.model('item').setMetadata(item, {'conf': {
+                'configId': self.configId, 'tkelvin': tkelvin,
+                'pgpa': pgpa, 'ens': 'NVT', 'nconf': 2}})
+            self.sims.append(item)
+        self.model('item').createItem('notqmc', self.admin, self.public)
+
+    def _table(self, user, **params):
+        params.setdefault('draw', 1)
+        resp = self.request(path='/qmc/table', method='GET', user=user,
+                            params=params)
+        self.assertStatusOk(resp)
+        return resp.json
+
+    def testSummary(self):
+        from girder.plugins.ythub.models.qmc_summary import QMCSummary
+        self.assertEqual(QMCSummary().find().count(), 4)
+
+        table = self._table(None)
+        self.assertEqual(table['recordsTotal'], 3)
+        self.assertEqual(table['recordsFiltered'], 3)
+        table = self._table(self.admin, Tmin=500, sort='T', sortdir=-1)
+        self.assertEqual(table['recordsTotal'], 4)
+        self.assertEqual(table['recordsFiltered'], 2)
+        self.assertEqual([row['T'] for row in table['data']], [2000, 1000])
+        self.assertEqual(table['data'][0]['DT_RowData']['itemId'],
+                         str(self.sims[3]['_id']))
+        table = self._table(self.admin, sort='ens')
+        self.assertEqual(len(table['data']), 4)
+        table = self._table(self.admin, sort='bogus')
+        self.assertEqual([row['name'] for row in table['data']],
+                         ['sim0', 'sim1', 'sim2', 'sim3'])
+
+        resp = self.request(path='/qmc/filter', method='GET', user=self.user,
+                            params={'Pmax': 20})
+        self.assertStatusOk(resp)
+        self.assertEqual(set(item['name'] for item in resp.json),
+                         {'sim0', 'sim1'})
+
+        # Access changes of the folder are reflected
+        self.model('folder').setPublic(self.private, True, save=True)
+        self.assertEqual(self._table(self.user)['recordsTotal'], 4)
+
+        # Metadata updates and removals are reflected
+        self.model('item').setMetadata(self.sims[0], {'conf': {
+            'configId': self.configId, 'tkelvin': 300, 'pgpa': 20,
+            'ens': 'NVT', 'nconf': 5}})
+        self.model('item').remove(self.sims[1])
+        resp = self.request(path='/qmc/count', method='GET')
+        self.assertStatusOk(resp)
+        counts = {(row['_id']['tkelvin'], row['_id']['pgpa']): row['count']
+                  for row in resp.json}
+        self.assertEqual(counts, {(300, 20): 5, (1000, 50): 2,
+                                  (2000, 100): 2})
+
+        # Counts are served with an ETag until they change
+        etag = resp.headers['ETag']
+        resp = self.request(path='/qmc/count', method='GET',
+                            additionalHeaders=[('If-None-Match', etag)],
+                            isJson=False)
+        self.assertStatus(resp, 304)
+        self.model('item').setMetadata(self.sims[2], {'conf': {
+            'configId': self.configId, 'tkelvin': 300, 'pgpa': 20,
+            'ens': 'NVT', 'nconf': 1}})
+        resp = self.request(path='/qmc/count', method='GET',
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        counts = {(row['_id']['tkelvin'], row['_id']['pgpa']): row['count']
+                  for row in resp.json}
+        self.assertEqual(counts, {(300, 20): 6, (2000, 100): 2})
+
+        # A recount from the summaries agrees with the incremental updates
+        QMCSummary().recount()
+        resp = self.request(path='/qmc/count', method='GET')
+        self.assertEqual(
+            {(row['_id']['tkelvin'], row['_id']['pgpa']): row['count']
+             for row in resp.json}, counts)
+
+    def testDownload(self):
+        from girder.plugins.ythub.rest import qmc
+        for item, name, data in (
+                (self.sims[0], 'a.txt', b'first'),
+                (self.sims[0], 'b.txt', b'second'),
+                (self.sims[2], 'sim2', b'third'),
+                (self.sims[3], 'c.txt', b'private')):
+            self.model('upload').uploadFromFile(
+                io.BytesIO(data), len(data), name, parentType='item',
+                parent=item, user=self.admin)
+
+        batchSize = qmc._DOWNLOAD_BATCH
+        qmc._DOWNLOAD_BATCH = 1
+        try:
+            resp = self.request(path='/qmc/download', method='GET',
+                                user=self.user, isJson=False)
+        finally:
+            qmc._DOWNLOAD_BATCH = batchSize
+        self.assertStatusOk(resp)
+        archive = self.getBody(resp, text=False)
+        self.assertEqual(int(resp.headers['Content-Length']), len(archive))
+        zf = zipfile.ZipFile(io.BytesIO(archive))
+        self.assertIsNone(zf.testzip())
+        contents = {name: zf.read(name) for name in zf.namelist()}
+        self.assertEqual(contents, {'sim0/a.txt': b'first',
+                                    'sim0/b.txt': b'second',
+                                    'sim2': b'third'})
+
+        # The layout of the archive is the same from one request to the next
+        from girder.plugins.ythub.archive import ZipManifest
+        manifests = [ZipManifest(qmc.QMC.downloadEntries({}, self.user))
+                     for _ in range(2)]
+        self.assertEqual(
+            *[[(entry['path'], entry['offset']) for entry in manifest.entries]
+              for manifest in manifests])
+        self.assertEqual(manifests[0].etag, manifests[1].etag)
+
+        # Byte ranges match the full archive, even once cached CRCs are gone
+        from girder.plugins.ythub.archive import CRC_FIELD
+        self.model('file').update({}, {'$unset': {CRC_FIELD: True}})
+        etag = resp.headers['ETag']
+        size = len(archive)
+        for header, start, end in (('bytes=10-99', 10, 100),
+                                   ('bytes=-30', size - 30, size)):
+            resp = self.request(path='/qmc/download', method='GET',
+                                user=self.user, isJson=False,
+                                additionalHeaders=[('Range', header),
+                                                   ('If-Range', etag)])
+            self.assertStatus(resp, 206)
+            self.assertEqual(self.getBody(resp, text=False),
+                             archive[start:end])
+            self.assertEqual(resp.headers['Content-Range'],
+                             'bytes %d-%d/%d' % (start, end - 1, size))
+
+        # Stale If-Range gets the whole archive, bad ranges a 416
+        resp = self.request(path='/qmc/download', method='GET',
+                            user=self.user, isJson=False,
+                            additionalHeaders=[('Range', 'bytes=10-99'),
+                                               ('If-Range', '"stale"')])
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), archive)
+        resp = self.request(path='/qmc/download', method='GET',
+                            user=self.user, additionalHeaders=[
+                                ('Range', 'bytes=%d-' % size)])
+        self.assertStatus(resp, 416)
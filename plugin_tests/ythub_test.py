@@ -1,4 +1,10 @@
+import json
+import mock
+import msgpack
 import six
+import time
+
+from bson import ObjectId
 from tests import base
 from girder.constants import SettingKey
 
@@ -148,6 +154,39 @@ class YtHubTestCase(base.TestCase):
         self.assertEqual(
             str(user['_id']), resp.json[0]['object']['_id'])
 
+        # Ancestors are stored, and dropped when a folder moves
+        sub1 = self.model('folder').createFolder(folder, 'sub1')
+        sub2 = self.model('folder').createFolder(sub1, 'sub2')
+        resp = self.request(
+            path='/folder/{_id}/rootpath'.format(**sub2),
+            user=user, method='GET')
+        self.assertStatusOk(resp)
+        self.assertEqual([_['object']['_id'] for _ in resp.json],
+                         [str(user['_id']), str(folder['_id']),
+                          str(sub1['_id'])])
+        sub2 = self.model('folder').load(sub2['_id'], force=True)
+        self.assertEqual(len(sub2['ythubAncestors']), 3)
+
+        self.model('folder').move(
+            self.model('folder').load(sub1['_id'], force=True),
+            user, 'user')
+        sub2 = self.model('folder').load(sub2['_id'], force=True)
+        self.assertNotIn('ythubAncestors', sub2)
+        resp = self.request(
+            path='/folder/rootpath', method='POST', user=user,
+            params={'ids': json.dumps([str(sub2['_id']), str(sub1['_id'])])})
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [_['object']['_id'] for _ in resp.json[str(sub2['_id'])]],
+            [str(user['_id']), str(sub1['_id'])])
+        self.assertEqual(
+            [_['object']['_id'] for _ in resp.json[str(sub1['_id'])]],
+            [str(user['_id'])])
+        resp = self.request(
+            path='/folder/rootpath', method='POST', user=user,
+            params={'ids': 'nope'})
+        self.assertStatus(resp, 400)
+
         # not much to check
         resp = self.request(
             path='/folder/{_id}/check'.format(**folder),
@@ -160,10 +199,49 @@ class YtHubTestCase(base.TestCase):
         self.assertStatusOk(resp)
         item = resp.json
 
+        self.model('item').update(
+            {'_id': ObjectId(item['_id'])}, {'$set': {'size': 42}})
         resp = self.request(
             path='/item/{_id}/check'.format(**item),
             user=user, method='PUT')
         self.assertStatusOk(resp)
+        self._waitForJob(resp.json)
+        item = self.model('item').load(item['_id'], force=True)
+        self.assertEqual(item['size'], 0)
+
+        # Collection checks fix sizes bottom-up
+        coll = self.model('collection').createCollection('sized', user)
+        top = self.model('folder').createFolder(
+            coll, 'top', parentType='collection')
+        sub = self.model('folder').createFolder(top, 'sub')
+        subItem = self.model('item').createItem('blob', user, sub)
+        self.model('file').createFile(
+            user, subItem, 'blob', 10, self.model('assetstore').getCurrent())
+        self.model('folder').update(
+            {'_id': sub['_id']}, {'$set': {'size': 3}})
+        self.model('collection').update(
+            {'_id': coll['_id']}, {'$set': {'size': 0}})
+        resp = self.request(
+            path='/collection/{_id}/check'.format(**coll),
+            user=user, method='PUT')
+        self.assertStatusOk(resp)
+        job = self._waitForJob(resp.json)
+        self.assertEqual(job['log'], ['Fixed 2 sizes.\n'])
+        self.assertEqual(self.model('folder').load(
+            sub['_id'], force=True)['size'], 10)
+        self.assertEqual(self.model('collection').load(
+            coll['_id'], force=True)['size'], 10)
+
+    def _waitForJob(self, job, timeout=10):
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.jobs.models.job import Job
+        for _ in range(timeout * 10):
+            job = Job().load(job['_id'], force=True, includeLog=True)
+            if job['status'] in (JobStatus.SUCCESS, JobStatus.ERROR):
+                break
+            time.sleep(0.1)
+        self.assertEqual(job['status'], JobStatus.SUCCESS)
+        return job
 
     def testListing(self):
         adminDef = {
@@ -219,6 +297,181 @@ class YtHubTestCase(base.TestCase):
         self.assertEqual(set(_['_id'] for _ in resp.json['files']),
                          set((str(fl1['_id']), str(fl2['_id']))))
 
+        # Projected listings only carry the requested fields
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, params={'fields': 'name,size'})
+        self.assertStatusOk(resp)
+        for entry in resp.json['folders'] + resp.json['files']:
+            self.assertEqual(set(entry), {'_id', 'name', 'size'})
+        resp = self.request(
+            path='/item/{_id}/listing'.format(**i1), method='GET',
+            user=user, params={'fields': 'path'})
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            set(_['path'] for _ in resp.json['files']),
+            set(('/nonexistent/path/foo1', '/nonexistent/path/foo2')))
+
+        resp = self.request(
+            path='/item/{_id}/listing'.format(**i1), method='GET',
+            user=user, params={'fields': 'name'}, isJson=False,
+            additionalHeaders=[('Accept', 'application/x-msgpack')])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Type'], 'application/x-msgpack')
+        listing = msgpack.unpackb(self.getBody(resp, text=False), raw=False)
+        self.assertEqual(set(_['name'] for _ in listing['files']),
+                         set(('foo1', 'foo2')))
+
+        # Bulk listings match the single ones
+        resp = self.request(
+            path='/folder/listing', method='POST', user=user, params={
+                'folderIds': json.dumps([str(f1['_id']), str(f2['_id'])]),
+                'itemIds': json.dumps([str(i1['_id'])])
+            })
+        self.assertStatusOk(resp)
+        self.assertEqual(set(resp.json['folders']),
+                         set((str(f1['_id']), str(f2['_id']))))
+        for folder in (f1, f2):
+            single = self.request(
+                path='/folder/{_id}/listing'.format(**folder), method='GET',
+                user=user)
+            self.assertEqual(resp.json['folders'][str(folder['_id'])],
+                             single.json)
+        self.assertEqual(
+            [_['_id'] for _ in resp.json['items'][str(i1['_id'])]['files']],
+            sorted((str(fl1['_id']), str(fl2['_id']))))
+
+        # Unchanged listings are answered with 304 Not Modified
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user)
+        etag = resp.headers['ETag']
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, additionalHeaders=[('If-None-Match', etag)],
+            isJson=False)
+        self.assertStatus(resp, 304)
+        i6 = self.model('item').createItem('i6', user, f2)
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.model('item').remove(i6)
+
+        # Recursive listings nest the content of each folder
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, params={'recursive': True})
+        self.assertStatusOk(resp)
+        self.assertFalse(resp.json['truncated'])
+        self.assertEqual([_['_id'] for _ in resp.json['files']],
+                         [str(fl3['_id'])])
+        subtree = {_['_id']: _ for _ in resp.json['folders']}
+        self.assertEqual(
+            set(_['name'] for _ in subtree[str(f2['_id'])]['listing']['files']),
+            set(('foo4', 'foo5', 'foo6')))
+
+        # Bookkeeping fields of the plugin are not part of listings
+        from girder.plugins.ythub.listing import VERSION_FIELD
+        self.assertIn(VERSION_FIELD, self.model('folder').load(
+            f2['_id'], force=True))
+        self.assertNotIn(VERSION_FIELD, subtree[str(f2['_id'])])
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, params={'fields': 'name,' + VERSION_FIELD})
+        self.assertStatusOk(resp)
+        for folder in resp.json['folders']:
+            self.assertNotIn(VERSION_FIELD, folder)
+        self.assertEqual(
+            set(_['_id'] for _ in subtree[str(i1['_id'])]['listing']['files']),
+            set((str(fl1['_id']), str(fl2['_id']))))
+
+        for params in ({'depth': 1}, {'maxEntries': 4}):
+            params['recursive'] = True
+            resp = self.request(
+                path='/folder/{_id}/listing'.format(**f1), method='GET',
+                user=user, params=params)
+            self.assertStatusOk(resp)
+            self.assertTrue(resp.json['truncated'])
+            self.assertEqual(len(resp.json['folders']), 2)
+            for folder in resp.json['folders']:
+                self.assertNotIn('listing', folder)
+
+        # Folders are expanded as long as their content fits
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, params={'recursive': True, 'maxEntries': 6})
+        self.assertStatusOk(resp)
+        self.assertTrue(resp.json['truncated'])
+        subtree = {_['_id']: _ for _ in resp.json['folders']}
+        self.assertEqual(len(subtree[str(f2['_id'])]['listing']['files']), 3)
+        self.assertNotIn('listing', subtree[str(i1['_id'])])
+
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, params={'recursive': True, 'limit': 1})
+        self.assertStatus(resp, 400)
+
+        # Paginated listings walk subfolders first, then items
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': 1}
+            if cursor:
+                params['cursor'] = cursor
+            resp = self.request(
+                path='/folder/{_id}/listing'.format(**f1), method='GET',
+                user=user, params=params)
+            self.assertStatusOk(resp)
+            page = resp.json['folders'] + resp.json['files']
+            seen += [_['_id'] for _ in page]
+            cursor = resp.json['nextCursor']
+            if not cursor:
+                break
+        self.assertEqual(seen[0], str(f2['_id']))
+        self.assertEqual(set(seen), set((
+            str(f2['_id']), str(i1['_id']), str(fl3['_id']))))
+        self.assertEqual(len(seen), 3)
+
+        resp = self.request(
+            path='/folder/{_id}/listing'.format(**f1), method='GET',
+            user=user, params={'limit': 2, 'cursor': 'bogus'})
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'], 'Invalid cursor.')
+
+        resp = self.request(
+            path='/item/{_id}/listing'.format(**i1), method='GET',
+            user=user, params={'stream': True, 'limit': 1}, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(_) for _ in
+                 self.getBody(resp).strip().split('\n')]
+        self.assertEqual(len(lines), 2)
+        self.assertIn(lines[0]['file']['_id'],
+                      (str(fl1['_id']), str(fl2['_id'])))
+        self.assertIsNotNone(lines[1]['nextCursor'])
+
+        # The returned cursor leads to the next page
+        resp = self.request(
+            path='/item/{_id}/listing'.format(**i1), method='GET',
+            user=user, params={'stream': True, 'limit': 1,
+                               'cursor': lines[1]['nextCursor']},
+            isJson=False)
+        self.assertStatusOk(resp)
+        nextLines = [json.loads(_) for _ in
+                     self.getBody(resp).strip().split('\n')]
+        self.assertEqual(
+            set((lines[0]['file']['_id'], nextLines[0]['file']['_id'])),
+            set((str(fl1['_id']), str(fl2['_id']))))
+
+        # Assetstore adapters are cached until the assetstore changes
+        from girder.plugins.ythub import listing
+        store = self.model('assetstore').load(assetstore['_id'])
+        self.assertIn(store['_id'], listing._adapters)
+        self.model('assetstore').save(store)
+        self.assertNotIn(store['_id'], listing._adapters)
+
         resp = self.request(
             path='/ythub/{_id}/examples'.format(**f1), method='GET',
             user=user)
@@ -249,6 +502,77 @@ class YtHubTestCase(base.TestCase):
         ]}
         self.assertEqual(resp.json, result)
 
+    def testChanges(self):
+        user = self.model('user').createUser(
+            'changes', 'passwd', 'tst', 'usr', 'changes@user.com')
+        coll = self.model('collection').createCollection('changes', user)
+        root = self.model('folder').createFolder(
+            coll, 'root', parentType='collection')
+        path = '/folder/{_id}/changes'.format(**root)
+
+        resp = self.request(path=path, method='GET', user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['changes'], [])
+        token = resp.json['nextToken']
+
+        sub = self.model('folder').createFolder(root, 'sub')
+        item = self.model('item').createItem('it', user, sub)
+        item['name'] = 'renamed'
+        item = self.model('item').save(item)
+        self.model('item').remove(item)
+
+        resp = self.request(path=path, method='GET', user=user,
+                            params={'since': token})
+        self.assertStatusOk(resp)
+        self.assertFalse(resp.json['reset'])
+        changes = [(_['type'], _['action'], _['name'])
+                   for _ in resp.json['changes']]
+        self.assertEqual(changes[0], ('folder', 'created', 'sub'))
+        self.assertEqual(
+            [_ for _ in changes if _[0] == 'item'],
+            [('item', 'created', 'it'), ('item', 'updated', 'renamed'),
+             ('item', 'deleted', 'renamed')])
+
+        # Paging and resuming
+        resp = self.request(path=path, method='GET', user=user,
+                            params={'since': token, 'limit': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['changes']), 1)
+        self.assertTrue(resp.json['more'])
+        resp = self.request(path=path, method='GET', user=user,
+                            params={'since': resp.json['nextToken']})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['changes']), len(changes) - 1)
+
+        # Changes elsewhere are not reported
+        token = resp.json['nextToken']
+        self.model('folder').createFolder(coll, 'other',
+                                          parentType='collection')
+        resp = self.request(path=path, method='GET', user=user,
+                            params={'since': token})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['changes'], [])
+
+        # Unknown tokens require a full listing
+        resp = self.request(path=path, method='GET', user=user,
+                            params={'since': str(10 ** 12)})
+        self.assertStatusOk(resp)
+        self.assertTrue(resp.json['reset'])
+        resp = self.request(path=path, method='GET', user=user,
+                            params={'since': str(ObjectId())})
+        self.assertStatus(resp, 400)
+
+        # Changes still being written hold the token back
+        from girder.plugins.ythub.models import change
+        head = change.Change().latest()
+        change.Change()._sequence.update_one(
+            {'_id': 'seq'}, {'$inc': {'seq': 1}})
+        self.model('folder').createFolder(root, 'late')
+        self.assertEqual(change.Change().latest(), head)
+        # until its writer is given up on
+        with mock.patch.object(change, '_PENDING_GRACE', 0):
+            self.assertEqual(change.Change().latest(), head + 2)
+
     def testHubRoutes(self):
         from girder.plugins.ythub.constants import PluginSettings
         self.model('setting').set(
@@ -282,3 +606,11 @@ class YtHubTestCase(base.TestCase):
         resp = self.request(path='/ythub', method='GET')
         self.assertStatusOk(resp)
         self.assertEqual(resp.json['url'], 'https://blah.null')
+
+        resp = self.request(path='/ythub/metrics', method='GET', isJson=False)
+        self.assertStatus(resp, 401)
+        resp = self.request(path='/ythub/metrics', method='GET', user=admin,
+                            isJson=False)
+        self.assertStatusOk(resp)
+        self.assertIn('# TYPE ythub_launch_stage_seconds histogram',
+                      self.getBody(resp))
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the queries behind the ``/qmc`` routes on a synthetic dataset.
+
+The script runs in the Python environment of a Girder instance with this
+plugin installed, and works on the database Girder is configured with, so
+point it at a scratch database, e.g.::
+
+    GIRDER_MONGO_URI=mongodb://localhost:27017/qmc_bench \\
+        python scripts/qmc_benchmark.py --sims 100000 --output report.json
+
+It loads ``--sims`` simulation items (and their summaries) into a public
+folder, creates the plugin's indices, then records the ``explain()`` plan
+and the latency of the query run by each route. With ``--api-url`` the
+routes of a Girder server running against the same database are timed
+end to end as well.
+"""
+
+import argparse
+import datetime
+import json
+import random
+import statistics
+import time
+
+from bson import ObjectId
+import requests
+
+from girder.constants import AccessType
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.user import User
+from girder.plugins.ythub.models.qmc_count import QMCCount
+from girder.plugins.ythub.models.qmc_summary import ITEM_INDICES, QMCSummary
+
+_BATCH_SIZE = 5000
+
+
+def loadDataset(sims, configs, seed):
+    """Insert synthetic simulations, skipping events for speed."""
+    rng = random.Random(seed)
+    admin = User().findOne({'admin': True}) or User().createUser(
+        'qmcbench', 'qmcbench', 'QMC', 'Bench', 'qmcbench@localhost',
+        admin=True)
+    folder = Folder().createFolder(
+        admin, 'qmc-benchmark-%s' % ObjectId(), parentType='user',
+        public=True)
+    configIds = [ObjectId() for _ in range(configs)]
+    now = datetime.datetime.utcnow()
+    for start in range(0, sims, _BATCH_SIZE):
+        items = []
+        for i in range(start, min(start + _BATCH_SIZE, sims)):
+            items.append({
+                '_id': ObjectId(),
+                'name': 'sim%08d' % i,
+                'folderId': folder['_id'],
+                'baseParentType': 'user',
+                'baseParentId': admin['_id'],
+                'creatorId': admin['_id'],
+                'created': now,
+                'updated': now,
+                'size': 0,
+                'meta': {'conf': {
+                    'configId': rng.choice(configIds),
+                    'tkelvin': rng.randrange(100, 10000, 100),
+                    'pgpa': rng.randrange(0, 500, 5),
+                    'ens': rng.choice(['NVT', 'NPT']),
+                    'input_dft': rng.choice(['PBE', 'vdW-DF']),
+                    'config_dft': rng.choice(['PBE', 'vdW-DF']),
+                    'quantum': rng.random() < 0.5,
+                    'nconf': rng.randint(1, 100)
+                }}
+            })
+        Item().collection.insert_many(items)
+        QMCSummary().collection.insert_many(
+            [QMCSummary.summaryOf(item, folder) for item in items])
+    QMCSummary().recount()
+    return admin, folder, configIds
+
+
+def ensureIndices():
+    # Summary indices are created along with the model.
+    for index in ITEM_INDICES:
+        Item().ensureIndex(index)
+
+
+def _planSummary(plan):
+    """Flatten a winning plan into its chain of stages and indices."""
+    stages = []
+    while plan:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += '(%s)' % plan['indexName']
+        stages.append(stage)
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return ' <- '.join(stages)
+
+
+def explainFind(collection, query, sort=None, limit=0):
+    cursor = collection.find(query, limit=limit)
+    if sort:
+        cursor = cursor.sort(sort)
+    explain = cursor.explain()
+    stats = explain.get('executionStats', {})
+    return {
+        'plan': _planSummary(explain['queryPlanner']['winningPlan']),
+        'docsExamined': stats.get('totalDocsExamined'),
+        'keysExamined': stats.get('totalKeysExamined'),
+        'returned': stats.get('nReturned'),
+        'millis': stats.get('executionTimeMillis')
+    }
+
+
+def explainAggregate(collection, pipeline):
+    explain = collection.database.command(
+        'aggregate', collection.name, pipeline=pipeline, explain=True)
+    stages = explain.get('stages') or [{}]
+    planner = stages[0].get('$cursor', {}).get('queryPlanner') or \
+        explain.get('queryPlanner', {})
+    return {'plan': _planSummary(planner.get('winningPlan', {}))}
+
+
+def timeIt(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        tic = time.time()
+        fn()
+        latencies.append((time.time() - tic) * 1000)
+    latencies.sort()
+    return {
+        'min': latencies[0],
+        'median': statistics.median(latencies),
+        'p95': latencies[int(0.95 * (len(latencies) - 1))]
+    }
+
+
+def routeQueries(configId, user):
+    """
+    The main query of each route, and the scan rebuilding the summaries,
+    as (name, collection, query, sort).
+    """
+    summaries = QMCSummary()
+    public = summaries.permissionQuery(user, AccessType.READ)
+    rangeQuery = QMCSummary.rangeQuery(1000, 50, 5000, 250)
+    return [
+        ('GET /qmc?configId (conf)', Item().collection,
+         {'meta.conf.configId': configId}, [('name', 1)]),
+        ('GET /qmc?configId (configFileIds)', Item().collection,
+         {'meta.configFileIds': configId}, [('name', 1)]),
+        ('rebuild (scan)', Item().collection,
+         {'meta.conf.configId': {'$exists': True},
+          'meta.conf.tkelvin': {'$exists': True}}, None),
+        ('GET /qmc/filter', summaries.collection,
+         {'$and': [rangeQuery, public]}, [('name', 1)]),
+        ('GET /qmc/table (total)', summaries.collection, public, None),
+        ('GET /qmc/table (page, by T)', summaries.collection,
+         {'$and': [rangeQuery, public]}, [('tkelvin', -1)]),
+        ('GET /qmc/download (page)', summaries.collection,
+         {'$and': [rangeQuery, public]}, [('name', 1), ('_id', 1)])
+    ]
+
+
+def benchmarkHttp(apiUrl, configId, repeat):
+    params = {'Tmin': 1000, 'Tmax': 5000, 'Pmin': 50, 'Pmax': 250}
+    routes = [
+        ('GET /qmc', 'qmc', {'configId': str(configId), 'limit': 50}),
+        ('GET /qmc/filter', 'qmc/filter', dict(params, limit=50)),
+        ('GET /qmc/table', 'qmc/table',
+         dict(params, draw=1, limit=50, sort='T', sortdir=-1)),
+        ('GET /qmc/count', 'qmc/count', {})
+    ]
+    report = {}
+    for name, path, query in routes:
+        url = '%s/%s' % (apiUrl.rstrip('/'), path)
+        report[name] = timeIt(
+            lambda: requests.get(url, params=query).raise_for_status(),
+            repeat)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sims', type=int, default=100000,
+                        help='number of synthetic simulations to load')
+    parser.add_argument('--configs', type=int, default=1000,
+                        help='number of distinct configs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs per query for latency figures')
+    parser.add_argument('--skip-load', action='store_true',
+                        help='benchmark the data already in the database')
+    parser.add_argument('--api-url',
+                        help='e.g. http://localhost:8080/api/v1')
+    parser.add_argument('--output', help='write the JSON report there')
+    args = parser.parse_args()
+
+    if args.skip_load:
+        configId = Item().findOne(
+            {'meta.conf.configId': {'$exists': True}})['meta']['conf']['configId']
+    else:
+        _, _, configIds = loadDataset(args.sims, args.configs, args.seed)
+        configId = configIds[0]
+    ensureIndices()
+
+    report = {'sims': QMCSummary().find().count(), 'queries': {}}
+    for name, collection, query, sort in routeQueries(configId, None):
+        entry = explainFind(collection, query, sort, limit=50)
+        entry['latency'] = timeIt(
+            lambda: list(collection.find(query, sort=sort, limit=50)),
+            args.repeat)
+        report['queries'][name] = entry
+    countPipeline = [{'$group': {
+        '_id': {'tkelvin': '$tkelvin', 'pgpa': '$pgpa'},
+        'count': {'$sum': '$nconf'}}}]
+    entry = explainAggregate(QMCSummary().collection, countPipeline)
+    entry['latency'] = timeIt(
+        lambda: list(QMCSummary().collection.aggregate(countPipeline)),
+        args.repeat)
+    report['queries']['GET /qmc/count (aggregate)'] = entry
+    report['queries']['GET /qmc/count (cached)'] = {
+        'latency': timeIt(QMCCount().counts, args.repeat)}
+
+    if args.api_url:
+        report['http'] = benchmarkHttp(args.api_url, configId, args.repeat)
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
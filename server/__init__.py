@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import cherrypy
+from concurrent.futures import ThreadPoolExecutor
+import json
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from cryptography.exceptions import UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
@@ -8,21 +13,50 @@ import six
 
 from girder import events
 from girder.models.model_base import ValidationException
+from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.api import access
 from girder.api.describe import Description, describeRoute
 from girder.api.rest import boundHandler, loadmodel
 from girder.constants import AccessType, TokenScope
+from girder.exceptions import RestException
 
 from girder.utility.model_importer import ModelImporter
-from girder.utility import assetstore_utilities, setting_utilities
+from girder.utility import setting_utilities
+from girder.plugins.jobs.models.job import Job
 
+from . import changes
 from .constants import PluginSettings
+from . import listing
+from .listing import acceptsMsgpack, bulkListing, checkETag, decodeCursor, \
+    fileChanged, folderChanged, invalidateAssetstoreAdapter, itemChanged, \
+    iterFolderEntries, iterItemEntries, msgpackResponse, paginate, \
+    parseFields, streamListing, subtreeListing
+from .models.change import Change
+from .models.pool import Pool, _poolExecutor
+from .models.qmc_count import QMCCount
+from .models.qmc_summary import ITEM_INDICES, QMCSummary
+from .models.volume import Volume
 from .rest.frontend import Frontend
 from .rest.notebook import Notebook
 from .rest.raft import Raft
 from .rest.ythub import ytHub
 from .rest.qmc import QMC
+from .rootpath import ANCESTORS_FIELD, folderMoved as ancestorsMoved, \
+    rootPaths
+from .sizes import scheduleSizeCheck
+from .utils import BATCH_SIZE, parentFolderId, parseMemory
+
+# Upper bounds (and defaults) of recursive folder listings.
+_SUBTREE_DEPTH = 32
+_SUBTREE_ENTRIES = 10000
+# Upper bound (and default) of the number of changes returned at once.
+_CHANGES_LIMIT = 1000
+# Maximum number of resources resolved by a single bulk request.
+_BULK_LIMIT = 1000
+# Rebuilds of the QMC summaries may take a while on large instances, so they
+# run on their own thread rather than holding up notebook launches.
+_qmcExecutor = ThreadPoolExecutor(max_workers=1)
 
 
 @setting_utilities.validator(PluginSettings.HUB_PRIV_KEY)
@@ -105,103 +139,300 @@ def validateCullingFrequency(doc):
             'Culling frequency must float.', 'value')
 
 
+@setting_utilities.validator(PluginSettings.POOL_MEMORY_LIMIT)
+def validatePoolMemoryLimit(doc):
+    if not doc['value']:
+        return
+    try:
+        parseMemory(doc['value'])
+    except ValueError:
+        raise ValidationException(
+            'Pool memory limit must be a memory size (e.g. 8g).', 'value')
+
+
+@setting_utilities.validator(PluginSettings.VOLUME_RETENTION_TTL)
+def validateVolumeRetentionTtl(doc):
+    if not doc['value']:
+        return
+    try:
+        float(doc['value'])
+    except ValueError:
+        raise ValidationException(
+            'Volume retention TTL must float.', 'value')
+
+
+@setting_utilities.validator(PluginSettings.VOLUME_NODE_BUDGET)
+def validateVolumeNodeBudget(doc):
+    if not doc['value']:
+        return
+    try:
+        parseMemory(doc['value'])
+    except ValueError:
+        raise ValidationException(
+            'Volume node budget must be a size (e.g. 50g).', 'value')
+
+
+@setting_utilities.validator(PluginSettings.NODE_MEMORY_CAPACITY)
+def validateNodeMemoryCapacity(doc):
+    if not doc['value']:
+        return
+    try:
+        parseMemory(doc['value'])
+    except ValueError:
+        raise ValidationException(
+            'Node memory capacity must be a memory size (e.g. 64g).', 'value')
+
+
+def _positiveInt(params, name, default):
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise RestException('%s must be a positive integer.' % name)
+    return value
+
+
+def _listingLimit(params):
+    try:
+        limit = int(params.get('limit', 0))
+    except ValueError:
+        limit = -1
+    if limit < 0:
+        raise RestException('Limit must be a non-negative integer.')
+    return limit
+
+
+def _listingResponse(resource, entries, limit, params):
+    useMsgpack = acceptsMsgpack()
+    if resource.boolParam('stream', params, default=False):
+        return streamListing(entries, limit, useMsgpack)
+    page = paginate(entries, limit)
+    return msgpackResponse(page) if useMsgpack else page
+
+
 @access.public(scope=TokenScope.DATA_READ)
 @loadmodel(model='folder', level=AccessType.READ)
 @describeRoute(
     Description('List the content of a folder.')
+    .notes('Responses are encoded with MessagePack when the Accept header '
+           'asks for application/x-msgpack.')
     .param('id', 'The ID of the folder.', paramType='path')
+    .param('limit', 'Maximum number of entries to return, 0 for all of '
+           'them. When set, the response includes a nextCursor.',
+           required=False, dataType='integer', default=0)
+    .param('cursor', 'The nextCursor of the previous page.', required=False)
+    .param('stream', 'Stream the entries as newline delimited JSON.',
+           required=False, dataType='boolean', default=False)
+    .param('fields', 'Comma separated list of the fields of each entry to '
+           'return, e.g. name,size,path. All fields by default.',
+           required=False)
+    .param('recursive', 'List the whole subtree, nesting the content of '
+           'each folder under its "listing" key. Cannot be combined with '
+           'limit, cursor or stream.',
+           required=False, dataType='boolean', default=False)
+    .param('depth', 'Maximum number of levels of a recursive listing.',
+           required=False, dataType='integer', default=_SUBTREE_DEPTH)
+    .param('maxEntries', 'Maximum number of entries in a recursive listing.',
+           required=False, dataType='integer', default=_SUBTREE_ENTRIES)
     .errorResponse('ID was invalid.')
     .errorResponse('Read access was denied for the folder.', 403)
 )
 @boundHandler()
 def listFolder(self, folder, params):
+    checkETag(folder, self.getCurrentUser(), params)
+    if self.boolParam('recursive', params, default=False):
+        if params.get('limit') or params.get('cursor') or \
+                params.get('fields') or \
+                self.boolParam('stream', params, default=False):
+            raise RestException(
+                'Recursive listings cannot be paginated, streamed or '
+                'projected.')
+        depth = _positiveInt(params, 'depth', _SUBTREE_DEPTH)
+        maxEntries = _positiveInt(params, 'maxEntries', _SUBTREE_ENTRIES)
+        subtree = subtreeListing(
+            folder, self.getCurrentUser(), min(depth, _SUBTREE_DEPTH),
+            min(maxEntries, _SUBTREE_ENTRIES))
+        return msgpackResponse(subtree) if acceptsMsgpack() else subtree
+    limit = _listingLimit(params)
+    entries = iterFolderEntries(
+        folder, self.getCurrentUser(),
+        after=decodeCursor(params.get('cursor')),
+        batchSize=min(limit, BATCH_SIZE) or BATCH_SIZE,
+        fields=parseFields(params.get('fields')))
+    return _listingResponse(self, entries, limit, params)
+
+
+def _sizeCheckResponse(resource, modelType, doc):
+    user = resource.getCurrentUser()
+    return Job().filter(scheduleSizeCheck(modelType, doc, user), user)
+
+
+@access.public(scope=TokenScope.DATA_READ)
+@describeRoute(
+    Description('List the content of many folders and items at once.')
+    .notes('Resources that do not exist or cannot be read are left out of '
+           'the result.')
+    .param('folderIds', 'JSON list of folder IDs.', paramType='form',
+           required=False)
+    .param('itemIds', 'JSON list of item IDs.', paramType='form',
+           required=False)
+    .errorResponse('ID was invalid.')
+)
+@boundHandler()
+def bulkListFolders(self, params):
+    folderIds = _parseIds(params, 'folderIds')
+    itemIds = _parseIds(params, 'itemIds')
+    if len(folderIds) + len(itemIds) > _BULK_LIMIT:
+        raise RestException(
+            'At most %d IDs can be given at once.' % _BULK_LIMIT)
+
     user = self.getCurrentUser()
-    folders = list(
-        self.model('folder').childFolders(parentType='folder',
-                                          parent=folder, user=user))
-
-    files = []
-    for item in self.model('folder').childItems(folder=folder):
-        childFiles = list(self.model('item').childFiles(item))
-        if len(childFiles) == 1:
-            fileitem = childFiles[0]
-            if 'imported' not in fileitem and \
-                    fileitem.get('assetstoreId') is not None:
-                try:
-                    store = \
-                        self.model('assetstore').load(fileitem['assetstoreId'])
-                    adapter = assetstore_utilities.getAssetstoreAdapter(store)
-                    fileitem["path"] = adapter.fullPath(fileitem)
-                except ValidationException:
-                    pass
-            files.append(fileitem)
-        else:
-            folders.append(item)
-    return {'folders': folders, 'files': files}
+    items = list(self.model('item').find({'_id': {'$in': itemIds}}))
+    parentIds = set(folderIds) | set(item['folderId'] for item in items)
+    readable = {
+        folder['_id']: folder
+        for folder in self.model('folder').find(
+            {'_id': {'$in': list(parentIds)}})
+        if self.model('folder').hasAccess(folder, user, AccessType.READ)}
+    folders = [readable[_id] for _id in folderIds if _id in readable]
+    items = [item for item in items if item['folderId'] in readable]
+
+    folderListings, itemListings = bulkListing(folders, items, user)
+    return {
+        'folders': {str(k): v for k, v in six.viewitems(folderListings)},
+        'items': {str(k): v for k, v in six.viewitems(itemListings)}
+    }
 
 
 @access.public(scope=TokenScope.DATA_OWN)
 @loadmodel(model='item', level=AccessType.ADMIN)
 @describeRoute(
     Description('Perform system check for a given item.')
+    .notes('Sizes are recomputed by a background job, which is returned.')
     .param('id', 'The ID of the item.', paramType='path')
     .errorResponse('ID was invalid.')
     .errorResponse('Read access was denied for the item.', 403)
 )
 @boundHandler()
 def checkItem(self, item, params):
-    self.model('item').updateSize(item)
+    return _sizeCheckResponse(self, 'item', item)
 
 
 @access.public(scope=TokenScope.DATA_OWN)
 @loadmodel(model='folder', level=AccessType.ADMIN)
 @describeRoute(
     Description('Perform system check for a given folder.')
+    .notes('Sizes are recomputed by a background job, which is returned.')
     .param('id', 'The ID of the folder.', paramType='path')
     .errorResponse('ID was invalid.')
     .errorResponse('Read access was denied for the folder.', 403)
 )
 @boundHandler()
 def checkFolder(self, folder, params):
-    self.model('folder').updateSize(folder)
+    return _sizeCheckResponse(self, 'folder', folder)
 
 
 @access.public(scope=TokenScope.DATA_OWN)
 @loadmodel(model='collection', level=AccessType.ADMIN)
 @describeRoute(
     Description('Perform system check for a given collection.')
+    .notes('Sizes are recomputed by a background job, which is returned.')
     .param('id', 'The ID of the collection.', paramType='path')
     .errorResponse('ID was invalid.')
     .errorResponse('Read access was denied for the collection.', 403)
 )
 @boundHandler()
 def checkCollection(self, collection, params):
-    self.model('collection').updateSize(collection)
+    return _sizeCheckResponse(self, 'collection', collection)
 
 
 @access.public(scope=TokenScope.DATA_READ)
 @loadmodel(model='item', level=AccessType.READ)
 @describeRoute(
     Description('List the content of an item.')
+    .notes('Responses are encoded with MessagePack when the Accept header '
+           'asks for application/x-msgpack.')
     .param('id', 'The ID of the folder.', paramType='path')
+    .param('limit', 'Maximum number of entries to return, 0 for all of '
+           'them. When set, the response includes a nextCursor.',
+           required=False, dataType='integer', default=0)
+    .param('cursor', 'The nextCursor of the previous page.', required=False)
+    .param('stream', 'Stream the entries as newline delimited JSON.',
+           required=False, dataType='boolean', default=False)
+    .param('fields', 'Comma separated list of the fields of each entry to '
+           'return, e.g. name,size,path. All fields by default.',
+           required=False)
     .errorResponse('ID was invalid.')
     .errorResponse('Read access was denied for the folder.', 403)
 )
 @boundHandler()
 def listItem(self, item, params):
-    files = []
-    for fileitem in self.model('item').childFiles(item):
-        if 'imported' not in fileitem and \
-                fileitem.get('assetstoreId') is not None:
-            try:
-                store = \
-                    self.model('assetstore').load(fileitem['assetstoreId'])
-                adapter = assetstore_utilities.getAssetstoreAdapter(store)
-                fileitem["path"] = adapter.fullPath(fileitem)
-            except ValidationException:
-                pass
-        files.append(fileitem)
-    return {'folders': [], 'files': files}
+    checkETag(item, self.getCurrentUser(), params)
+    limit = _listingLimit(params)
+    entries = iterItemEntries(item, after=decodeCursor(params.get('cursor')),
+                              fields=parseFields(params.get('fields')))
+    return _listingResponse(self, entries, limit, params)
+
+
+@access.public(scope=TokenScope.DATA_READ)
+@loadmodel(model='folder', level=AccessType.READ)
+@describeRoute(
+    Description('List what changed under a folder since a given token.')
+    .notes('Without a token, no changes are returned, only the token to '
+           'start from. When changes since the token are no longer '
+           'available, reset is set and the folder must be listed again.')
+    .param('id', 'The ID of the folder.', paramType='path')
+    .param('since', 'The nextToken of a previous call.', required=False)
+    .param('limit', 'Maximum number of changes to return.',
+           required=False, dataType='integer', default=1000)
+    .errorResponse('ID was invalid.')
+    .errorResponse('Read access was denied for the folder.', 403)
+)
+@boundHandler()
+def folderChanges(self, folder, params):
+    changeModel = Change()
+    result = {'changes': [], 'more': False, 'reset': False}
+    if not params.get('since'):
+        result['nextToken'] = str(changeModel.latest())
+        return result
+    try:
+        since = int(params['since'])
+    except (ValueError, TypeError):
+        raise RestException('Invalid token.')
+    if since < 0:
+        raise RestException('Invalid token.')
+    if changeModel.isExpired(since):
+        result.update(reset=True, nextToken=str(changeModel.latest()))
+        return result
+    head = changeModel.latest(since)
+    result['nextToken'] = str(head)
+
+    limit = min(_positiveInt(params, 'limit', _CHANGES_LIMIT), _CHANGES_LIMIT)
+    entries = list(changeModel.changesSince(folder, since, head, limit))
+    if len(entries) == limit:
+        result['nextToken'] = str(entries[-1]['seq'])
+        result['more'] = True
+
+    # Leave out changes in or of folders the user cannot read.
+    user = self.getCurrentUser()
+    folderIds = set(change['folderId'] for change in entries)
+    folderIds.update(change['resourceId'] for change in entries
+                     if change['type'] == 'folder')
+    hidden = set(
+        doc['_id'] for doc in self.model('folder').find(
+            {'_id': {'$in': list(folderIds)}},
+            fields=['public', 'access'])
+        if not self.model('folder').hasAccess(doc, user, AccessType.READ))
+    for change in entries:
+        ids = {change['folderId']}
+        if change['type'] == 'folder':
+            ids.add(change['resourceId'])
+        if ids & hidden:
+            continue
+        del change['ancestors']
+        result['changes'].append(change)
+    return result
 
 
 @access.public(scope=TokenScope.DATA_READ)
@@ -214,8 +445,40 @@ def listItem(self, item, params):
 )
 @boundHandler()
 def folderRootpath(self, folder, params):
-    return self.model('folder').parentsToRoot(
-        folder, user=self.getCurrentUser())
+    return rootPaths([folder], user=self.getCurrentUser())[0]
+
+
+def _parseIds(params, name):
+    try:
+        ids = [ObjectId(_id) for _id in json.loads(params.get(name, '[]'))]
+    except (ValueError, TypeError, InvalidId):
+        raise RestException(
+            'The %s parameter must be a JSON list of IDs.' % name)
+    if len(ids) > _BULK_LIMIT:
+        raise RestException(
+            'At most %d IDs can be given at once.' % _BULK_LIMIT)
+    return ids
+
+
+@access.public(scope=TokenScope.DATA_READ)
+@describeRoute(
+    Description('Get the paths to the root of the hierarchy of many folders.')
+    .notes('Folders that do not exist or cannot be read, or whose path '
+           'contains such a resource, are left out of the result.')
+    .param('ids', 'JSON list of folder IDs.', paramType='form')
+    .errorResponse('ID was invalid.')
+)
+@boundHandler()
+def folderRootpaths(self, params):
+    self.requireParams('ids', params)
+    ids = _parseIds(params, 'ids')
+    user = self.getCurrentUser()
+    folders = [
+        folder for folder in self.model('folder').find({'_id': {'$in': ids}})
+        if self.model('folder').hasAccess(folder, user, AccessType.READ)]
+    paths = rootPaths(folders, user=user, exc=False)
+    return {str(folder['_id']): path
+            for folder, path in zip(folders, paths) if path is not None}
 
 
 def addDefaultFolders(event):
@@ -226,6 +489,61 @@ def addDefaultFolders(event):
         notebookFolder, user, AccessType.ADMIN, save=True)
 
 
+def refillPool(event):
+    _poolExecutor.submit(Pool().fill, event.info)
+
+
+def drainPool(event):
+    _poolExecutor.submit(Pool().drain, event.info)
+
+
+def summarizeQMC(event):
+    QMCSummary().summarize(event.info)
+
+
+def dropQMCSummary(event):
+    QMCSummary().drop(event.info)
+
+
+def rebuildQMC():
+    QMCSummary().rebuild()
+    QMCSummary().recount()
+
+
+def syncQMCAccess(event):
+    QMCSummary().syncAccess(event.info)
+
+
+def folderSaving(event):
+    """
+    Load the stored version of a folder being saved, once, and pass it on
+    to whatever depends on the folder being moved.
+    """
+    folder = event.info
+    if '_id' not in folder:
+        return
+    previous = Folder().load(folder['_id'], force=True,
+                             fields=['name', 'parentId', 'parentCollection'])
+    if previous and parentFolderId(previous) != parentFolderId(folder):
+        listing.folderMoved(folder, previous)
+        changes.folderMoved(folder, previous)
+
+
+def itemSaving(event):
+    """
+    Load the stored version of an item being saved, once, and pass it on
+    to whatever depends on the item being moved.
+    """
+    item = event.info
+    if '_id' not in item:
+        return
+    previous = Item().load(item['_id'], force=True,
+                           fields=['name', 'folderId'])
+    if previous and previous.get('folderId') != item.get('folderId'):
+        listing.itemMoved(item, previous)
+        changes.itemMoved(item, previous)
+
+
 def load(info):
     notebook = Notebook()
     info['apiRoot'].ythub = ytHub()
@@ -234,12 +552,66 @@ def load(info):
     info['apiRoot'].raft = Raft()
     info['apiRoot'].qmc = QMC()
     info['apiRoot'].folder.route('GET', (':id', 'listing'), listFolder)
+    info['apiRoot'].folder.route('POST', ('listing',), bulkListFolders)
     info['apiRoot'].item.route('GET', (':id', 'listing'), listItem)
     info['apiRoot'].item.route('PUT', (':id', 'check'), checkItem)
     info['apiRoot'].folder.route('GET', (':id', 'rootpath'), folderRootpath)
+    info['apiRoot'].folder.route('GET', (':id', 'changes'), folderChanges)
+    info['apiRoot'].folder.route('POST', ('rootpath',), folderRootpaths)
     info['apiRoot'].folder.route('PUT', (':id', 'check'), checkFolder)
     info['apiRoot'].collection.route('PUT', (':id', 'check'), checkCollection)
 
     Item().ensureIndex(['meta.isRaft', {'sparse': True}])
+    for index in ITEM_INDICES:
+        Item().ensureIndex(index)
+    if QMCSummary().findOne() is None:
+        _qmcExecutor.submit(rebuildQMC)
+    elif QMCCount().version() is None:
+        _qmcExecutor.submit(QMCSummary().recount)
+    Folder().ensureIndex([ANCESTORS_FIELD + '.id', {'sparse': True}])
 
     events.bind('model.user.save.created', 'ythub', addDefaultFolders)
+    # Launches that were running when the server went down are not coming back.
+    ModelImporter.model('notebook', 'ythub').expireLaunches()
+    cherrypy.process.plugins.Monitor(
+        cherrypy.engine, notebook.cullNotebooks, frequency=60,
+        name='ythub.culling').subscribe()
+    cherrypy.process.plugins.Monitor(
+        cherrypy.engine, Volume().evictExpired, frequency=300,
+        name='ythub.volumes').subscribe()
+    cherrypy.process.plugins.Monitor(
+        cherrypy.engine, Pool().maintain, frequency=60,
+        name='ythub.pool').subscribe()
+    events.bind('model.item.save.after', 'ythub.qmc', summarizeQMC)
+    events.bind('model.item.remove', 'ythub.qmc', dropQMCSummary)
+    events.bind('model.folder.save.after', 'ythub.qmc', syncQMCAccess)
+    events.bind('model.frontend.save.after', 'ythub', refillPool)
+    events.bind('model.frontend.remove', 'ythub', drainPool)
+    events.bind('model.assetstore.save.after', 'ythub',
+                invalidateAssetstoreAdapter)
+    events.bind('model.assetstore.remove', 'ythub',
+                invalidateAssetstoreAdapter)
+    events.bind('model.folder.save', 'ythub', folderSaving)
+    events.bind('model.folder.save', 'ythub.ancestors', ancestorsMoved)
+    events.bind('model.item.save', 'ythub', itemSaving)
+    for event, handler in (('model.folder.save.after', folderChanged),
+                           ('model.folder.remove', folderChanged),
+                           ('model.item.save.after', itemChanged),
+                           ('model.item.remove', itemChanged),
+                           ('model.file.save.after', fileChanged),
+                           ('model.file.remove', fileChanged)):
+        events.bind(event, 'ythub', handler)
+    for event, handler in (('model.folder.save.created', changes.folderCreated),
+                           ('model.folder.save.after', changes.folderSaved),
+                           ('model.folder.remove', changes.folderRemoved),
+                           ('model.item.save.created', changes.itemCreated),
+                           ('model.item.save.after', changes.itemSaved),
+                           ('model.item.remove', changes.itemRemoved),
+                           ('model.file.save.created', changes.fileCreated),
+                           ('model.file.save.after', changes.fileSaved),
+                           ('model.file.remove', changes.fileRemoved)):
+        events.bind(event, 'ythub.changes', handler)
+
+    for frontend in ModelImporter.model('frontend', 'ythub').find(
+            {'poolSize': {'$gt': 0}}):
+        _poolExecutor.submit(Pool().fill, frontend)
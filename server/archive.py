@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import hashlib
+import json
+import struct
+import zlib
+
+from girder.models.file import File
+
+from .prefetch import _prefetchExecutor, prefetchFiles
+
+# CRC-32 of the contents of a file, cached on the file along with the size
+# and hash it was computed for.
+CRC_FIELD = 'ythubCrc32'
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+_ZIP_VERSION = 20
+_ZIP64_VERSION = 45
+# Sizes and CRC follow the data, names are UTF-8.
+_FLAGS = 0x0808
+_EPOCH = datetime.datetime(1980, 1, 1)
+
+
+def _dosTime(date):
+    date = max(date or _EPOCH, _EPOCH)
+    return ((date.hour << 11) | (date.minute << 5) | (date.second // 2),
+            ((date.year - 1980) << 9) | (date.month << 5) | date.day)
+
+
+def cachedCrc(fileitem):
+    """The CRC-32 cached on a file, or None if missing or stale."""
+    crc = fileitem.get(CRC_FIELD)
+    if crc and crc.get('size') == fileitem.get('size') and \
+            crc.get('sha512') == fileitem.get('sha512'):
+        return crc['crc']
+    return None
+
+
+def storeCrc(fileitem, crc):
+    fileitem[CRC_FIELD] = {
+        'crc': crc,
+        'size': fileitem.get('size'),
+        'sha512': fileitem.get('sha512')
+    }
+    File().update({'_id': fileitem['_id']},
+                  {'$set': {CRC_FIELD: fileitem[CRC_FIELD]}})
+
+
+def computeCrc(fileitem):
+    """Read a file to compute its CRC-32, and cache it."""
+    crc = 0
+    for chunk in File().download(fileitem, headers=False)():
+        crc = zlib.crc32(chunk, crc)
+    crc &= 0xFFFFFFFF
+    storeCrc(fileitem, crc)
+    return crc
+
+
+class ZipManifest(object):
+    """
+    Layout of a zip archive of files, computed from their sizes alone, so
+    that the archive has a known length and any byte range of it can be
+    produced on its own. Entries are stored uncompressed, with their CRC in
+    a data descriptor following the data, which lets a full download
+    compute CRCs while streaming. Byte ranges that need the CRC of files
+    they do not cover in full read those files, once, as CRCs are cached.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: Iterable of (path, file) pairs, in archive order.
+        """
+        self.entries = []
+        offset = 0
+        for path, fileitem in entries:
+            name = path.encode('utf8')
+            size = fileitem.get('size') or 0
+            zip64 = size >= _ZIP64_LIMIT
+            version = _ZIP64_VERSION if zip64 or offset >= _ZIP64_LIMIT \
+                else _ZIP_VERSION
+            entry = {
+                'path': path,
+                'name': name,
+                'file': fileitem,
+                'size': size,
+                'zip64': zip64,
+                'version': version,
+                'offset': offset,
+                'dataOffset': offset + 30 + len(name)
+            }
+            entry['descriptorOffset'] = entry['dataOffset'] + size
+            entry['end'] = entry['descriptorOffset'] + (24 if zip64 else 16)
+            offset = entry['end']
+            self.entries.append(entry)
+        self.cdOffset = offset
+        self.cdSize = sum(46 + len(entry['name']) + len(self._cdExtra(entry))
+                          for entry in self.entries)
+        self.zip64 = len(self.entries) >= _ZIP64_COUNT_LIMIT or \
+            self.cdOffset >= _ZIP64_LIMIT or self.cdSize >= _ZIP64_LIMIT
+        self.size = self.cdOffset + self.cdSize + 22 + (76 if self.zip64 else 0)
+        self.etag = '"%s"' % hashlib.sha1(json.dumps([
+            (entry['path'], str(entry['file']['_id']), entry['size'],
+             entry['file'].get('sha512') or str(entry['file'].get('created')))
+            for entry in self.entries
+        ]).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def _cdExtra(entry):
+        fields = []
+        if entry['size'] >= _ZIP64_LIMIT:
+            fields += [entry['size'], entry['size']]
+        if entry['offset'] >= _ZIP64_LIMIT:
+            fields.append(entry['offset'])
+        if not fields:
+            return b''
+        return struct.pack('<HH%dQ' % len(fields), 1, 8 * len(fields),
+                           *fields)
+
+    @staticmethod
+    def localHeader(entry):
+        time, date = _dosTime(entry['file'].get('created'))
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, entry['version'], _FLAGS, 0, time, date,
+            0, 0, 0, len(entry['name']), 0) + entry['name']
+
+    @staticmethod
+    def descriptor(entry, crc):
+        fmt = '<IIQQ' if entry['zip64'] else '<IIII'
+        return struct.pack(fmt, 0x08074b50, crc, entry['size'], entry['size'])
+
+    def centralDirectory(self, crcs):
+        records = []
+        for entry in self.entries:
+            time, date = _dosTime(entry['file'].get('created'))
+            extra = self._cdExtra(entry)
+            size = min(entry['size'], _ZIP64_LIMIT)
+            records.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, _ZIP64_VERSION,
+                entry['version'], _FLAGS, 0, time, date,
+                crcs[entry['file']['_id']], size, size,
+                len(entry['name']), len(extra), 0, 0, 0, 0,
+                min(entry['offset'], _ZIP64_LIMIT)) + entry['name'] + extra)
+        count = len(self.entries)
+        end = b''
+        if self.zip64:
+            zip64End = self.cdOffset + self.cdSize
+            end += struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, _ZIP64_VERSION,
+                _ZIP64_VERSION, 0, 0, count, count, self.cdSize,
+                self.cdOffset)
+            end += struct.pack('<IIQI', 0x07064b50, 0, zip64End, 1)
+        end += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, _ZIP64_COUNT_LIMIT),
+            min(count, _ZIP64_COUNT_LIMIT), min(self.cdSize, _ZIP64_LIMIT),
+            min(self.cdOffset, _ZIP64_LIMIT), 0)
+        return b''.join(records) + end
+
+    def _crcs(self, entries, crcs):
+        """Fill ``crcs`` with the CRC of ``entries``, reading files if needed."""
+        missing = []
+        for entry in entries:
+            fileitem = entry['file']
+            if fileitem['_id'] in crcs:
+                continue
+            crc = 0 if not entry['size'] else cachedCrc(fileitem)
+            if crc is None:
+                missing.append(fileitem)
+            else:
+                crcs[fileitem['_id']] = crc
+        for fileitem, crc in zip(
+                missing, _prefetchExecutor.map(computeCrc, missing)):
+            crcs[fileitem['_id']] = crc
+
+    def stream(self, start=0, end=None):
+        """
+        Generate the bytes of the archive from ``start`` up to ``end``,
+        excluded.
+        """
+        end = self.size if end is None else end
+        crcs = {}
+
+        def dataRanges():
+            for entry in self.entries:
+                dataStart = max(start, entry['dataOffset'])
+                dataEnd = min(end, entry['descriptorOffset'])
+                if dataStart < dataEnd:
+                    yield (entry, entry['file'],
+                           dataStart - entry['dataOffset'],
+                           dataEnd - entry['dataOffset'])
+
+        data = prefetchFiles(dataRanges())
+        try:
+            for entry in self.entries:
+                if entry['offset'] >= end:
+                    return
+                if entry['end'] <= start:
+                    continue
+                for chunk in self._streamEntry(entry, start, end, data, crcs):
+                    yield chunk
+        finally:
+            data.close()
+        if end > self.cdOffset:
+            self._crcs(self.entries, crcs)
+            yield self.centralDirectory(crcs)[max(start - self.cdOffset, 0):
+                                              end - self.cdOffset]
+
+    def _streamEntry(self, entry, start, end, data, crcs):
+        fileId = entry['file']['_id']
+        if start < entry['dataOffset']:
+            yield self.localHeader(entry)[max(start - entry['offset'], 0):
+                                          end - entry['offset']]
+        if max(start, entry['dataOffset']) < \
+                min(end, entry['descriptorOffset']):
+            _, chunks = next(data)
+            whole = start <= entry['dataOffset'] and \
+                end >= entry['descriptorOffset']
+            crc = 0
+            for chunk in chunks():
+                if whole:
+                    crc = zlib.crc32(chunk, crc)
+                yield chunk
+            if whole:
+                crcs[fileId] = crc & 0xFFFFFFFF
+                if cachedCrc(entry['file']) != crcs[fileId]:
+                    storeCrc(entry['file'], crcs[fileId])
+        if end > entry['descriptorOffset']:
+            self._crcs([entry], crcs)
+            yield self.descriptor(entry, crcs[fileId])[
+                max(start - entry['descriptorOffset'], 0):
+                end - entry['descriptorOffset']]
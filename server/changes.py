@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from girder import logger
+from girder.models.item import Item
+
+from .models.change import Change
+from .utils import parentFolderId
+
+# Set by the save.created handlers on the document being saved, which
+# save.after then receives, so that creations are not also recorded as
+# updates. Girder triggers both events in turn from the same save.
+_CREATED = '_ythubCreated'
+
+
+def _isUpdate(doc):
+    return not doc.pop(_CREATED, False)
+
+
+def _record(action, resourceType, doc, folderId):
+    try:
+        Change().record(action, resourceType, doc, folderId)
+    except Exception:
+        logger.exception('Failed to record change of %s %s',
+                         resourceType, doc.get('_id'))
+
+
+def folderMoved(folder, previous):
+    """Record a folder being moved as deleted from its previous parent."""
+    _record('deleted', 'folder', previous, parentFolderId(previous))
+
+
+def folderCreated(event):
+    folder = event.info
+    folder[_CREATED] = True
+    _record('created', 'folder', folder, parentFolderId(folder))
+
+
+def folderSaved(event):
+    folder = event.info
+    if _isUpdate(folder):
+        _record('updated', 'folder', folder, parentFolderId(folder))
+
+
+def folderRemoved(event):
+    folder = event.info
+    _record('deleted', 'folder', folder, parentFolderId(folder))
+
+
+def itemMoved(item, previous):
+    """Record an item being moved as deleted from its previous folder."""
+    _record('deleted', 'item', previous, previous['folderId'])
+
+
+def itemCreated(event):
+    item = event.info
+    item[_CREATED] = True
+    _record('created', 'item', item, item['folderId'])
+
+
+def itemSaved(event):
+    item = event.info
+    if _isUpdate(item):
+        _record('updated', 'item', item, item['folderId'])
+
+
+def itemRemoved(event):
+    item = event.info
+    _record('deleted', 'item', item, item['folderId'])
+
+
+def _fileChanged(action, fileitem):
+    if fileitem.get('itemId') is None:
+        return
+    item = Item().load(fileitem['itemId'], force=True, fields=['folderId'])
+    if item is not None:
+        _record(action, 'file', fileitem, item['folderId'])
+
+
+def fileCreated(event):
+    event.info[_CREATED] = True
+    _fileChanged('created', event.info)
+
+
+def fileSaved(event):
+    if _isUpdate(event.info):
+        _fileChanged('updated', event.info)
+
+
+def fileRemoved(event):
+    _fileChanged('deleted', event.info)
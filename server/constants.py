@@ -14,6 +14,10 @@ class PluginSettings:
     REDIRECT_URL = 'ythub.tmpnb_redirect_url'
     HUB_PRIV_KEY = 'ythub.priv_key'
     HUB_PUB_KEY = 'ythub.pub_key'
+    POOL_MEMORY_LIMIT = 'ythub.pool_memory_limit'
+    VOLUME_RETENTION_TTL = 'ythub.volume_retention_ttl'
+    VOLUME_NODE_BUDGET = 'ythub.volume_node_budget'
+    NODE_MEMORY_CAPACITY = 'ythub.node_memory_capacity'
 
 
 # Constants representing the setting keys for this plugin
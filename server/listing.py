@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import base64
+import hashlib
+import itertools
+import json
+import threading
+
+import cherrypy
+import msgpack
+from bson import ObjectId
+from girder.api.rest import setResponseHeader
+from girder.constants import AccessType, SortDir
+from girder.exceptions import RestException
+from girder.models.assetstore import Assetstore
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.model_base import ValidationException
+from girder.utility import JsonEncoder, assetstore_utilities
+
+from .archive import CRC_FIELD
+from .rootpath import ANCESTORS_FIELD
+from .utils import BATCH_SIZE, batches, checkNotModified, parentFolderId
+
+# Listings are walked in two phases: subfolders, then items.
+_PHASES = ('folder', 'item')
+# Counter bumped on folders and items whenever their listing changes.
+VERSION_FIELD = 'ythubListingVersion'
+
+# Bookkeeping fields of the plugin, which are left out of listings.
+_INTERNAL_FIELDS = frozenset((VERSION_FIELD, ANCESTORS_FIELD, CRC_FIELD))
+_INTERNAL_PROJECTION = {field: False for field in _INTERNAL_FIELDS}
+
+# Media types clients may accept to get MessagePack encoded listings.
+MSGPACK_TYPES = ('application/x-msgpack', 'application/msgpack')
+
+_adapters = {}
+_adaptersLock = threading.Lock()
+
+
+def childFilesByItem(items, fields=None):
+    """
+    Fetch the files of many items with one query per batch of items. Files
+    are in ``_id`` order, so that archives built from them keep their layout.
+
+    :param fields: Fields to load, see :func:`queryFields`.
+    :returns: A dict mapping item ids to lists of their files.
+    """
+    itemIds = [item['_id'] for item in items]
+    files = {itemId: [] for itemId in itemIds}
+    if isinstance(fields, list):
+        fields = list(set(fields) | {'itemId'})
+    for batch in batches(itemIds):
+        for fileitem in File().find({'itemId': {'$in': batch}},
+                                    fields=fields,
+                                    sort=[('_id', SortDir.ASCENDING)]):
+            files[fileitem['itemId']].append(fileitem)
+    return files
+
+
+def parseFields(value):
+    """
+    Parse the comma separated ``fields`` parameter of listings.
+
+    :returns: The set of fields to return, always including ``_id``, or None
+        to return whole documents. Bookkeeping fields are never returned.
+    """
+    if not value:
+        return None
+    fields = set(field.strip() for field in value.split(',') if field.strip())
+    if not fields or any(field.startswith('$') for field in fields):
+        raise RestException('Invalid fields parameter.')
+    return (fields - _INTERNAL_FIELDS) | {'_id'}
+
+
+def queryFields(fields):
+    """
+    The fields to load from the database to return ``fields``: resolving
+    paths needs a few more, and is skipped when ``path`` is not wanted.
+    Whole documents are loaded without the bookkeeping fields.
+    """
+    if fields is None:
+        return dict(_INTERNAL_PROJECTION)
+    if 'path' in fields:
+        fields = fields | {'assetstoreId', 'imported'}
+    return list(fields)
+
+
+def _project(doc, fields):
+    if fields is None:
+        return doc
+    return {key: value for key, value in doc.items() if key in fields}
+
+
+def getAssetstoreAdapter(assetstoreId):
+    """
+    Get the adapter of an assetstore from a process-wide cache. Entries are
+    dropped by :func:`invalidateAssetstoreAdapter` whenever an assetstore is
+    saved or removed.
+    """
+    try:
+        return _adapters[assetstoreId]
+    except KeyError:
+        adapter = assetstore_utilities.getAssetstoreAdapter(
+            Assetstore().load(assetstoreId))
+        with _adaptersLock:
+            _adapters[assetstoreId] = adapter
+        return adapter
+
+
+def invalidateAssetstoreAdapter(event):
+    with _adaptersLock:
+        _adapters.pop(event.info['_id'], None)
+
+
+def resolvePaths(files):
+    """Set the ``path`` of files stored in an assetstore."""
+    for fileitem in files:
+        if 'imported' in fileitem or fileitem.get('assetstoreId') is None:
+            continue
+        try:
+            adapter = getAssetstoreAdapter(fileitem['assetstoreId'])
+            fileitem['path'] = adapter.fullPath(fileitem)
+        except ValidationException:
+            pass
+    return files
+
+
+def encodeCursor(phase, lastId):
+    """Build the opaque cursor pointing after ``lastId`` in a phase."""
+    return base64.urlsafe_b64encode(json.dumps(
+        {'phase': phase, 'id': str(lastId)}).encode('utf8')).decode('utf8')
+
+
+def decodeCursor(cursor):
+    """
+    :returns: A (phase, lastId) tuple, or None for an empty cursor.
+    :raises RestException: if the cursor is malformed.
+    """
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('utf8')).decode('utf8'))
+        if data['phase'] not in _PHASES:
+            raise ValueError
+        return data['phase'], ObjectId(data['id'])
+    except Exception:
+        raise RestException('Invalid cursor.')
+
+
+def iterFolderEntries(folder, user, after=None, batchSize=BATCH_SIZE,
+                      fields=None):
+    """
+    Lazily walk the content of a folder in ``_id`` order: subfolders first,
+    then items. Items holding a single file are returned as that file, other
+    items as folders.
+
+    :param after: A (phase, lastId) tuple to resume after, as returned by
+        :func:`decodeCursor`.
+    :param batchSize: Number of items whose files are fetched at once.
+    :param fields: The fields to return, as parsed by :func:`parseFields`.
+        They are projected in the queries themselves.
+    :returns: A generator of (phase, key, kind, doc) tuples, where ``kind``
+        is ``'folder'`` or ``'file'`` and (phase, key) locates the entry for
+        :func:`encodeCursor`.
+    """
+    phase, lastId = after or ('folder', None)
+    sort = [('_id', SortDir.ASCENDING)]
+    if phase == 'folder':
+        filters = {'_id': {'$gt': lastId}} if lastId is not None else {}
+        for child in Folder().childFolders(
+                parentType='folder', parent=folder, user=user, sort=sort,
+                filters=filters, fields=queryFields(fields)):
+            yield 'folder', child['_id'], 'folder', _project(child, fields)
+        lastId = None
+
+    filters = {'_id': {'$gt': lastId}} if lastId is not None else {}
+    while True:
+        items = list(Folder().childItems(
+            folder=folder, limit=batchSize, sort=sort, filters=filters,
+            fields=queryFields(fields)))
+        if not items:
+            return
+        childFiles = childFilesByItem(items, queryFields(fields))
+        if fields is None or 'path' in fields:
+            resolvePaths([files[0] for files in childFiles.values()
+                          if len(files) == 1])
+        for item in items:
+            files = childFiles[item['_id']]
+            if len(files) == 1:
+                yield 'item', item['_id'], 'file', _project(files[0], fields)
+            else:
+                yield 'item', item['_id'], 'folder', _project(item, fields)
+        if len(items) < batchSize:
+            return
+        filters = {'_id': {'$gt': items[-1]['_id']}}
+
+
+def iterItemEntries(item, after=None, fields=None):
+    """Lazily walk the files of an item, see :func:`iterFolderEntries`."""
+    query = {'itemId': item['_id']}
+    if after is not None:
+        query['_id'] = {'$gt': after[1]}
+    cursor = File().find(query, sort=[('_id', SortDir.ASCENDING)],
+                         fields=queryFields(fields))
+    while True:
+        files = list(itertools.islice(cursor, BATCH_SIZE))
+        if fields is None or 'path' in fields:
+            resolvePaths(files)
+        for fileitem in files:
+            yield 'item', fileitem['_id'], 'file', _project(fileitem, fields)
+        if len(files) < BATCH_SIZE:
+            return
+
+
+def paginate(entries, limit=0):
+    """
+    Collect entries into a listing. With a ``limit`` only the first page is
+    read and the listing carries the cursor of the next one.
+    """
+    listing = {'folders': [], 'files': []}
+    if limit:
+        entries = itertools.islice(entries, limit)
+    count = 0
+    last = None
+    for phase, key, kind, doc in entries:
+        listing[kind + 's'].append(doc)
+        count += 1
+        last = (phase, key)
+    if limit:
+        listing['nextCursor'] = \
+            encodeCursor(*last) if count == limit else None
+    return listing
+
+
+def acceptsMsgpack():
+    """Whether the client asked for MessagePack."""
+    accept = cherrypy.request.headers.get('Accept', '')
+    return any(mediaType in accept for mediaType in MSGPACK_TYPES)
+
+
+def _packb(obj):
+    return msgpack.packb(obj, default=JsonEncoder().default,
+                         use_bin_type=True)
+
+
+def msgpackResponse(obj):
+    """Send a response encoded with MessagePack instead of JSON."""
+    setResponseHeader('Content-Type', MSGPACK_TYPES[0])
+    body = _packb(obj)
+
+    def stream():
+        yield body
+    return stream
+
+
+def streamListing(entries, limit=0, useMsgpack=False):
+    """
+    Serialize entries as newline delimited JSON, one ``{"folder": ...}`` or
+    ``{"file": ...}`` object per line, followed by a ``{"nextCursor": ...}``
+    line when a ``limit`` is given. With ``useMsgpack``, the same objects
+    are sent as a sequence of MessagePack values instead.
+    """
+    if useMsgpack:
+        setResponseHeader('Content-Type', MSGPACK_TYPES[0])
+        encode = _packb
+    else:
+        setResponseHeader('Content-Type', 'application/x-ndjson')
+
+        def encode(obj):
+            return json.dumps(obj, cls=JsonEncoder) + '\n'
+
+    def stream():
+        count = 0
+        last = None
+        for phase, key, kind, doc in itertools.islice(entries, limit or None):
+            yield encode({kind: doc})
+            count += 1
+            last = (phase, key)
+        if limit:
+            nextCursor = encodeCursor(*last) if count == limit else None
+            yield encode({'nextCursor': nextCursor})
+    return stream
+
+
+def bulkListing(folders, items, user):
+    """
+    List the content of many folders and items at once, with the same
+    rules as the single listings. Child folders, child items and files are
+    each fetched with one query per batch across the whole request.
+
+    :param folders: Folders the user is known to be able to read.
+    :param items: Items the user is known to be able to read.
+    :returns: A (folderListings, itemListings) tuple of dicts by id.
+    """
+    sort = [('_id', SortDir.ASCENDING)]
+    folderListings = {folder['_id']: {'folders': [], 'files': []}
+                      for folder in folders}
+    itemListings = {item['_id']: {'folders': [], 'files': []}
+                    for item in items}
+
+    childItems = []
+    for batch in batches(list(folderListings)):
+        for child in Folder().findWithPermissions({
+            'parentId': {'$in': batch},
+            'parentCollection': 'folder'
+        }, sort=sort, user=user, level=AccessType.READ,
+                fields=queryFields(None)):
+            folderListings[child['parentId']]['folders'].append(child)
+        childItems.extend(Item().find(
+            {'folderId': {'$in': batch}}, sort=sort,
+            fields=queryFields(None)))
+
+    childFiles = childFilesByItem(childItems + list(items),
+                                  queryFields(None))
+    for item in childItems:
+        files = childFiles[item['_id']]
+        if len(files) == 1:
+            folderListings[item['folderId']]['files'].append(files[0])
+        else:
+            folderListings[item['folderId']]['folders'].append(item)
+    for item in items:
+        itemListings[item['_id']]['files'] = sorted(
+            childFiles[item['_id']], key=lambda fileitem: fileitem['_id'])
+
+    resolvePaths(itertools.chain(
+        *(listing['files'] for listing in itertools.chain(
+            folderListings.values(), itemListings.values()))))
+    return folderListings, itemListings
+
+
+def _limitedChildren(find, key, parentIds, remaining):
+    """
+    Fetch the children of ``parentIds``, ordered by parent, stopping once
+    more than ``remaining`` were found.
+
+    :returns: A (children, cutoff) tuple, where cutoff is the first parent
+        whose children may be incomplete, or None if all were fetched.
+        Children of that parent and of the following ones are left out.
+    """
+    children = []
+    sort = [(key, SortDir.ASCENDING), ('_id', SortDir.ASCENDING)]
+    for batch in batches(parentIds):
+        found = list(find({key: {'$in': batch}}, sort=sort,
+                          limit=remaining - len(children) + 1,
+                          fields=queryFields(None)))
+        if len(children) + len(found) > remaining:
+            cutoff = found[-1][key]
+            children += [child for child in found if child[key] < cutoff]
+            return children, cutoff
+        children += found
+    return children, None
+
+
+def subtreeListing(folder, user, maxDepth, maxEntries):
+    """
+    List a whole subtree at once, with one round of batched queries per
+    level. Each listed folder (or multi-file item) carries the listing of
+    its own content under ``listing``, following the same rules as the
+    flat listing.
+
+    Expansion stops after ``maxDepth`` levels, or before a folder whose
+    content would take the total number of entries over ``maxEntries``.
+    Folders that were not expanded have no ``listing``, and the top level
+    listing then has ``truncated`` set. Queries fetch no more than what is
+    left of ``maxEntries``, so large folders beyond it are never read.
+    """
+    root = {'folders': [], 'files': []}
+    # The folders and items to expand at the current level, by id.
+    folders = {folder['_id']: root}
+    items = {}
+    count = 0
+    truncated = False
+
+    def findFolders(query, **kwargs):
+        query['parentCollection'] = 'folder'
+        return Folder().findWithPermissions(
+            query, user=user, level=AccessType.READ, **kwargs)
+
+    for _ in range(maxDepth):
+        if not folders and not items:
+            break
+        folderIds = sorted(folders)
+        itemIds = sorted(items)
+        listings = {parentId: {'folders': [], 'files': []}
+                    for parentId in folderIds + itemIds}
+        remaining = maxEntries - count
+        subfolders = []
+        subitems = []
+
+        # Parents past the cutoff were not fully fetched, nor were items
+        # when folders have one.
+        childFolders, cutoff = _limitedChildren(
+            findFolders, 'parentId', folderIds, remaining)
+        childItems, itemCutoff = _limitedChildren(
+            Item().find, 'folderId',
+            [_ for _ in folderIds if cutoff is None or _ < cutoff],
+            remaining - len(childFolders))
+        if itemCutoff is not None:
+            cutoff = itemCutoff
+            childFolders = [_ for _ in childFolders
+                            if _['parentId'] < cutoff]
+        complete = set(_ for _ in folderIds if cutoff is None or _ < cutoff)
+        if cutoff is None:
+            itemFiles, cutoff = _limitedChildren(
+                File().find, 'itemId', itemIds,
+                remaining - len(childFolders) - len(childItems))
+            complete.update(_ for _ in itemIds if cutoff is None or _ < cutoff)
+        else:
+            itemFiles = []
+
+        for child in childFolders:
+            listings[child['parentId']]['folders'].append(child)
+            subfolders.append(child)
+        childFiles = childFilesByItem(childItems, queryFields(None))
+        for item in childItems:
+            files = childFiles[item['_id']]
+            if len(files) == 1:
+                listings[item['folderId']]['files'].append(files[0])
+            else:
+                listings[item['folderId']]['folders'].append(item)
+                subitems.append(item)
+        for fileitem in itemFiles:
+            listings[fileitem['itemId']]['files'].append(fileitem)
+
+        expanded = set()
+        for parentId in folderIds + itemIds:
+            listing = listings[parentId]
+            size = len(listing['folders']) + len(listing['files'])
+            if parentId not in complete or count + size > maxEntries:
+                truncated = True
+                break
+            count += size
+            resolvePaths(listing['files'])
+            doc = folders[parentId] if parentId in folders \
+                else items[parentId]
+            if doc is root:
+                root.update(listing)
+            else:
+                doc['listing'] = listing
+            expanded.add(parentId)
+        if truncated:
+            break
+
+        folders = {child['_id']: child for child in subfolders
+                   if child['parentId'] in expanded}
+        items = {item['_id']: item for item in subitems
+                 if item['folderId'] in expanded}
+    else:
+        truncated = bool(folders or items)
+
+    root['truncated'] = truncated
+    return root
+
+
+def bumpListingVersion(folderId=None, itemId=None):
+    """
+    Invalidate the listings of an item and of a folder along with all of
+    its ancestors, whose sizes and recursive listings depend on it.
+    """
+    if itemId is not None:
+        Item().update({'_id': itemId}, {'$inc': {VERSION_FIELD: 1}})
+    folderIds = []
+    while folderId is not None:
+        folderIds.append(folderId)
+        folder = Folder().load(folderId, force=True,
+                               fields=['parentId', 'parentCollection'])
+        if not folder or folder.get('parentCollection') != 'folder':
+            break
+        folderId = folder['parentId']
+    if folderIds:
+        Folder().update({'_id': {'$in': folderIds}},
+                        {'$inc': {VERSION_FIELD: 1}})
+
+
+def folderMoved(folder, previous):
+    """Invalidate the previous parent of a folder being moved."""
+    bumpListingVersion(folderId=parentFolderId(previous))
+
+
+def folderChanged(event):
+    bumpListingVersion(folderId=parentFolderId(event.info))
+
+
+def itemMoved(item, previous):
+    """Invalidate the previous folder of an item being moved."""
+    bumpListingVersion(folderId=previous.get('folderId'))
+
+
+def itemChanged(event):
+    bumpListingVersion(folderId=event.info.get('folderId'))
+
+
+def fileChanged(event):
+    itemId = event.info.get('itemId')
+    if itemId is None:
+        return
+    item = Item().load(itemId, force=True, fields=['folderId'])
+    bumpListingVersion(folderId=item and item.get('folderId'), itemId=itemId)
+
+
+def checkETag(doc, user, params):
+    """
+    Tag the listing of a folder or item with its version, and answer with
+    ``304 Not Modified`` when the client already holds that version. The
+    tag also covers the user, the query and the encoding, as all of them
+    shape the listing.
+    """
+    key = json.dumps([str(doc['_id']), doc.get(VERSION_FIELD, 0),
+                      str(user['_id']) if user else None,
+                      sorted((k, str(v)) for k, v in params.items()),
+                      acceptsMsgpack()])
+    setResponseHeader('Vary', 'Accept')
+    checkNotModified('"%s"' % hashlib.sha1(key.encode('utf8')).hexdigest())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+# Upper bounds (in seconds) of the launch stage histogram buckets.
+LAUNCH_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def _formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+
+
+class Histogram(object):
+    """
+    A minimal in-memory, thread-safe histogram rendered in the Prometheus
+    text exposition format.
+    """
+
+    def __init__(self, name, documentation, labelNames=(),
+                 buckets=LAUNCH_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        labels = tuple(str(label) for label in labels)
+        with self._lock:
+            counts, total, count = self._series.get(
+                labels, ([0] * len(self.buckets), 0.0, 0))
+            counts = [n + (value <= bound)
+                      for n, bound in zip(counts, self.buckets)]
+            self._series[labels] = (counts, total + value, count + 1)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s histogram' % self.name
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+        for labels, (counts, total, count) in series:
+            bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+            for n, bound in zip(counts + [count], bounds):
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _formatLabels(self.labelNames, labels, [('le', bound)]),
+                    n))
+            lines.append('%s_sum%s %r' % (
+                self.name, _formatLabels(self.labelNames, labels), total))
+            lines.append('%s_count%s %d' % (
+                self.name, _formatLabels(self.labelNames, labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+launchStageSeconds = Histogram(
+    'ythub_launch_stage_seconds',
+    'Time spent in each stage of a notebook launch.',
+    labelNames=('stage', 'frontend', 'node'))
+
+
+def observeStage(stage, seconds, frontendId, nodeId=None):
+    """Record how long a launch stage took for a frontend on a node."""
+    launchStageSeconds.observe(
+        seconds, stage, frontendId, nodeId if nodeId is not None else '')
+
+
+def render():
+    return launchStageSeconds.render()
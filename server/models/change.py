@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+import time
+
+from pymongo import ReturnDocument
+from pymongo.errors import CollectionInvalid
+
+from girder.constants import SortDir
+from girder.models.folder import Folder
+from girder.models import getDbConnection
+from girder.models.model_base import Model
+
+from ..rootpath import ANCESTORS_FIELD, folderAncestors
+
+# Size of the capped collection holding the feed. Older changes are dropped
+# once it is full, and clients asking for them are told to start over.
+_FEED_BYTES = 64 * 1024 * 1024
+# Changes are numbered before they are written, so the latest numbers may
+# belong to changes other threads or processes are still writing. Readers
+# stop short of the first such gap among the last _PENDING_WINDOW numbers,
+# unless it stayed open for _PENDING_GRACE seconds (its writer failed).
+_PENDING_WINDOW = 1000
+_PENDING_GRACE = 10
+
+
+class Change(Model):
+    """
+    Feed of the folders, items and files created, updated or deleted in the
+    data hierarchy. Each change is tagged with every folder it happened
+    under, so that the changes below a folder are one indexed query away.
+    Changes are numbered by a counter in the ``seq`` field, which serves as
+    the token clients resume from.
+    """
+
+    def initialize(self):
+        self.name = 'folder_change'
+        ancestorsIndex = (
+            ('ancestors', SortDir.ASCENDING),
+            ('seq', SortDir.ASCENDING)
+        )
+        self.ensureIndices([(ancestorsIndex, {}), 'seq'])
+        self._gaps = {}
+        self._gapsLock = threading.Lock()
+
+    def reconnect(self):
+        # The collection must be created capped before indices create it.
+        try:
+            getDbConnection().get_database().create_collection(
+                self.name, capped=True, size=_FEED_BYTES)
+        except CollectionInvalid:
+            pass
+        super(Change, self).reconnect()
+        self._sequence = self.collection.database[self.name + '_seq']
+
+    def validate(self, change):
+        return change
+
+    def folderIds(self, folderId):
+        """The ids of a folder and of all of its ancestor folders."""
+        if folderId is None:
+            return []
+        folder = Folder().load(folderId, force=True, fields=[
+            'parentId', 'parentCollection', ANCESTORS_FIELD])
+        if folder is None:
+            return [folderId]
+        return [folderId] + [
+            ancestor['id'] for ancestor in folderAncestors(folder) or []
+            if ancestor['type'] == 'folder']
+
+    def record(self, action, resourceType, doc, folderId, ancestors=None):
+        """
+        Add a change to the feed.
+
+        :param action: One of ``created``, ``updated`` or ``deleted``.
+        :param folderId: The folder the resource is (or was) in.
+        :param ancestors: The ids of that folder and its ancestors, if
+            already known.
+        """
+        if ancestors is None:
+            ancestors = self.folderIds(folderId)
+        if not ancestors:
+            return None
+        return self.save({
+            'seq': self._sequence.find_one_and_update(
+                {'_id': 'seq'}, {'$inc': {'seq': 1}}, upsert=True,
+                return_document=ReturnDocument.AFTER)['seq'],
+            'action': action,
+            'type': resourceType,
+            'resourceId': doc['_id'],
+            'name': doc.get('name'),
+            'itemId': doc.get('itemId'),
+            'folderId': folderId,
+            'ancestors': ancestors,
+            'time': datetime.datetime.utcnow()
+        }, validate=False)
+
+    def _lastSeq(self):
+        doc = self._sequence.find_one({'_id': 'seq'})
+        return doc['seq'] if doc else 0
+
+    def _firstGap(self, low, high):
+        """The lowest number in (low, high] without a change, if any."""
+        if self.find({'seq': {'$gt': low, '$lte': high}}).count() == \
+                high - low:
+            return None
+        expected = low + 1
+        for change in self.find({'seq': {'$gt': low, '$lte': high}},
+                                sort=[('seq', SortDir.ASCENDING)],
+                                fields=['seq']):
+            if change['seq'] != expected:
+                return expected
+            expected += 1
+        return expected
+
+    def latest(self, since=0):
+        """
+        The token of the most recent change that no earlier change is still
+        being written before.
+        """
+        head = self._lastSeq()
+        low = max(since, head - _PENDING_WINDOW, 0)
+        now = time.time()
+        with self._gapsLock:
+            while low < head:
+                gap = self._firstGap(low, head)
+                if gap is None:
+                    break
+                seen = self._gaps.setdefault(gap, now)
+                if now - seen < _PENDING_GRACE:
+                    head = gap - 1
+                    break
+                low = gap
+            for gap in [gap for gap, seen in self._gaps.items()
+                        if now - seen > 2 * _PENDING_GRACE]:
+                del self._gaps[gap]
+        return head
+
+    def isExpired(self, since):
+        """
+        Whether changes after a token may already have been dropped, or the
+        token is not one the feed handed out.
+        """
+        if since > self._lastSeq():
+            return True
+        oldest = self.findOne({'seq': {'$exists': True}},
+                              sort=[('seq', SortDir.ASCENDING)],
+                              fields=['seq'])
+        return oldest is not None and since < oldest['seq'] - 1
+
+    def changesSince(self, folder, since, until, limit=0):
+        """The changes under a folder after ``since`` up to ``until``."""
+        return self.find({
+            'ancestors': folder['_id'],
+            'seq': {'$gt': since, '$lte': until}
+        }, sort=[('seq', SortDir.ASCENDING)], limit=limit)
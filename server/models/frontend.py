@@ -21,19 +21,22 @@ class Frontend(AccessControlledModel):
                           fields={'_id', 'imageName', 'command', 'memLimit',
                                   'user', 'cpuShares', 'port', 'created',
                                   'updated', 'description', 'public',
-                                  'targetMount', 'urlPath'})
+                                  'targetMount', 'urlPath', 'poolSize'})
 
     def validate(self, frontend):
         if not _DOCKER_IMAGENAME.match(frontend['imageName']):
             raise ValidationException(
                 'Invalid image name: %s.' % frontend['imageName'],
                 field='imageName')
+        if frontend.get('poolSize', 0) < 0:
+            raise ValidationException(
+                'Pool size must not be negative.', field='poolSize')
         return frontend
 
     def createFrontend(self, imageName, memLimit='1024m', command=None,
                        user=None, cpuShares=None, port=None, save=True,
                        description=None, public=None, targetMount=None,
-                       urlPath=''):
+                       urlPath='', poolSize=0):
         now = datetime.datetime.utcnow()
         frontend = {
             'imageName': imageName,
@@ -46,6 +49,7 @@ class Frontend(AccessControlledModel):
             'public': public,
             'targetMount': targetMount,
             'urlPath': urlPath,
+            'poolSize': poolSize,
             'created': now,
             'updated': now
         }
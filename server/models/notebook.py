@@ -1,46 +1,106 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from urllib.parse import urlsplit
-from urllib.request import urlopen
-from urllib.error import HTTPError, URLError
-import ssl
+from urllib.parse import urlsplit, urlunsplit
 import time
+import traceback
 
+import requests
+
+from bson import ObjectId
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 from girder import logger
 from ..constants import API_VERSION, NotebookStatus, PluginSettings
+from ..metrics import observeStage
+from ..readiness import prober
+from ..utils import parseMemory
+from .placement import Placement
+from .volume import Volume
 from girder.constants import AccessType, SortDir
+from girder.models import getDbConnection
 from girder.models.model_base import \
     AccessControlledModel, ValidationException
 from girder.models.notification import \
     ProgressState, Notification
 from girder.models.setting import Setting
+from girder.models.token import Token
+from girder.models.user import User
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
 from girder.plugins.worker import getCeleryApp, getWorkerApiUrl
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# Launches are driven from this pool rather than from the CherryPy request
+# thread, so its size caps how many notebooks can be starting at once.
+_LAUNCH_WORKERS = 16
+_launchExecutor = ThreadPoolExecutor(max_workers=_LAUNCH_WORKERS)
+_CULLING_CONCURRENCY = 8
+_TEARDOWN_CONCURRENCY = 16
+# Bulk deletions run as local jobs on this pool.
+_deletionExecutor = ThreadPoolExecutor(max_workers=2)
+# Seconds a single shutdown or volume removal task may take.
+_TEARDOWN_TIMEOUT = 60
+# Seconds a notebook server may take to report its activity.
+_ACTIVITY_TIMEOUT = 5
+# Seconds a launch may take from the creation of the notebook until its
+# server answers. Worker tasks wait at most what is left of it, and records
+# still STARTING past it are left over from a crashed or hung launch.
+_LAUNCH_TIMEOUT = 600
+# Seconds the readiness probe may take, within the launch deadline.
+_PROBE_TIMEOUT = 30
+# A user gets a single live notebook per folder and frontend. Failed ones
+# are left out, so that earlier duplicates can be kept around as failed
+# until culling tears them down.
+_LAUNCH_KEY = (
+    ('folderId', SortDir.ASCENDING),
+    ('creatorId', SortDir.ASCENDING),
+    ('frontendId', SortDir.ASCENDING)
+)
+_LAUNCH_KEY_OPTIONS = {
+    'unique': True,
+    'partialFilterExpression': {'status': {'$lt': NotebookStatus.ERROR}}
+}
+
+
+class _LaunchCancelled(Exception):
+    """The notebook was removed while it was starting."""
 
 
-def _wait_for_server(url, timeout=30, wait_time=0.5):
-    """Wait for a server to show up within a newly launched instance."""
-    tic = time.time()
-    # Fudge factor of IPython notebook bootup.
-    time.sleep(0.5)
+def _live(key):
+    """Match the notebook covered by the launch key index for ``key``."""
+    return dict(key, status={'$lt': NotebookStatus.ERROR})
 
-    while time.time() - tic < timeout:
+
+def _memLimit(frontend):
+    """Memory (in bytes) reserved by a notebook running a frontend."""
+    try:
+        return parseMemory(frontend.get('memLimit') or 0)
+    except ValueError:
+        return 0
+
+
+def _parseTimestamp(value):
+    """Parse an ISO 8601 UTC timestamp, as reported by Jupyter."""
+    value = value.replace('Z', '').replace('+00:00', '')
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
         try:
-            urlopen(url, timeout=1)
-        except HTTPError as err:
-            logger.info(
-                'Booting server at [%s], getting HTTP status [%s]',
-                url, err.code)
-            time.sleep(wait_time)
-        except URLError as err:
-            logger.info(
-                'Booting server at [%s], getting URLError due to [%s]',
-                url, err.reason)
-        except (ssl.SSLError, ssl.CertificateError):
-            time.sleep(wait_time)
-        else:
-            break
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp: %s' % value)
+
+
+def _service_url(serviceInfo):
+    """Build the public url of a notebook service from its worker info."""
+    tmpnb_url = urlsplit(
+        Setting().get(PluginSettings.TMPNB_URL)
+    )
+    domain = '{}.{}'.format(serviceInfo['serviceId'], tmpnb_url.netloc)
+    return '{}://{}/{}'.format(
+        tmpnb_url.scheme, domain, serviceInfo.get('urlPath', ''))
 
 
 class Notebook(AccessControlledModel):
@@ -51,15 +111,60 @@ class Notebook(AccessControlledModel):
             ('creatorId', SortDir.ASCENDING),
             ('created', SortDir.DESCENDING)
         )
+        folderSearchIndex = (
+            ('folderId', SortDir.ASCENDING),
+            ('created', SortDir.DESCENDING)
+        )
 
-        self.ensureIndices([(compoundSearchIndex, {})])
+        self.ensureIndices([(compoundSearchIndex, {}),
+                            (folderSearchIndex, {}),
+                            (_LAUNCH_KEY, _LAUNCH_KEY_OPTIONS),
+                            'lastActivity', 'status'])
         self.exposeFields(level=AccessType.WRITE,
                           fields={'created', 'folderId', '_id',
                                   'creatorId', 'status', 'frontendId',
-                                  'serviceInfo', 'url'})
+                                  'serviceInfo', 'url', 'lastActivity'})
         self.exposeFields(level=AccessType.SITE_ADMIN,
                           fields={'args', 'kwargs'})
 
+    def reconnect(self):
+        # Duplicates must be resolved before the unique index is built.
+        self.resolveDuplicates(getDbConnection().get_database()[self.name])
+        super(Notebook, self).reconnect()
+
+    @staticmethod
+    def resolveDuplicates(collection):
+        """
+        Move to ERROR all but one of the live notebooks sharing a folder,
+        creator and frontend, which releases before launches were coalesced
+        could create, keeping a running one over a starting one and a recent
+        one over an older one. Culling then tears the others down. Also drop
+        the launch key index if it was built without its partial filter.
+
+        :returns: The number of notebooks moved to ERROR.
+        """
+        groups = collection.aggregate([
+            {'$match': {'status': {'$lt': NotebookStatus.ERROR}}},
+            {'$sort': {'status': SortDir.DESCENDING,
+                       'created': SortDir.DESCENDING}},
+            {'$group': {
+                '_id': {field: '$' + field for field, _ in _LAUNCH_KEY},
+                'ids': {'$push': '$_id'}
+            }},
+            {'$match': {'ids.1': {'$exists': True}}}
+        ], allowDiskUse=True)
+        extra = [_id for group in groups for _id in group['ids'][1:]]
+        if extra:
+            logger.warning('Marking %d duplicate notebook(s) as failed',
+                           len(extra))
+            collection.update_many({'_id': {'$in': extra}}, {'$set': {
+                'status': NotebookStatus.ERROR}})
+        for name, info in collection.index_information().items():
+            if info['key'] == list(_LAUNCH_KEY) and \
+                    'partialFilterExpression' not in info:
+                collection.drop_index(name)
+        return len(extra)
+
     def validate(self, notebook):
         if not NotebookStatus.isValid(notebook['status']):
             raise ValidationException(
@@ -70,75 +175,331 @@ class Notebook(AccessControlledModel):
     def list(self, user=None, folder=None, limit=0, offset=0,
              sort=None, currentUser=None):
         """
-        List a page of jobs for a given user.
+        List a page of notebooks for a given user.
 
-        :param user: The user who owns the job.
+        Access is checked by the database query itself, so the cost of a page
+        does not depend on how many notebooks the current user cannot see.
+
+        :param user: The user who owns the notebooks.
         :type user: dict or None
+        :param folder: The folder mounted by the notebooks.
+        :type folder: dict or None
         :param limit: The page limit.
         :param offset: The page offset
         :param sort: The sort field.
         :param currentUser: User for access filtering.
+        :returns: A cursor; its ``count()`` is the total number of matches.
         """
         cursor_def = {}
         if user is not None:
             cursor_def['creatorId'] = user['_id']
         if folder is not None:
             cursor_def['folderId'] = folder['_id']
-        cursor = self.find(cursor_def, sort=sort)
-        for r in self.filterResultsByPermission(cursor=cursor,
-                                                user=currentUser,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
-            yield r
+        return self.findWithPermissions(
+            cursor_def, sort=sort, user=currentUser, level=AccessType.READ,
+            limit=limit, offset=offset)
 
     def deleteNotebook(self, notebook, token):
-        payload = {
-            'serviceInfo': notebook.get('serviceInfo', {}),
-            'girder_token': str(token['_id']),
-            'apiUrl': getWorkerApiUrl()
-        }
+        return self.deleteNotebooks([notebook], token)[0]
+
+    def deleteNotebooks(self, notebooks, token,
+                        concurrency=_TEARDOWN_CONCURRENCY,
+                        timeout=_TEARDOWN_TIMEOUT, retain=True):
+        """
+        Tear down a set of notebooks and remove their records, see
+        :meth:`teardown`.
+        """
+        results = self.teardown(notebooks, token, concurrency, timeout,
+                                retain)
+        for notebook in notebooks:
+            self.remove(notebook)
+        return results
+
+    def scheduleDeletion(self, notebooks, user, retain=True):
+        """
+        Queue a job running :meth:`deleteNotebooks` on behalf of ``user``.
+
+        :returns: The job, whose log holds the outcome for each notebook.
+        """
+        jobModel = Job()
+        job = jobModel.createLocalJob(
+            title='Delete %d notebooks' % len(notebooks),
+            type='ythub.notebook_deletion', user=user,
+            module='girder.plugins.ythub.models.notebook',
+            function='runDeletion',
+            kwargs={'ids': [str(notebook['_id']) for notebook in notebooks],
+                    'retain': retain})
+        _deletionExecutor.submit(jobModel.scheduleJob, job)
+        return job
+
+    def teardown(self, notebooks, token, concurrency=_TEARDOWN_CONCURRENCY,
+                 timeout=_TEARDOWN_TIMEOUT, retain=True):
+        """
+        Shut down the containers of a set of notebooks and remove or retain
+        their volumes, leaving their records alone.
+
+        Container shutdowns are sent to the manager queue at most
+        ``concurrency`` at a time, then volume removals are sent to the queue
+        of the node holding each volume. Every task gets ``timeout`` seconds
+        from the moment it was sent; a failed or late task does not prevent
+        the record from being removed. Notebooks that never got a container
+        only have their volume handled. If ``retain`` is set and volume
+        retention is enabled, volumes of cleanly shut down notebooks are kept
+        for reuse instead of being removed.
 
+        :returns: A list of per notebook results with the outcome of the
+            ``shutdown`` and ``volume`` stages.
+        """
+        celeryApp = getCeleryApp()
+        apiUrl = getWorkerApiUrl()
+        results = []
+        for notebook in notebooks:
+            results.append({
+                '_id': notebook['_id'],
+                'notebook': notebook,
+                'payload': {
+                    'serviceInfo': notebook.get('serviceInfo', {}),
+                    'girder_token': str(token['_id']),
+                    'apiUrl': apiUrl
+                }
+            })
+
+        running = []
+        for result in results:
+            if 'serviceId' in result['payload']['serviceInfo']:
+                running.append(result)
+            else:
+                result['shutdown'] = 'skipped'
+        for i in range(0, len(running), concurrency):
+            window = running[i:i + concurrency]
+            tasks = [self._sendTask(
+                celeryApp, 'gwvolman.tasks.shutdown_container',
+                result['payload'], 'manager') for result in window]
+            for result, task in zip(window, tasks):
+                result['shutdown'] = self._waitForTask(task, timeout)
+
+        tasks = []
+        for result in sorted(results, key=lambda r: str(
+                r['payload']['serviceInfo'].get('nodeId'))):
+            nodeId = result['payload']['serviceInfo'].get('nodeId')
+            if nodeId is None:
+                result['volume'] = 'skipped'
+                continue
+            if retain and result['shutdown'] in ('ok', 'skipped') and \
+                    Volume().retain(result['notebook']):
+                result['volume'] = 'retained'
+                continue
+            tasks.append((result, self._sendTask(
+                celeryApp, 'gwvolman.tasks.remove_volume', result['payload'],
+                nodeId)))
+        for result, task in tasks:
+            result['volume'] = self._waitForTask(task, timeout)
+
+        for result in results:
+            del result['payload']
+            del result['notebook']
+        return results
+
+    @staticmethod
+    def _sendTask(celeryApp, name, payload, queue):
         try:
-            instanceTask = getCeleryApp().send_task(
-                'gwvolman.tasks.shutdown_container', args=[payload],
-                queue='manager',
-            )
-            instanceTask.get()
-        except Exception:
-            pass
+            task = celeryApp.send_task(name, args=[payload], queue=queue)
+        except Exception as exc:
+            return exc
+        return task, time.time()
 
+    @staticmethod
+    def _waitForTask(task, timeout):
+        if isinstance(task, Exception):
+            return 'error: %s' % task
+        task, sent = task
         try:
-            volumeTask = getCeleryApp().send_task(
-                'gwvolman.tasks.remove_volume', args=[payload],
-                queue=notebook['serviceInfo']['nodeId']
-            )
-            volumeTask.get()
-        except Exception:
-            pass
+            task.get(timeout=max(sent + timeout - time.time(), 0.001))
+        except CeleryTimeoutError:
+            return 'timeout'
+        except Exception as exc:
+            return 'error: %s' % exc
+        return 'ok'
 
-        self.remove(notebook)
+    def cullNotebooks(self, period, concurrency=_CULLING_CONCURRENCY):
+        """
+        Remove notebooks that have been idle for longer than a given period.
+
+        A notebook is idle when neither its recorded ``lastActivity`` (or its
+        creation time, for records that have none) nor the activity its
+        server reports (see :meth:`serverActivity`) is within the period.
+        Idle notebooks are torn down through :meth:`deleteNotebook` in
+        batches of at most ``concurrency`` notebooks at a time.
+
+        :param period: Maximum inactivity period in hours.
+        :type period: float
+        :param concurrency: Number of notebooks removed in parallel.
+        :returns: The number of reclaimed notebooks.
+        """
+        self.expireLaunches()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=period)
+        skipped = []
+        reclaimed = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                batch = list(self.find({
+                    '$or': [
+                        {'lastActivity': {'$lt': cutoff}},
+                        {'lastActivity': None, 'created': {'$lt': cutoff}}
+                    ],
+                    'status': {'$ne': NotebookStatus.STARTING},
+                    '_id': {'$nin': skipped}
+                }, limit=concurrency, sort=[('lastActivity', SortDir.ASCENDING)]))
+                if not batch:
+                    break
+                for notebook, culled in zip(batch, executor.map(
+                        lambda nb: self._cullNotebook(nb, cutoff), batch)):
+                    if culled:
+                        reclaimed += 1
+                    else:
+                        skipped.append(notebook['_id'])
+        return reclaimed
+
+    def serverActivity(self, notebook):
+        """
+        Ask the server of a running notebook when it was last used, and
+        record it as the notebook's ``lastActivity`` if more recent. Only
+        servers with the Jupyter ``/api/status`` endpoint report it.
+
+        :returns: The reported time of the last activity, or None.
+        """
+        if notebook.get('status') != NotebookStatus.RUNNING or \
+                not notebook.get('url'):
+            return None
+        url = urlsplit(notebook['url'])
+        statusUrl = urlunsplit(
+            (url.scheme, url.netloc, '/api/status', url.query, ''))
+        try:
+            resp = requests.get(statusUrl, timeout=_ACTIVITY_TIMEOUT)
+            resp.raise_for_status()
+            lastActivity = _parseTimestamp(resp.json()['last_activity'])
+        except Exception as exc:
+            logger.info('No activity reported by notebook %s: %s',
+                        notebook['_id'], exc)
+            return None
+        self.update({
+            '_id': notebook['_id'],
+            '$or': [{'lastActivity': {'$lt': lastActivity}},
+                    {'lastActivity': None}]
+        }, {'$set': {'lastActivity': lastActivity}})
+        return lastActivity
+
+    def expireLaunches(self, timeout=_LAUNCH_TIMEOUT):
+        """
+        Move notebooks that have been STARTING for longer than a launch may
+        take to the ERROR state, so that they get culled like any failed
+        launch. Such records are left behind by a restart during a launch.
+
+        :returns: The number of expired launches.
+        """
+        cutoff = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=timeout)
+        return self.update({
+            'status': NotebookStatus.STARTING,
+            'created': {'$lt': cutoff}
+        }, {'$set': {'status': NotebookStatus.ERROR}}).modified_count
+
+    def _cullNotebook(self, notebook, cutoff):
+        lastActivity = self.serverActivity(notebook)
+        if lastActivity is not None and lastActivity >= cutoff:
+            return False
+        try:
+            user = User().load(notebook['creatorId'], force=True)
+            token = Token().createToken(user=user, days=1)
+            self.deleteNotebook(notebook, token)
+            Token().remove(token)
+        except Exception:
+            logger.exception('Failed to cull notebook %s', notebook['_id'])
+            return False
+        return True
 
     def createNotebook(self, folder, user, token, frontend, scripts=None,
                        when=None, save=True):
-        existing = self.findOne({
+        """
+        Create a notebook record and schedule its launch.
+
+        The returned document is in the STARTING state; the volume, container
+        and readiness stages are run by :meth:`launchNotebook` in the
+        background and move the record forward as they complete.
+        """
+        key = {
             'folderId': folder['_id'],
             'creatorId': user['_id'],
             'frontendId': frontend['_id']
-        })
-        if existing:
-            return existing
+        }
+        if not save:
+            existing = self.findOne(_live(key))
+            if existing:
+                return existing
 
         now = datetime.datetime.utcnow()
-        notebook = {
-            'folderId': folder['_id'],
-            'creatorId': user['_id'],
-            'frontendId': frontend['_id'],
+        notebook = dict(key, **{
             'status': NotebookStatus.STARTING,
-            'created': now
-        }
-        if save:
-            notebook = self.save(notebook)
+            'memLimit': _memLimit(frontend),
+            'created': now,
+            'lastActivity': now
+        })
+        self.setPublic(notebook, public=False)
+        self.setUserAccess(notebook, user=user, level=AccessType.ADMIN)
+        if not save:
+            return notebook
+
+        notebook, created = self._claimNotebook(key, notebook)
+        if created:
+            _launchExecutor.submit(
+                self.launchNotebook, notebook, folder, user, token, frontend,
+                scripts)
+        return notebook
+
+    def _claimNotebook(self, key, notebook):
+        """
+        Atomically insert a notebook unless a live one (i.e. not failed)
+        already exists for the same (folder, creator, frontend). Concurrent
+        requests for the same triple all get the single record created by
+        whichever of them won.
+
+        :returns: A (notebook, created) tuple.
+        """
+        notebook = self.validate(notebook)
+        notebook['_id'] = ObjectId()
+        fields = {k: v for k, v in notebook.items() if k not in key}
+        try:
+            doc = self.collection.find_one_and_update(
+                _live(key), {'$setOnInsert': fields}, upsert=True,
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Lost the race against a concurrent upsert of the same triple.
+            doc = self.findOne(_live(key))
+        return doc, doc['_id'] == notebook['_id']
 
+    def updateNotebook(self, notebook, user, **fields):
+        """
+        Set fields on a notebook without overwriting concurrent changes and
+        notify its owner about the new state.
+        """
+        notebook.update(fields)
+        self.update({'_id': notebook['_id']}, {'$set': fields})
+        Notification().createNotification(
+            type='notebook_status', user=user, data={
+                '_id': notebook['_id'],
+                'status': notebook['status'],
+                'created': notebook['created'],
+                'url': notebook.get('url')
+            },
+            expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30))
+        return notebook
+
+    def launchNotebook(self, notebook, folder, user, token, frontend,
+                       scripts=None):
+        """
+        Run the launch pipeline for a STARTING notebook. Any failure moves the
+        record to the ERROR state.
+        """
         total = 3.0
         notification = Notification().initProgress(
             user, 'Starting Notebook', total, state=ProgressState.QUEUED,
@@ -146,6 +507,98 @@ class Notebook(AccessControlledModel):
             estimateTime=False, resourceName=self.name,
             resource=notebook)
 
+        launched = {}
+        try:
+            self._launch(notebook, folder, user, token, frontend, scripts,
+                         notification, total, launched)
+        except _LaunchCancelled:
+            self._cancelLaunch(notebook, launched, token, notification, total)
+        except Exception as exc:
+            logger.exception('Failed to launch notebook %s', notebook['_id'])
+            self.updateNotebook(notebook, user, status=NotebookStatus.ERROR)
+            Notification().updateProgress(
+                notification, total=total, state=ProgressState.ERROR,
+                message='Failed to start notebook: %s' % exc,
+                expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+            )
+
+    def _cancelLaunch(self, notebook, launched, token, notification, total):
+        """Tear down what a launch started for a notebook removed since."""
+        logger.info('Notebook %s was removed while starting, tearing it down',
+                    notebook['_id'])
+        if launched:
+            self.teardown([dict(notebook, serviceInfo=launched)], token,
+                          retain=False)
+        Notification().updateProgress(
+            notification, total=total, state=ProgressState.ERROR,
+            message='Notebook was removed while starting',
+            expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+        )
+
+    def _checkLaunch(self, notebook):
+        """Stop a launch if its notebook has been removed meanwhile."""
+        if self.findOne({'_id': notebook['_id']}, fields=['_id']) is None:
+            raise _LaunchCancelled()
+
+    def _remaining(self, notebook):
+        """Seconds left before the launch deadline of a notebook."""
+        remaining = _LAUNCH_TIMEOUT - self._elapsed(notebook)
+        if remaining <= 0:
+            raise CeleryTimeoutError(
+                'Notebook did not start within %d seconds' % _LAUNCH_TIMEOUT)
+        return remaining
+
+    @staticmethod
+    def _elapsed(notebook):
+        return (datetime.datetime.utcnow() - notebook['created']).total_seconds()
+
+    def _observeTotal(self, notebook):
+        observeStage('total', self._elapsed(notebook), notebook['frontendId'],
+                     notebook['serviceInfo'].get('nodeId'))
+
+    def _launchFromPool(self, notebook, entry, payload, user, notification,
+                        total, launched):
+        """
+        Hand a booted container from the warm pool over to the notebook: only
+        the user's folder and token need to be attached to it.
+        """
+        Notification().updateProgress(
+            notification, total=total, current=2.0,
+            state=ProgressState.ACTIVE, message='Attaching Filesystem',
+            expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+        )
+        payload.update(entry['serviceInfo'])
+        attachTask = getCeleryApp().send_task(
+            'gwvolman.tasks.update_container', args=[payload], kwargs={},
+            queue='manager'
+        )
+        tic = time.time()
+        serviceInfo = dict(entry['serviceInfo'])
+        launched.update(serviceInfo)
+        serviceInfo.update(
+            attachTask.get(timeout=self._remaining(notebook)) or {})
+        launched.update(serviceInfo)
+        observeStage('attach', time.time() - tic, notebook['frontendId'],
+                     serviceInfo.get('nodeId'))
+        self._checkLaunch(notebook)
+
+        self.updateNotebook(
+            notebook, user, serviceInfo=serviceInfo,
+            url=_service_url(serviceInfo), status=NotebookStatus.RUNNING)
+        self._observeTotal(notebook)
+
+        Notification().updateProgress(
+            notification, total=total, current=3.0,
+            state=ProgressState.SUCCESS, message='Redirecting to notebook',
+            expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        )
+
+    def _launch(self, notebook, folder, user, token, frontend, scripts,
+                notification, total, launched):
+        """
+        Run the launch stages, recording in ``launched`` the service info of
+        what has been started so far.
+        """
         payload = {
             'girder_token': token['_id'],
             'folder': {k: str(v) for k, v in folder.items()},
@@ -153,18 +606,57 @@ class Notebook(AccessControlledModel):
             'scripts': scripts,
             'api_version': API_VERSION
         }
+        observeStage('queued', self._elapsed(notebook), frontend['_id'])
+
+        if frontend.get('poolSize'):
+            from .pool import Pool, _poolExecutor
+            entry = Pool().claim(frontend)
+            if entry is not None:
+                _poolExecutor.submit(Pool().fill, frontend)
+                try:
+                    return self._launchFromPool(
+                        notebook, entry, payload, user, notification, total,
+                        launched)
+                except _LaunchCancelled:
+                    raise
+                except Exception:
+                    logger.exception(
+                        'Failed to attach pooled container %s, launching a '
+                        'new one instead', entry['serviceInfo']['serviceId'])
+                    Pool().shutdownEntry(entry)
+                    launched.clear()
 
-        # do the job
         Notification().updateProgress(
             notification, total=total, current=1.0,
             state=ProgressState.ACTIVE, message='Creating and mounting Filesystem',
             expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
         )
-        volumeTask = getCeleryApp().send_task(
-            'gwvolman.tasks.create_volume', args=[payload], kwargs={},
-        )
-        volumeInfo = volumeTask.get()
+        volumeInfo = Volume().claim(user, folder)
+        if volumeInfo is None:
+            placement = Placement().place(notebook, frontend)
+            kwargs = {}
+            if placement['nodeId'] is not None:
+                kwargs['queue'] = placement['nodeId']
+            volumeTask = getCeleryApp().send_task(
+                'gwvolman.tasks.create_volume', args=[payload], kwargs={},
+                **kwargs
+            )
+            tic = time.time()
+            volumeInfo = volumeTask.get(timeout=self._remaining(notebook))
+            observeStage('create_volume', time.time() - tic, frontend['_id'],
+                         volumeInfo.get('nodeId'))
+            Placement().recordVolumeNode(placement, volumeInfo.get('nodeId'))
+        else:
+            Placement().record(
+                notebook, frontend, volumeInfo.get('nodeId'), 'volume')
+        nodeId = volumeInfo.get('nodeId')
+        launched.update(volumeInfo)
+        self._checkLaunch(notebook)
         payload.update(volumeInfo)
+        # Record the volume right away, so that a notebook removed while
+        # still starting knows which node to clean up.
+        self.updateNotebook(notebook, user, serviceInfo=volumeInfo,
+                            volumeInfo=volumeInfo)
 
         Notification().updateProgress(
             notification, total=total, current=2.0,
@@ -175,28 +667,42 @@ class Notebook(AccessControlledModel):
             'gwvolman.tasks.launch_container', args=[payload], kwargs={},
             queue='manager'
         )
-        serviceInfo = serviceTask.get()
+        tic = time.time()
+        serviceInfo = serviceTask.get(timeout=self._remaining(notebook))
         serviceInfo.update(volumeInfo)
+        launched.update(serviceInfo)
+        observeStage('launch_container', time.time() - tic, frontend['_id'],
+                     nodeId)
+        self._checkLaunch(notebook)
 
-        tmpnb_url = urlsplit(
-            Setting().get(PluginSettings.TMPNB_URL)
-        )
-        domain = '{}.{}'.format(serviceInfo['serviceId'], tmpnb_url.netloc)
-        url = '{}://{}/{}'.format(
-            tmpnb_url.scheme, domain, serviceInfo.get('urlPath', ''))
+        url = _service_url(serviceInfo)
+        self.updateNotebook(notebook, user, serviceInfo=serviceInfo, url=url)
 
         Notification().updateProgress(
             notification, total=total, current=2.5,
             state=ProgressState.ACTIVE, message='Waiting for Notebook to start',
             expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
         )
-        _wait_for_server(url)
+        prober.probe(url, lambda ready, timings: _launchExecutor.submit(
+            self._notebookReady, notebook, user, token, notification, total,
+            ready, timings), timeout=min(_PROBE_TIMEOUT,
+                                         self._remaining(notebook)))
 
-        notebook.update({
-            'status': NotebookStatus.RUNNING,   # be optimistic for now
-            'serviceInfo': serviceInfo,
-            'url': url
-        })
+    def _notebookReady(self, notebook, user, token, notification, total,
+                       ready, timings):
+        if self.findOne({'_id': notebook['_id']}, fields=['_id']) is None:
+            self._cancelLaunch(notebook, notebook['serviceInfo'], token,
+                               notification, total)
+            return
+        if not ready:
+            logger.warning('Notebook %s did not answer at %s in time',
+                           notebook['_id'], notebook['url'])
+        nodeId = notebook['serviceInfo'].get('nodeId')
+        for stage, seconds in timings.items():
+            observeStage(stage, seconds, notebook['frontendId'], nodeId)
+        # be optimistic for now
+        self.updateNotebook(notebook, user, status=NotebookStatus.RUNNING)
+        self._observeTotal(notebook)
 
         Notification().updateProgress(
             notification, total=total, current=3.0,
@@ -204,9 +710,29 @@ class Notebook(AccessControlledModel):
             expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
         )
 
-        self.setPublic(notebook, public=False)
-        self.setUserAccess(notebook, user=user, level=AccessType.ADMIN)
-        if save:
-            notebook = self.save(notebook)
 
-        return notebook
+def runDeletion(job):
+    jobModel = Job()
+    job = jobModel.updateJob(job, status=JobStatus.RUNNING)
+    token = None
+    try:
+        model = Notebook()
+        notebooks = list(model.find({'_id': {
+            '$in': [ObjectId(_) for _ in job['kwargs']['ids']]}}))
+        user = User().load(job['userId'], force=True)
+        token = Token().createToken(user=user, days=1)
+        results = model.deleteNotebooks(
+            notebooks, token, retain=job['kwargs']['retain'])
+        jobModel.updateJob(
+            job, status=JobStatus.SUCCESS,
+            progressMessage='Deleted %d notebooks' % len(results),
+            log=''.join('%s: shutdown %s, volume %s\n' % (
+                result['_id'], result['shutdown'], result['volume'])
+                for result in results))
+    except Exception:
+        logger.exception('Deletion job %s failed', job['_id'])
+        jobModel.updateJob(job, status=JobStatus.ERROR,
+                           log=traceback.format_exc())
+    finally:
+        if token is not None:
+            Token().remove(token)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from girder.constants import SortDir
+from girder.models.model_base import Model
+from girder.models.setting import Setting
+from girder.utility.model_importer import ModelImporter
+
+from ..constants import NotebookStatus, PluginSettings
+from ..utils import parseMemory
+
+# How long a node is remembered (and assumed to still hold the images it
+# ran) after the last notebook was placed on it.
+_NODE_MEMORY_DAYS = 7
+
+
+class Placement(Model):
+    """
+    Choose the node a notebook's volume (and therefore its container) is
+    created on, and keep a record of every decision.
+
+    Known nodes are those that ran a notebook recently. Each is scored by the
+    memory reserved by its active notebooks; nodes that have not run the
+    frontend recently are charged the frontend's memory limit on top, as they
+    will have to pull its image. Nodes that cannot fit the notebook within
+    ``ythub.node_memory_capacity`` are skipped. When no known node fits, the
+    volume task goes to the default queue and the worker pool decides, which
+    is also how new nodes become known. Placement is only done when the
+    capacity is configured; without it, known nodes would never fill up and
+    new ones would never be used.
+    """
+
+    def initialize(self):
+        self.name = 'notebook_placement'
+        nodeIndex = (
+            ('nodeId', SortDir.ASCENDING),
+            ('created', SortDir.DESCENDING)
+        )
+        self.ensureIndices([
+            (nodeIndex, {}),
+            ('created', {'expireAfterSeconds':
+                         _NODE_MEMORY_DAYS * 24 * 60 * 60}),
+            'notebookId'
+        ])
+
+    def validate(self, placement):
+        return placement
+
+    def capacity(self):
+        capacity = Setting().get(PluginSettings.NODE_MEMORY_CAPACITY)
+        return parseMemory(capacity) if capacity else None
+
+    def nodeLoads(self):
+        """
+        Per node view of active notebooks: how many run there, how much
+        memory they reserve and which frontends the node ran recently.
+        """
+        nodes = {}
+        since = datetime.datetime.utcnow() - \
+            datetime.timedelta(days=_NODE_MEMORY_DAYS)
+        for record in self.collection.aggregate([
+            {'$project': {'frontendId': 1, 'created': 1, 'nodeId': {
+                '$ifNull': ['$volumeNodeId', '$nodeId']}}},
+            {'$match': {'created': {'$gte': since},
+                        'nodeId': {'$ne': None}}},
+            {'$group': {'_id': '$nodeId',
+                        'frontends': {'$addToSet': '$frontendId'}}}
+        ]):
+            nodes[record['_id']] = {
+                'nodeId': record['_id'], 'running': 0, 'reserved': 0,
+                'frontends': set(record['frontends'])}
+
+        notebookModel = ModelImporter.model('notebook', 'ythub')
+        for record in notebookModel.collection.aggregate([
+            {'$match': {'status': {'$ne': NotebookStatus.ERROR},
+                        'serviceInfo.nodeId': {'$exists': True}}},
+            {'$group': {'_id': '$serviceInfo.nodeId',
+                        'running': {'$sum': 1},
+                        'reserved': {'$sum': '$memLimit'},
+                        'frontends': {'$addToSet': '$frontendId'}}}
+        ]):
+            node = nodes.setdefault(record['_id'], {
+                'nodeId': record['_id'], 'frontends': set()})
+            node['running'] = record['running']
+            node['reserved'] = record['reserved']
+            node['frontends'].update(record['frontends'])
+        return list(nodes.values())
+
+    def place(self, notebook, frontend):
+        """
+        Pick a node for a notebook and record the decision.
+
+        :returns: The placement record; its ``nodeId`` is None when the
+            choice is left to the worker pool.
+        """
+        memLimit = notebook.get('memLimit', 0)
+        capacity = self.capacity()
+        if capacity is None:
+            return self.record(notebook, frontend, None, 'default')
+
+        candidates = []
+        for node in self.nodeLoads():
+            hasImage = frontend['_id'] in node['frontends']
+            if node['reserved'] + memLimit > capacity:
+                continue
+            candidates.append({
+                'nodeId': node['nodeId'],
+                'running': node['running'],
+                'reserved': node['reserved'],
+                'hasImage': hasImage,
+                'score': node['reserved'] + (0 if hasImage else memLimit)
+            })
+        candidates.sort(key=lambda c: (c['score'], c['running']))
+
+        if candidates:
+            return self.record(notebook, frontend, candidates[0]['nodeId'],
+                               'load', candidates)
+        return self.record(notebook, frontend, None, 'default')
+
+    def record(self, notebook, frontend, nodeId, reason, candidates=()):
+        return self.save({
+            'notebookId': notebook['_id'],
+            'frontendId': frontend['_id'],
+            'nodeId': nodeId,
+            'reason': reason,
+            'candidates': list(candidates),
+            'created': datetime.datetime.utcnow()
+        })
+
+    def recordVolumeNode(self, placement, nodeId):
+        """Store the node the volume actually ended up on."""
+        self.update({'_id': placement['_id']},
+                    {'$set': {'volumeNodeId': nodeId}})
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import threading
+import time
+
+from girder import logger
+from girder.constants import SortDir
+from girder.models.model_base import Model, ValidationException
+from girder.models.setting import Setting
+from girder.plugins.worker import getCeleryApp, getWorkerApiUrl
+
+from ..constants import API_VERSION, NotebookStatus, PluginSettings
+from ..readiness import prober
+from ..utils import parseMemory
+from .notebook import _LAUNCH_TIMEOUT, _memLimit, _service_url
+from .placement import Placement
+
+# Pooling relies on gwvolman tasks beyond those of a regular launch:
+# launch_container must accept a 'pooled' payload without a volume, and
+# update_container must attach a volume to a running container. Workers are
+# asked for the latter at most every _SUPPORT_TTL seconds; without it
+# frontends are not pooled and every launch runs the full pipeline.
+_POOL_TASKS = ('gwvolman.tasks.update_container',)
+_SUPPORT_TTL = 300
+_support = {'checked': None, 'value': False}
+_supportLock = threading.Lock()
+# Pooled launches block on their worker task like regular ones, so they run
+# on their own threads instead of those of the launch pool.
+_POOL_WORKERS = 4
+_poolExecutor = ThreadPoolExecutor(max_workers=_POOL_WORKERS)
+# Fills count the entries of a frontend before adding the missing ones.
+_fillLock = threading.Lock()
+
+
+def workersSupportPooling():
+    """Whether the workers registered the tasks the pool relies on."""
+    with _supportLock:
+        now = time.time()
+        if _support['checked'] is None or \
+                now - _support['checked'] > _SUPPORT_TTL:
+            try:
+                registered = getCeleryApp().control.inspect(
+                    timeout=1).registered() or {}
+                tasks = set(task for names in registered.values()
+                            for task in names)
+            except Exception:
+                logger.exception('Failed to list the tasks of the workers')
+                tasks = set()
+            supported = all(task in tasks for task in _POOL_TASKS)
+            if not supported and _support['value'] is not False:
+                logger.warning('Workers do not provide %s, warm pools are '
+                               'disabled', ', '.join(_POOL_TASKS))
+            _support.update(checked=now, value=supported)
+        return _support['value']
+
+
+class Pool(Model):
+    """
+    Containers that were launched and readiness-probed ahead of time, so that
+    a notebook can claim one instead of paying for the whole launch.
+
+    Each frontend keeps ``poolSize`` idle entries, provided the workers
+    support pooling (see :func:`workersSupportPooling`). The memory reserved
+    by idle entries is capped by the ``ythub.pool_memory_limit`` setting and,
+    when ``ythub.node_memory_capacity`` is set, by the capacity notebooks
+    leave free on the known nodes; when either is exceeded the newest
+    entries are shut down first.
+    """
+
+    def initialize(self):
+        self.name = 'notebook_pool'
+        compoundSearchIndex = (
+            ('frontendId', SortDir.ASCENDING),
+            ('status', SortDir.ASCENDING),
+            ('created', SortDir.ASCENDING)
+        )
+        self.ensureIndices([(compoundSearchIndex, {})])
+
+    def validate(self, entry):
+        if not NotebookStatus.isValid(entry['status']):
+            raise ValidationException(
+                'Invalid pool entry status %s.' % entry['status'],
+                field='status')
+        return entry
+
+    def claim(self, frontend):
+        """
+        Atomically take the oldest booted entry for a frontend out of the pool.
+
+        :returns: the claimed entry or None if the pool is empty.
+        """
+        return self.collection.find_one_and_delete(
+            {'frontendId': frontend['_id'], 'status': NotebookStatus.RUNNING},
+            sort=[('created', SortDir.ASCENDING)])
+
+    def reserved(self):
+        """Total memory (in bytes) held by pool entries."""
+        result = list(self.collection.aggregate([
+            {'$group': {'_id': None, 'total': {'$sum': '$memLimit'}}}
+        ]))
+        return result[0]['total'] if result else 0
+
+    def memoryBudget(self):
+        budgets = []
+        limit = Setting().get(PluginSettings.POOL_MEMORY_LIMIT)
+        if limit:
+            budgets.append(parseMemory(limit))
+        capacity = Placement().capacity()
+        nodes = Placement().nodeLoads() if capacity is not None else []
+        if nodes:
+            budgets.append(sum(max(capacity - node.get('reserved', 0), 0)
+                               for node in nodes))
+        return min(budgets) if budgets else None
+
+    def expire(self, timeout=_LAUNCH_TIMEOUT):
+        """
+        Shut down entries that have been starting for longer than a launch
+        may take, such as those left by a restart, so that they stop
+        counting towards the pool size.
+        """
+        cutoff = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=timeout)
+        for entry in self.find({'status': NotebookStatus.STARTING,
+                                'created': {'$lt': cutoff}}):
+            self.shutdownEntry(entry)
+
+    def maintain(self):
+        """Periodic cleanup: expire stuck entries and fit the budget."""
+        self.expire()
+        self.shrink()
+
+    def fill(self, frontend):
+        """
+        Launch the entries a frontend is missing and shrink the pool if it
+        no longer fits its size or memory budget. Fills run one at a time, so
+        that concurrent refills do not both add the same missing entries.
+        """
+        with _fillLock:
+            self._fill(frontend)
+
+    def _fill(self, frontend):
+        self.expire()
+        poolSize = frontend.get('poolSize') or 0
+        if poolSize and not workersSupportPooling():
+            poolSize = 0
+        current = self.find({'frontendId': frontend['_id']},
+                            sort=[('created', SortDir.ASCENDING)])
+        entries = list(current)
+        for entry in entries[poolSize:]:
+            self.shutdownEntry(entry)
+
+        memLimit = _memLimit(frontend)
+        budget = self.memoryBudget()
+        for _ in range(poolSize - len(entries)):
+            if budget is not None and self.reserved() + memLimit > budget:
+                logger.info('Warm pool memory budget reached, not refilling '
+                            'frontend %s', frontend['_id'])
+                break
+            entry = self.save({
+                'frontendId': frontend['_id'],
+                'status': NotebookStatus.STARTING,
+                'memLimit': memLimit,
+                'created': datetime.datetime.utcnow()
+            })
+            _poolExecutor.submit(self.launchEntry, entry, frontend)
+        self.shrink()
+
+    def shrink(self):
+        """Shut down the newest idle entries until the pool fits its budget."""
+        budget = self.memoryBudget()
+        if budget is None:
+            return
+        reserved = self.reserved()
+        for entry in self.find({}, sort=[('created', SortDir.DESCENDING)]):
+            if reserved <= budget:
+                break
+            self.shutdownEntry(entry)
+            reserved -= entry.get('memLimit', 0)
+
+    def drain(self, frontend):
+        for entry in self.find({'frontendId': frontend['_id']}):
+            self.shutdownEntry(entry)
+
+    def launchEntry(self, entry, frontend):
+        payload = {
+            'frontend': {k: str(v) for k, v in frontend.items()},
+            'api_version': API_VERSION,
+            'pooled': True
+        }
+        try:
+            serviceTask = getCeleryApp().send_task(
+                'gwvolman.tasks.launch_container', args=[payload], kwargs={},
+                queue='manager'
+            )
+            entry['serviceInfo'] = serviceTask.get(timeout=_LAUNCH_TIMEOUT)
+            url = _service_url(entry['serviceInfo'])
+            self.update({'_id': entry['_id']}, {'$set': {
+                'serviceInfo': entry['serviceInfo'], 'url': url}})
+        except Exception:
+            logger.exception('Failed to launch pooled container for '
+                             'frontend %s', frontend['_id'])
+            self.remove(entry)
+            return
+
+        prober.probe(url, lambda ready, timings: _poolExecutor.submit(
+            self._entryReady, entry, ready))
+
+    def _entryReady(self, entry, ready):
+        if not ready:
+            logger.warning('Pooled container %s did not answer in time',
+                           entry['serviceInfo'].get('serviceId'))
+            self.shutdownEntry(entry)
+            return
+
+        result = self.update(
+            {'_id': entry['_id']},
+            {'$set': {'status': NotebookStatus.RUNNING}})
+        if not result.matched_count:
+            # Drained while booting; nobody is going to claim it.
+            self.shutdownEntry(entry)
+
+    def shutdownEntry(self, entry):
+        self.remove(entry)
+        if 'serviceInfo' not in entry:
+            return
+        payload = {
+            'serviceInfo': entry['serviceInfo'],
+            'apiUrl': getWorkerApiUrl()
+        }
+        try:
+            getCeleryApp().send_task(
+                'gwvolman.tasks.shutdown_container', args=[payload],
+                queue='manager',
+            )
+        except Exception:
+            logger.exception('Failed to shut down pooled container %s',
+                             entry['serviceInfo'].get('serviceId'))
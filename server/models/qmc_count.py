@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numbers
+import threading
+
+from bson import SON
+from pymongo import ReturnDocument
+
+from girder.models.model_base import Model
+
+# Id of the document holding the version of the counts.
+_VERSION_ID = 'version'
+
+
+# Bucket ids are matched as whole documents, which depends on key order.
+def _bucketId(summary):
+    return SON([('tkelvin', summary.get('tkelvin')),
+                ('pgpa', summary.get('pgpa'))])
+
+
+def _nconf(summary):
+    nconf = summary.get('nconf')
+    return nconf if isinstance(nconf, numbers.Number) and \
+        not isinstance(nconf, bool) else 0
+
+
+class QMCCount(Model):
+    """
+    Number of QMC configurations per (tkelvin, pgpa) bucket, kept up to date
+    incrementally as simulation summaries change, along with a version
+    bumped on every change. The counts are cached in memory until the
+    version moves, and the version doubles as their ETag.
+    """
+
+    def initialize(self):
+        self.name = 'qmc_count'
+        self._cache = (None, None)
+        self._cacheLock = threading.Lock()
+
+    def validate(self, count):
+        return count
+
+    def version(self):
+        doc = self.collection.find_one({'_id': _VERSION_ID})
+        return doc['version'] if doc else None
+
+    def _bump(self):
+        return self.collection.find_one_and_update(
+            {'_id': _VERSION_ID}, {'$inc': {'version': 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)['version']
+
+    def adjust(self, old=None, new=None):
+        """
+        Move a simulation between buckets when its summary goes from ``old``
+        to ``new``; either may be None for creations and removals.
+        """
+        changes = {}
+        for summary, sign in ((old, -1), (new, 1)):
+            if summary is None:
+                continue
+            key = (summary.get('tkelvin'), summary.get('pgpa'))
+            bucket = changes.setdefault(key, [_bucketId(summary), 0, 0])
+            bucket[1] += sign * _nconf(summary)
+            bucket[2] += sign
+        changed = False
+        for bucketId, count, sims in changes.values():
+            if count or sims:
+                self.collection.update_one(
+                    {'_id': bucketId},
+                    {'$inc': {'count': count, 'sims': sims}}, upsert=True)
+                changed = True
+        if changed:
+            self.collection.delete_many({'sims': {'$lte': 0}})
+            self._bump()
+
+    def recount(self, summaryCollection):
+        """Rebuild all the buckets from the summaries."""
+        buckets = list(summaryCollection.aggregate([{'$group': {
+            '_id': SON([('tkelvin', '$tkelvin'), ('pgpa', '$pgpa')]),
+            'count': {'$sum': '$nconf'},
+            'sims': {'$sum': 1}
+        }}]))
+        self.collection.delete_many({'_id': {'$ne': _VERSION_ID}})
+        if buckets:
+            self.collection.insert_many(buckets)
+        return self._bump()
+
+    def counts(self):
+        """
+        :returns: A (version, counts) tuple, counts being a list of
+            ``{'_id': {'tkelvin': ..., 'pgpa': ...}, 'count': ...}``.
+        """
+        version = self.version()
+        with self._cacheLock:
+            if version is not None and self._cache[0] == version:
+                return self._cache
+        counts = list(self.find(
+            {'_id': {'$ne': _VERSION_ID}}, fields={'sims': False}))
+        with self._cacheLock:
+            self._cache = (version, counts)
+        return version, counts
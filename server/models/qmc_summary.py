@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from pymongo import ReturnDocument
+
+from girder import logger
+from girder.constants import AccessType, SortDir
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.model_base import Model
+
+from .qmc_count import QMCCount
+
+# Fields of ``meta.conf`` copied to the summary of a QMC simulation.
+CONF_FIELDS = ('tkelvin', 'pgpa', 'ens', 'input_dft', 'config_dft',
+               'quantum', 'configId', 'nconf')
+
+# Only QMC simulations are covered by the item indices below, which keeps
+# them small on instances where most items are not simulations.
+_QMC_FILTER = {'partialFilterExpression': {
+    'meta.conf.configId': {'$exists': True}}}
+
+# Item indices backing the queries that still run on items: lookups by
+# config, and the scan of :py:meth:`QMCSummary.rebuild`. (T, P) ranges and
+# sorts are served by the summaries.
+ITEM_INDICES = [
+    ([('meta.conf.configId', SortDir.ASCENDING),
+      ('name', SortDir.ASCENDING)], _QMC_FILTER),
+    ([('meta.configFileIds', SortDir.ASCENDING),
+      ('name', SortDir.ASCENDING)], {'partialFilterExpression': {
+          'meta.configFileIds': {'$exists': True}}})
+]
+
+
+class QMCSummary(Model):
+    """
+    Compact copy of the QMC simulation items, holding only the fields the
+    ``/qmc`` routes query and return, along with the access control of the
+    folder each item is in, so that permissions can be checked in the
+    query itself. It is kept in sync by item and folder events; see
+    :py:meth:`rebuild` for filling it from existing items. Changes are
+    forwarded to :py:class:`QMCCount`.
+    """
+
+    def initialize(self):
+        self.name = 'qmc_summary'
+        rangeIndex = (
+            ('tkelvin', SortDir.ASCENDING),
+            ('pgpa', SortDir.ASCENDING)
+        )
+        pressureIndex = (
+            ('pgpa', SortDir.ASCENDING),
+            ('tkelvin', SortDir.ASCENDING)
+        )
+        # Also serves the paging of downloads, which sort on (name, _id).
+        nameIndex = (
+            ('name', SortDir.ASCENDING),
+            ('_id', SortDir.ASCENDING)
+        )
+        self.ensureIndices([
+            (rangeIndex, {}), (pressureIndex, {}), (nameIndex, {}), 'configId',
+            'folderId', 'access.users.id', 'access.groups.id'
+        ])
+
+    def validate(self, summary):
+        return summary
+
+    @staticmethod
+    def isQMC(item):
+        conf = item.get('meta', {}).get('conf')
+        return isinstance(conf, dict) and \
+            'configId' in conf and 'tkelvin' in conf
+
+    def summarize(self, item, folder=None):
+        """
+        Create, update or drop the summary of an item, depending on whether
+        it is a QMC simulation.
+        """
+        if not self.isQMC(item):
+            self.drop(item)
+            return None
+        if folder is None:
+            folder = Folder().load(item['folderId'], force=True,
+                                   fields=['access', 'public'])
+        summary = self.summaryOf(item, folder)
+        old = self.collection.find_one_and_replace(
+            {'_id': item['_id']}, summary, upsert=True,
+            return_document=ReturnDocument.BEFORE)
+        QMCCount().adjust(old, summary)
+        return summary
+
+    def drop(self, item):
+        """Drop the summary of an item, if any."""
+        old = self.collection.find_one_and_delete({'_id': item['_id']})
+        if old is not None:
+            QMCCount().adjust(old, None)
+
+    @staticmethod
+    def summaryOf(item, folder):
+        """Build the summary of a QMC simulation item in ``folder``."""
+        conf = item['meta']['conf']
+        summary = {field: conf[field] for field in CONF_FIELDS if field in conf}
+        summary.update({
+            '_id': item['_id'],
+            'name': item['name'],
+            'folderId': item['folderId'],
+            'access': (folder or {}).get('access', {}),
+            'public': (folder or {}).get('public', False)
+        })
+        return summary
+
+    def syncAccess(self, folder):
+        """Copy the access control of a folder to the summaries in it."""
+        self.update({'folderId': folder['_id']}, {'$set': {
+            'access': folder.get('access', {}),
+            'public': folder.get('public', False)
+        }})
+
+    def rebuild(self):
+        """Summarize all the QMC simulation items."""
+        folders = {}
+        count = 0
+        for item in Item().find({
+            'meta.conf.configId': {'$exists': True},
+            'meta.conf.tkelvin': {'$exists': True}
+        }, fields=['name', 'folderId', 'meta.conf']):
+            if item['folderId'] not in folders:
+                folders[item['folderId']] = Folder().load(
+                    item['folderId'], force=True, fields=['access', 'public'])
+            self.summarize(item, folders[item['folderId']])
+            count += 1
+        logger.info('Summarized %d QMC simulations', count)
+        return count
+
+    def recount(self):
+        """Rebuild the QMC counts from the summaries."""
+        return QMCCount().recount(self.collection)
+
+    def permissionQuery(self, user, level=AccessType.READ):
+        """
+        Mongo clause restricting summaries to those ``user`` may access.
+        Summaries carry the access control of their folder, so the clause is
+        the one folders are filtered with.
+        """
+        return Folder().permissionClauses(user, level)
+
+    def findWithPermissions(self, query=None, user=None,
+                            level=AccessType.READ, **kwargs):
+        query = dict(query or {})
+        permissions = self.permissionQuery(user, level)
+        if permissions:
+            query = {'$and': [query, permissions]}
+        return self.find(query, **kwargs)
+
+    @staticmethod
+    def rangeQuery(Tmin=0, Pmin=0, Tmax=100000, Pmax=100000):
+        return {
+            'tkelvin': {'$gte': Tmin, '$lte': Tmax},
+            'pgpa': {'$gte': Pmin, '$lte': Pmax}
+        }
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from girder import logger
+from girder.constants import SortDir
+from girder.models.folder import Folder
+from girder.models.model_base import Model
+from girder.models.setting import Setting
+from girder.models.token import Token
+from girder.models.user import User
+from girder.plugins.worker import getCeleryApp, getWorkerApiUrl
+
+from ..constants import PluginSettings
+from ..utils import parseMemory
+
+
+class Volume(Model):
+    """
+    Volumes kept on their node after a notebook is removed, so that the next
+    launch for the same user and folder can skip ``create_volume``.
+
+    Retention is enabled by the ``ythub.volume_retention_ttl`` setting (in
+    hours). Volumes unused for longer than that are removed, and each node
+    keeps at most ``ythub.volume_node_budget`` worth of retained volumes,
+    evicting the least recently used ones first. The size of a volume is
+    estimated from the size of the mounted folder.
+    """
+
+    def initialize(self):
+        self.name = 'notebook_volume'
+        ownerIndex = (
+            ('creatorId', SortDir.ASCENDING),
+            ('folderId', SortDir.ASCENDING)
+        )
+        nodeIndex = (
+            ('nodeId', SortDir.ASCENDING),
+            ('lastUsed', SortDir.DESCENDING)
+        )
+        self.ensureIndices([(ownerIndex, {'unique': True}),
+                            (nodeIndex, {}), 'lastUsed'])
+
+    def validate(self, volume):
+        return volume
+
+    def ttl(self):
+        ttl = Setting().get(PluginSettings.VOLUME_RETENTION_TTL)
+        return float(ttl) if ttl else 0.0
+
+    def nodeBudget(self):
+        budget = Setting().get(PluginSettings.VOLUME_NODE_BUDGET)
+        return parseMemory(budget) if budget else None
+
+    def retain(self, notebook):
+        """
+        Keep the volume of a removed notebook for later reuse.
+
+        :returns: Whether the volume was retained; if not, the caller is
+            responsible for removing it.
+        """
+        volumeInfo = notebook.get('volumeInfo')
+        if not self.ttl() or not volumeInfo or 'nodeId' not in volumeInfo:
+            return False
+
+        folder = Folder().load(notebook['folderId'], force=True) or {}
+        now = datetime.datetime.utcnow()
+        previous = self.collection.find_one_and_replace(
+            {'creatorId': notebook['creatorId'],
+             'folderId': notebook['folderId']},
+            {
+                'creatorId': notebook['creatorId'],
+                'folderId': notebook['folderId'],
+                'nodeId': volumeInfo['nodeId'],
+                'volumeInfo': volumeInfo,
+                'size': folder.get('size', 0),
+                'lastUsed': now
+            }, upsert=True)
+        if previous is not None and \
+                previous['volumeInfo'] != volumeInfo:
+            self.removeVolume(previous)
+        self.enforceBudget(volumeInfo['nodeId'])
+        return True
+
+    def claim(self, user, folder):
+        """
+        Atomically take the retained volume for a user and folder, if any.
+
+        :returns: The volume info to launch against, or None.
+        """
+        ttl = self.ttl()
+        if not ttl:
+            return None
+        volume = self.collection.find_one_and_delete({
+            'creatorId': user['_id'],
+            'folderId': folder['_id']
+        })
+        if volume is None:
+            return None
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=ttl)
+        if volume['lastUsed'] < cutoff:
+            self.removeVolume(volume)
+            return None
+        return volume['volumeInfo']
+
+    def enforceBudget(self, nodeId):
+        """Evict least recently used volumes until a node fits its budget."""
+        budget = self.nodeBudget()
+        if budget is None:
+            return
+        used = 0
+        for volume in self.find({'nodeId': nodeId},
+                                sort=[('lastUsed', SortDir.DESCENDING)]):
+            size = volume.get('size', 0)
+            if used + size > budget:
+                self.collection.delete_one({'_id': volume['_id']})
+                self.removeVolume(volume)
+            else:
+                used += size
+
+    def evictExpired(self):
+        """
+        Remove volumes that were not reused within the retention TTL, or all
+        of them once retention has been disabled.
+        """
+        ttl = self.ttl()
+        query = {}
+        if ttl:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=ttl)
+            query = {'lastUsed': {'$lt': cutoff}}
+        for volume in self.find(query):
+            self.collection.delete_one({'_id': volume['_id']})
+            self.removeVolume(volume)
+
+    def removeVolume(self, volume):
+        try:
+            user = User().load(volume['creatorId'], force=True)
+            token = Token().createToken(user=user, days=1)
+            payload = {
+                'serviceInfo': volume['volumeInfo'],
+                'girder_token': str(token['_id']),
+                'apiUrl': getWorkerApiUrl()
+            }
+            getCeleryApp().send_task(
+                'gwvolman.tasks.remove_volume', args=[payload],
+                queue=volume['nodeId'])
+        except Exception:
+            logger.exception('Failed to remove retained volume %s',
+                             volume['volumeInfo'].get('volumeId'))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+
+from girder.models.file import File
+
+# Number of files read ahead of the one being streamed, per download.
+PREFETCH_FILES = 8
+# Bytes that may be buffered ahead, per download. Larger files are
+# streamed from the assetstore when their turn comes.
+PREFETCH_BYTES = 64 * 1024 * 1024
+
+# Shared by all downloads, which bounds the reads in flight.
+_prefetchExecutor = ThreadPoolExecutor(max_workers=16)
+
+
+def _download(fileitem, offset, endByte):
+    return File().download(
+        fileitem, offset, headers=False, endByte=endByte)
+
+
+def _readFile(fileitem, offset, endByte):
+    return list(_download(fileitem, offset, endByte)())
+
+
+def prefetchFiles(entries, depth=PREFETCH_FILES, maxBytes=PREFETCH_BYTES):
+    """
+    Read files ahead of their consumer, so that fetching the next files
+    from the assetstore overlaps with streaming the current one.
+
+    :param entries: Iterable of (key, file, offset, endByte) tuples, naming
+        the byte range of each file to read.
+    :param depth: Maximum number of files read ahead.
+    :param maxBytes: Maximum number of bytes buffered ahead.
+    :returns: A generator of (key, stream) pairs, where stream is a
+        generator function as returned by :py:meth:`File.download`.
+    """
+    entries = iter(entries)
+    nextEntry = next(entries, None)
+    pending = collections.deque()
+    buffered = 0
+    try:
+        while pending or nextEntry is not None:
+            while nextEntry is not None and len(pending) < depth:
+                key, fileitem, offset, endByte = nextEntry
+                size = endByte - offset
+                if size > maxBytes:
+                    future = None
+                elif pending and buffered + size > maxBytes:
+                    break
+                else:
+                    future = _prefetchExecutor.submit(
+                        _readFile, fileitem, offset, endByte)
+                    buffered += size
+                pending.append((nextEntry, future))
+                nextEntry = next(entries, None)
+            (key, fileitem, offset, endByte), future = pending.popleft()
+            if future is None:
+                yield key, _download(fileitem, offset, endByte)
+            else:
+                yield key, functools.partial(iter, future.result())
+                # The consumer is done with the buffered range by now.
+                buffered -= endByte - offset
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
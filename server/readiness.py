@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import socket
+import threading
+import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from girder import logger
+
+
+class ReadinessProber(object):
+    """
+    Probe newly launched notebook servers until they answer.
+
+    All probes share a single tornado IOLoop running in a daemon thread, so
+    waiting for a notebook to boot does not tie up a thread per launch. Each
+    url is polled with jittered exponential backoff until it responds or its
+    deadline passes; ``callback`` is then called with ``True`` if the server
+    came up and ``False`` otherwise, along with a dict of the seconds spent
+    waiting for the host name to resolve (``dns``) and for the server to
+    answer once it did (``boot``). Callbacks run on the IOLoop thread and
+    should hand any blocking work off elsewhere.
+    """
+
+    def __init__(self, initialDelay=0.5, baseDelay=0.25, maxDelay=5.0,
+                 requestTimeout=1.0, maxClients=100):
+        self.initialDelay = initialDelay
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.requestTimeout = requestTimeout
+        self.maxClients = maxClients
+        self._ioloop = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        ready = threading.Event()
+
+        def run():
+            # A new IOLoop becomes the current one of the thread creating it.
+            self._ioloop = IOLoop()
+            self._client = AsyncHTTPClient(max_clients=self.maxClients)
+            ready.set()
+            self._ioloop.start()
+
+        thread = threading.Thread(target=run, name='ythub-readiness')
+        thread.daemon = True
+        thread.start()
+        ready.wait()
+
+    def probe(self, url, callback, timeout=30):
+        """
+        Start probing ``url`` for at most ``timeout`` seconds. Safe to call
+        from any thread.
+        """
+        with self._lock:
+            if self._ioloop is None:
+                self._start()
+        start = time.time()
+        self._ioloop.add_callback(
+            self._probe, url, start, start + timeout, callback)
+
+    def backoff(self, attempt):
+        delay = min(self.maxDelay, self.baseDelay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+    @gen.coroutine
+    def _probe(self, url, start, deadline, callback):
+        # Fudge factor of IPython notebook bootup.
+        yield gen.sleep(self.initialDelay)
+
+        ready = False
+        resolved = None
+        attempt = 0
+        while time.time() < deadline:
+            timeout = min(self.requestTimeout, max(deadline - time.time(), 0))
+            tic = time.time()
+            try:
+                yield self._client.fetch(
+                    url, connect_timeout=timeout, request_timeout=timeout)
+            except Exception as err:
+                if resolved is None and not isinstance(err, socket.gaierror):
+                    resolved = tic
+                logger.info('Booting server at [%s], getting [%s]', url, err)
+            else:
+                ready = True
+                if resolved is None:
+                    resolved = tic
+                break
+            delay = min(self.backoff(attempt), max(deadline - time.time(), 0))
+            yield gen.sleep(delay)
+            attempt += 1
+
+        end = time.time()
+        if resolved is None:
+            timings = {'dns': end - start}
+        else:
+            timings = {'dns': resolved - start, 'boot': end - resolved}
+        try:
+            callback(ready, timings)
+        except Exception:
+            logger.exception('Readiness callback for [%s] failed', url)
+
+
+prober = ReadinessProber()
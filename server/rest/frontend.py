@@ -46,6 +46,8 @@ frontendModel = {
         'created': {'type': 'string', 'format': 'date',
                     'allowEmptyValue': True},
         'public': {'type': 'boolean', 'allowEmptyValue': True},
+        'poolSize': {'type': 'integer', 'format': 'int32',
+                     'allowEmptyValue': True, 'minimum': 0},
     }
 }
 addModel('frontend', frontendModel, resources='frontend')
@@ -112,13 +114,15 @@ class Frontend(Resource):
                required=False)
         .param('urlPath', 'Optional suffix to frontend url',
                required=False)
+        .param('poolSize', 'Number of idle containers kept booted for this '
+               'frontend.', dataType='integer', required=False)
         .responseClass('frontend')
         .errorResponse('ID was invalid.')
         .errorResponse('Admin access was denied for the frontend.', 403)
     )
     def updateFrontend(self, frontend, imageName, command, memLimit,
                        user, port, description, public, cpuShares,
-                       targetMount, urlPath, params):
+                       targetMount, urlPath, poolSize, params):
         frontend['imageName'] = imageName or frontend['imageName']
         frontend['command'] = command or frontend['command']
         frontend['memLimit'] = memLimit or frontend['memLimit']
@@ -128,6 +132,8 @@ class Frontend(Resource):
         frontend['cpuShares'] = cpuShares or frontend['cpuShares']
         frontend['targetMount'] = targetMount or frontend['targetMount']
         frontend['urlPath'] = urlPath or frontend['urlPath']
+        if poolSize is not None:
+            frontend['poolSize'] = poolSize
 
         if public is not None:
             self.model('frontend', 'ythub').setPublic(frontend, public)
@@ -166,13 +172,16 @@ class Frontend(Resource):
         .param('public', 'Whether the frontend should be publicly visible.'
                ' Defaults to False.', dataType='boolean', required=False)
         .param('cpuShares', 'Limit cpu usage.', required=False)
+        .param('poolSize', 'Number of idle containers kept booted for this '
+               'frontend.', dataType='integer', required=False, default=0)
         .responseClass('frontend')
         .errorResponse('You are not authorized to create collections.', 403)
     )
     def createFrontend(self, imageName, command, memLimit, user, port,
                        description, public, cpuShares, targetMount, urlPath,
-                       params):
+                       poolSize, params):
         return self.model('frontend', 'ythub').createFrontend(
             imageName, memLimit=memLimit, command=command, user=user,
             port=port, cpuShares=cpuShares, description=description,
-            public=public, urlPath=urlPath, targetMount=targetMount)
+            public=public, urlPath=urlPath, targetMount=targetMount,
+            poolSize=poolSize)
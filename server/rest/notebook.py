@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from bson import ObjectId
+from bson.errors import InvalidId
+import cherrypy
 import datetime
 
+from girder import logger
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.docs import addModel
-from girder.api.rest import Resource, filtermodel
+from girder.api.rest import Resource, filtermodel, setResponseHeader
 from girder.constants import AccessType, SortDir
+from girder.exceptions import RestException
+
+from ..constants import NotebookStatus, PluginSettings
 
 
 notebookModel = {
@@ -51,9 +58,32 @@ class Notebook(Resource):
         self.route('GET', (), self.listNotebooks)
         self.route('POST', (), self.createNotebook)
         self.route('GET', (':id',), self.getNotebook)
+        self.route('DELETE', (), self.deleteNotebooks)
         self.route('DELETE', (':id',), self.deleteNotebook)
+        self.route('PUT', (':id', 'activity'), self.recordActivity)
 
         self.lastCulling = datetime.datetime.utcnow()
+        self.lastReclaimed = 0
+
+    def cullNotebooks(self):
+        """
+        Reap idle notebooks if the configured culling frequency has passed
+        since the last pass. Meant to be called periodically.
+        """
+        setting = self.model('setting')
+        period = setting.get(PluginSettings.CULLING_PERIOD)
+        frequency = setting.get(PluginSettings.CULLING_FREQUENCY)
+        if not period or not frequency:
+            return
+
+        now = datetime.datetime.utcnow()
+        if now - self.lastCulling < datetime.timedelta(hours=float(frequency)):
+            return
+        self.lastCulling = now
+        self.lastReclaimed = self.model('notebook', 'ythub').cullNotebooks(
+            float(period))
+        logger.info('Culling pass reclaimed %d idle notebook(s)',
+                    self.lastReclaimed)
 
     @access.user
     @filtermodel(model='notebook', plugin='ythub')
@@ -67,6 +97,8 @@ class Notebook(Resource):
                required=False)
         .responseClass('notebook', array=True)
         .pagingParams(defaultSort='created', defaultSortDir=SortDir.DESCENDING)
+        .notes('The total number of matching notebooks is returned in the '
+               'Girder-Total-Count header.')
     )
     def listNotebooks(self, userId, folderId, limit, offset, sort, params):
         currentUser = self.getCurrentUser()
@@ -82,9 +114,11 @@ class Notebook(Resource):
             folder = self.model('folder').load(
                 folderId, user=currentUser, level=AccessType.READ)
 
-        return list(self.model('notebook', 'ythub').list(
+        cursor = self.model('notebook', 'ythub').list(
             user=user, folder=folder, offset=offset, limit=limit,
-            sort=sort, currentUser=currentUser))
+            sort=sort, currentUser=currentUser)
+        setResponseHeader('Girder-Total-Count', cursor.count())
+        return list(cursor)
 
     @access.user
     @autoDescribeRoute(
@@ -99,6 +133,25 @@ class Notebook(Resource):
     def getNotebook(self, notebook, params):
         return notebook
 
+    @access.user
+    @filtermodel(model='notebook', plugin='ythub')
+    @autoDescribeRoute(
+        Description('Record user activity in a notebook.')
+        .notes('Notebooks that have been inactive for longer than the '
+               'culling period are removed.')
+        .modelParam('id', model='notebook', plugin='ythub',
+                    level=AccessType.WRITE)
+        .responseClass('notebook')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the notebook.', 403)
+    )
+    def recordActivity(self, notebook, params):
+        notebook['lastActivity'] = datetime.datetime.utcnow()
+        self.model('notebook', 'ythub').update(
+            {'_id': notebook['_id']},
+            {'$set': {'lastActivity': notebook['lastActivity']}})
+        return notebook
+
     @access.user
     @autoDescribeRoute(
         Description('Delete an existing notebook.')
@@ -111,10 +164,58 @@ class Notebook(Resource):
         self.model('notebook', 'ythub').deleteNotebook(
             notebook, self.getCurrentToken())
 
+    @access.admin
+    @autoDescribeRoute(
+        Description('Delete all notebooks matching given criteria.')
+        .notes('At least one filter is required. Returns a job removing the '
+               'notebooks, whose log holds the outcome of the container '
+               'shutdown and volume removal for each of them.')
+        .param('userId', 'The ID of the user whose notebooks will be '
+               'removed.', required=False)
+        .param('folderId', 'The ID of the folder mounted by the notebooks.',
+               required=False)
+        .param('frontendId', 'The ID of the frontend run by the notebooks.',
+               required=False)
+        .param('olderThan', 'Only remove notebooks created more than this '
+               'many hours ago.', dataType='number', required=False)
+        .param('retainVolumes', 'Keep the volumes for reuse if volume '
+               'retention is enabled.', dataType='boolean', required=False,
+               default=False)
+        .errorResponse('No filter was given.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    def deleteNotebooks(self, userId, folderId, frontendId, olderThan,
+                        retainVolumes, params):
+        query = {}
+        for field, value in (('creatorId', userId), ('folderId', folderId),
+                             ('frontendId', frontendId)):
+            if value:
+                try:
+                    query[field] = ObjectId(value)
+                except InvalidId:
+                    raise RestException('Invalid ObjectId: %s' % value)
+        if olderThan is not None:
+            cutoff = datetime.datetime.utcnow() - \
+                datetime.timedelta(hours=olderThan)
+            query['created'] = {'$lt': cutoff}
+        if not query:
+            raise RestException('At least one filter is required.')
+
+        user = self.getCurrentUser()
+        notebookModel = self.model('notebook', 'ythub')
+        job = notebookModel.scheduleDeletion(
+            list(notebookModel.find(query, fields=['_id'])), user,
+            retain=retainVolumes)
+        return self.model('job', 'jobs').filter(job, user)
+
     @access.user
     @filtermodel(model='notebook', plugin='ythub')
     @autoDescribeRoute(
         Description('Create new notebook for a current user and folder.')
+        .notes('The notebook is launched in the background. The response is '
+               'returned with status 202 while the notebook is starting; poll '
+               'the notebook or listen for notebook_status notifications to '
+               'learn when its url becomes available.')
         .param('folderId', 'The ID of the folder that will be mounted inside '
                'of the container.', required=True)
         .param('frontendId', 'The ID of the frontend that is going to be '
@@ -134,5 +235,6 @@ class Notebook(Resource):
             folderId, user=user, level=AccessType.READ)
         notebook = notebookModel.createNotebook(folder, user, token, frontend,
                                                 scripts)
-
-        return notebookModel.save(notebook)
+        if notebook['status'] == NotebookStatus.STARTING:
+            cherrypy.response.status = 202
+        return notebook
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
+
+import cherrypy
 from bson import ObjectId
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
@@ -11,7 +14,20 @@ from girder.api.rest import (
 )
 from girder.constants import AccessType
 from girder.models.item import Item
-from girder.utility import ziputil
+
+from ..archive import ZipManifest
+from ..listing import childFilesByItem
+from ..models.qmc_count import QMCCount
+from ..models.qmc_summary import CONF_FIELDS, QMCSummary
+from ..utils import checkNotModified, requestedRange
+
+# Number of sims fetched per query while building a download.
+_DOWNLOAD_BATCH = 500
+# Fields of QMC summaries by sort key: their own names, those of the item
+# fields they copy, and the datatables columns. Other keys sort by name.
+_SUMMARY_SORT = {"T": "tkelvin", "P": "pgpa", "conf_dft": "config_dft", "name": "name"}
+_SUMMARY_SORT.update((field, field) for field in CONF_FIELDS)
+_SUMMARY_SORT.update(("meta.conf." + field, field) for field in CONF_FIELDS)
 
 
 class QMCDescription(Description):
@@ -98,21 +114,21 @@ class QMC(Resource):
     )
     def listQMCByParams(self, Tmin, Tmax, Pmin, Pmax, limit, offset, sort):
         user = self.getCurrentUser()
-        q = {
-            "meta.conf.configId": {"$exists": True},
-            "meta.conf.tkelvin": {"$gte": Tmin, "$lte": Tmax},
-            "meta.conf.pgpa": {"$gte": Pmin, "$lte": Pmax},
-        }
-        fields = {"meta.qmc": 0}
-        return Item().findWithPermissions(
-            q,
-            sort=sort,
+        summaries = QMCSummary().findWithPermissions(
+            QMCSummary.rangeQuery(Tmin, Pmin, Tmax, Pmax),
+            sort=self.summarySort(sort),
             user=user,
             level=AccessType.READ,
             limit=limit,
             offset=offset,
-            fields=fields,
+            fields=["_id"],
         )
+        ids = [summary["_id"] for summary in summaries]
+        items = {
+            item["_id"]: item
+            for item in Item().find({"_id": {"$in": ids}}, fields={"meta.qmc": 0})
+        }
+        return [items[_id] for _id in ids if _id in items]
 
     @access.public
     @autoDescribeRoute(
@@ -128,50 +144,40 @@ class QMC(Resource):
         .pagingParams(defaultSort="name")
     )
     def aggregateQMCByParams(self, draw, Tmin, Tmax, Pmin, Pmax, limit, offset, sort):
-        results = []
         user = self.getCurrentUser()
+        summaryModel = QMCSummary()
 
-        search_kwargs = dict(
-            sort=[("name", 1)],
-            user=user,
-            level=AccessType.READ,
-            limit=0,
-            offset=0,
-            fields={},
-        )
+        def count(query):
+            return summaryModel.findWithPermissions(
+                query, user=user, level=AccessType.READ
+            ).count()
 
-        total = Item().findWithPermissions(self.query(), **search_kwargs).count()
-        q = self.query(Tmin, Pmin, Tmax, Pmax)
-        totalFiltered = Item().findWithPermissions(q, **search_kwargs).count()
-
-        if sort[0][0] == "T":
-            newsort = [("meta.conf.tkelvin", sort[0][1])]
-        elif sort[0][0] == "P":
-            newsort = [("meta.conf.pgpa", sort[0][1])]
-        else:
-            newsort = [("name", sort[0][1])]
-
-        search_kwargs.update(
-            {
-                "sort": newsort,
-                "fields": {"meta.qmc": 0},
-                "offset": offset,
-                "limit": limit,
-            }
-        )
+        q = QMCSummary.rangeQuery(Tmin, Pmin, Tmax, Pmax)
+        total = count({})
+        totalFiltered = count(q)
 
-        for item in Item().findWithPermissions(q, **search_kwargs):
-            conf = item["meta"]["conf"]
+        results = []
+        for summary in summaryModel.findWithPermissions(
+            q,
+            sort=self.summarySort(sort),
+            user=user,
+            level=AccessType.READ,
+            limit=limit,
+            offset=offset,
+        ):
             results.append(
                 {
-                    "name": item["name"],
-                    "T": conf["tkelvin"],
-                    "P": conf["pgpa"],
-                    "DT_RowData": {"itemId": item["_id"], "configId": conf["configId"]},
-                    "input_dft": conf.get("input_dft"),
-                    "ens": conf["ens"],
-                    "conf_dft": conf.get("config_dft"),
-                    "quantum": conf.get("quantum", False),
+                    "name": summary["name"],
+                    "T": summary["tkelvin"],
+                    "P": summary["pgpa"],
+                    "DT_RowData": {
+                        "itemId": summary["_id"],
+                        "configId": summary["configId"],
+                    },
+                    "input_dft": summary.get("input_dft"),
+                    "ens": summary["ens"],
+                    "conf_dft": summary.get("config_dft"),
+                    "quantum": summary.get("quantum", False),
                 }
             )
 
@@ -183,56 +189,109 @@ class QMC(Resource):
         }
 
     @staticmethod
-    def query(Tmin=0, Pmin=0, Tmax=100000, Pmax=100000):
-        return {
-            "meta.conf.configId": {"$exists": True},
-            "meta.conf.tkelvin": {"$gte": Tmin, "$lte": Tmax},
-            "meta.conf.pgpa": {"$gte": Pmin, "$lte": Pmax},
-        }
+    def summarySort(sort):
+        """Map datatables columns to the fields of QMC summaries."""
+        field, direction = sort[0]
+        return [(_SUMMARY_SORT.get(field, "name"), direction)]
+
+    @staticmethod
+    def downloadEntries(query, user):
+        """
+        Yield the (path, file) pairs of the sims matching ``query`` in name
+        order, paging through them rather than holding a cursor open for the
+        whole download.
+        """
+        summaryModel = QMCSummary()
+        last = None
+        while True:
+            pageQuery = query
+            if last is not None:
+                pageQuery = {
+                    "$and": [
+                        query,
+                        {
+                            "$or": [
+                                {"name": {"$gt": last["name"]}},
+                                {"name": last["name"], "_id": {"$gt": last["_id"]}},
+                            ]
+                        },
+                    ]
+                }
+            summaries = list(
+                summaryModel.findWithPermissions(
+                    pageQuery,
+                    user=user,
+                    level=AccessType.READ,
+                    sort=[("name", 1), ("_id", 1)],
+                    limit=_DOWNLOAD_BATCH,
+                    fields=["name"],
+                )
+            )
+            if not summaries:
+                return
+            items = {
+                item["_id"]: item
+                for item in Item().find(
+                    {"_id": {"$in": [summary["_id"] for summary in summaries]}},
+                    fields=["name"],
+                )
+            }
+            files = childFilesByItem(list(items.values()))
+            for summary in summaries:
+                item = items.get(summary["_id"])
+                if item is None:
+                    continue
+                itemFiles = files[item["_id"]]
+                # Same layout as Item.fileList with subpath=True
+                path = ""
+                if len(itemFiles) != 1 or itemFiles[0]["name"] != item["name"]:
+                    path = item["name"]
+                for fileitem in itemFiles:
+                    yield os.path.join(path, fileitem["name"]), fileitem
+            last = summaries[-1]
 
     @access.public
     @autoDescribeRoute(
         QMCDescription("Download QMC sims by config parameters (T, P)")
+        .notes(
+            "The archive has a Content-Length and an ETag, and supports single "
+            "Range requests, with If-Range, to resume or split downloads."
+        )
         .physRangeParams()
         .produces("application/zip")
     )
     def downloadQMCByParams(self, Tmin, Tmax, Pmin, Pmax):
         user = self.getCurrentUser()
-        search_kwargs = dict(
-            sort=[("name", 1)], user=user, level=AccessType.READ, limit=0, offset=0
+        manifest = ZipManifest(
+            self.downloadEntries(QMCSummary.rangeQuery(Tmin, Pmin, Tmax, Pmax), user)
         )
-        q = self.query(Tmin, Pmin, Tmax, Pmax)
         setResponseHeader("Content-Type", "application/zip")
         setContentDisposition("QMC.zip")
+        setResponseHeader("Accept-Ranges", "bytes")
+        setResponseHeader("ETag", manifest.etag)
+        start, end = requestedRange(manifest.size, manifest.etag) or (0, manifest.size)
+        if (start, end) != (0, manifest.size):
+            cherrypy.response.status = 206
+            setResponseHeader(
+                "Content-Range", "bytes %d-%d/%d" % (start, end - 1, manifest.size)
+            )
+        setResponseHeader("Content-Length", end - start)
 
         def stream():
-            zipobj = ziputil.ZipGenerator()
-            for item in Item().findWithPermissions(q, **search_kwargs):
-                print(item["_id"])
-                for (path, fobj) in Item().fileList(
-                    doc=item, user=user, includeMetadata=False, subpath=True
-                ):
-                    for data in zipobj.addFile(fobj, path):
-                        yield data
-            yield zipobj.footer()
+            for data in manifest.stream(start, end):
+                yield data
 
         return stream
 
     @access.public
     @autoDescribeRoute(
         Description("Return a count of QMC simulations aggregated by (T, P)")
+        .notes(
+            "The response carries an ETag that changes along with the counts, "
+            "send it back in If-None-Match to get a 304 when they did not."
+        )
     )
     def countQMC(self):
-        query = {
-            "$match": {
-                "meta.conf.configId": {"$exists": True},
-                "meta.conf.tkelvin": {"$exists": True},
-            }
-        }
-        aggregation = {
-            "$group": {
-                "_id": {"tkelvin": "$meta.conf.tkelvin", "pgpa": "$meta.conf.pgpa"},
-                "count": {"$sum": "$meta.conf.nconf"},
-            }
-        }
-        return list(Item().collection.aggregate([query, aggregation]))
+        version, counts = QMCCount().counts()
+        checkNotModified('"qmc-count-%s"' % (version or 0))
+        return counts
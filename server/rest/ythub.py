@@ -12,12 +12,13 @@ import validators
 
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import Resource, getApiUrl, setResponseHeader
+from girder.api.rest import Resource, getApiUrl, rawResponse, setResponseHeader
 from girder.constants import AccessType
 from girder.exceptions import RestException
 from girder.models.folder import Folder
 from girder.models.item import Item
 
+from girder.plugins.ythub import metrics
 from girder.plugins.ythub.constants import PluginSettings
 
 
@@ -104,6 +105,19 @@ class ytHub(Resource):
         self.route("GET", (":id", "registry"), self.generate_pooch_registry)
         self.route("POST", ("genkey",), self.generateRSAKey)
         self.route("GET", ("dataverse",), self.dataverseExternalTools)
+        self.route("GET", ("metrics",), self.getMetrics)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description("Get notebook launch metrics.")
+        .notes("Per stage launch latency histograms, labeled by frontend and "
+               "node, in the Prometheus text exposition format.")
+        .produces("text/plain")
+    )
+    @rawResponse
+    def getMetrics(self, params):
+        setResponseHeader("Content-Type", "text/plain; version=0.0.4")
+        return metrics.render()
 
     @access.admin
     @autoDescribeRoute(Description("Generate ythub's RSA key"))
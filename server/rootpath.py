@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from girder.constants import AccessType
+from girder.exceptions import AccessException
+from girder.models.folder import Folder
+
+from .utils import MODELS
+
+# Materialized list of {'type', 'id'} ancestors of a folder, root first.
+ANCESTORS_FIELD = 'ythubAncestors'
+
+
+def _computeAncestors(folder):
+    parentType = folder['parentCollection']
+    parentId = folder['parentId']
+    if parentType == 'folder':
+        parent = Folder().load(parentId, force=True, fields=[
+            'parentId', 'parentCollection', ANCESTORS_FIELD])
+        if parent is None:
+            return None
+        ancestors = folderAncestors(parent)
+        if ancestors is None:
+            return None
+        ancestors = ancestors + [{'type': 'folder', 'id': parentId}]
+    else:
+        ancestors = [{'type': parentType, 'id': parentId}]
+    Folder().update({'_id': folder['_id'], 'parentId': parentId},
+                    {'$set': {ANCESTORS_FIELD: ancestors}})
+    folder[ANCESTORS_FIELD] = ancestors
+    return ancestors
+
+
+def folderAncestors(folder):
+    """
+    Get the ancestors of a folder, computing and storing them on first use.
+
+    :returns: A list of ``{'type': ..., 'id': ...}`` dicts from the root
+        user or collection down to the parent, or None if the chain is
+        broken.
+    """
+    ancestors = folder.get(ANCESTORS_FIELD)
+    if ancestors is None:
+        ancestors = _computeAncestors(folder)
+    return ancestors
+
+
+def _isConsistent(folder, ancestors, docs):
+    """Check that stored ancestors still match the parents of each folder."""
+    if not ancestors or ancestors[0]['type'] == 'folder':
+        return False
+    expected = None
+    for ancestor in ancestors + [{'type': 'folder', 'id': folder['_id']}]:
+        if ancestor['id'] == folder['_id']:
+            doc = folder
+        else:
+            doc = docs.get((ancestor['type'], ancestor['id']))
+        if doc is None:
+            return False
+        if ancestor['type'] == 'folder' and \
+                (doc['parentCollection'], doc['parentId']) != expected:
+            return False
+        expected = (ancestor['type'], ancestor['id'])
+    return True
+
+
+def rootPaths(folders, user=None, level=AccessType.READ, exc=True):
+    """
+    Get the path to the root of the hierarchy of many folders, in the format
+    of :py:meth:`Folder.parentsToRoot`, loading all ancestors with a single
+    query per model. Folders whose stored ancestors turn out to be stale
+    are resolved the slow way, and their chain is recomputed on next use.
+
+    :param exc: Whether to raise when ``user`` lacks access to an ancestor,
+        rather than return None for that folder's path.
+    :raises AccessException: if ``exc`` is set and access is denied.
+    """
+    chains = [folderAncestors(folder) or [] for folder in folders]
+    ids = {}
+    for chain in chains:
+        for ancestor in chain:
+            ids.setdefault(ancestor['type'], set()).add(ancestor['id'])
+    docs = {}
+    for modelType, modelIds in ids.items():
+        for doc in MODELS[modelType]().find({'_id': {'$in': list(modelIds)}}):
+            docs[(modelType, doc['_id'])] = doc
+
+    paths = []
+    for folder, chain in zip(folders, chains):
+        try:
+            paths.append(_rootPath(folder, chain, docs, user, level))
+        except AccessException:
+            if exc:
+                raise
+            paths.append(None)
+    return paths
+
+
+def _rootPath(folder, chain, docs, user, level):
+    if not _isConsistent(folder, chain, docs):
+        staleIds = [folder['_id']] + [
+            ancestor['id'] for ancestor in chain
+            if ancestor['type'] == 'folder']
+        Folder().update({'_id': {'$in': staleIds}},
+                        {'$unset': {ANCESTORS_FIELD: ''}})
+        return Folder().parentsToRoot(folder, user=user, level=level)
+    path = []
+    for ancestor in chain:
+        model = MODELS[ancestor['type']]()
+        doc = docs[(ancestor['type'], ancestor['id'])]
+        model.requireAccess(doc, user=user, level=level)
+        path.append({'type': ancestor['type'],
+                     'object': model.filter(doc, user)})
+    return path
+
+
+def folderMoved(event):
+    """
+    Drop the stored ancestors of a folder being moved and of everything
+    below it. Renames need nothing, as ancestors are stored by id only.
+    """
+    folder = event.info
+    ancestors = folder.get(ANCESTORS_FIELD)
+    if not ancestors:
+        return
+    parent = ancestors[-1]
+    if (parent['type'], parent['id']) != \
+            (folder['parentCollection'], folder['parentId']):
+        del folder[ANCESTORS_FIELD]
+        Folder().update({ANCESTORS_FIELD + '.id': folder['_id']},
+                        {'$unset': {ANCESTORS_FIELD: ''}})
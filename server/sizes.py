@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from girder import logger
+from girder.models.collection import Collection
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.plugins.jobs.constants import JobStatus
+from girder.plugins.jobs.models.job import Job
+
+from .utils import MODELS, batches
+
+_sizeExecutor = ThreadPoolExecutor(max_workers=2)
+
+
+def _setSizes(model, docs, sizes):
+    """Write the sizes that changed, returning how many did."""
+    requests = [
+        UpdateOne({'_id': doc['_id']}, {'$set': {'size': sizes[doc['_id']]}})
+        for doc in docs if doc.get('size') != sizes[doc['_id']]]
+    if requests:
+        model.collection.bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def fixItemSizes(items):
+    """
+    Recompute item sizes from their files with one aggregation per batch.
+
+    :returns: A (sizes, fixes) tuple, sizes being a dict of item id to size.
+    """
+    sizes = {}
+    fixes = 0
+    for batch in batches(list(items)):
+        batchSizes = {item['_id']: 0 for item in batch}
+        for record in File().collection.aggregate([
+            {'$match': {'itemId': {'$in': list(batchSizes)}}},
+            {'$group': {'_id': '$itemId', 'size': {'$sum': '$size'}}}
+        ]):
+            batchSizes[record['_id']] = record['size']
+        fixes += _setSizes(Item(), batch, batchSizes)
+        sizes.update(batchSizes)
+    return sizes, fixes
+
+
+def _subtreeLevels(parentType, parentIds):
+    """List the folders below some parents, one list per level."""
+    levels = []
+    while parentIds:
+        level = []
+        for batch in batches(parentIds):
+            level.extend(Folder().find({
+                'parentId': {'$in': batch},
+                'parentCollection': parentType
+            }, fields=['parentId', 'size']))
+        if level:
+            levels.append(level)
+        parentIds = [folder['_id'] for folder in level]
+        parentType = 'folder'
+    return levels
+
+
+def fixFolderSizes(levels, progress=None):
+    """
+    Recompute the sizes of folders, given level by level from the top, and
+    of their items. Levels are processed bottom-up so that the recursive
+    size of each folder is known once its own level is done.
+
+    :param progress: Called with the number of folders done and the total
+        after each level.
+    :returns: A (totals, fixes) tuple, totals being a dict of folder id to
+        recursive size.
+    """
+    totals = {}
+    fixes = 0
+    done = 0
+    count = sum(len(level) for level in levels)
+    for level in reversed(levels):
+        folderIds = [folder['_id'] for folder in level]
+        direct = {folderId: 0 for folderId in folderIds}
+        for batch in batches(folderIds):
+            items = list(Item().find({'folderId': {'$in': batch}},
+                                     fields=['folderId', 'size']))
+            itemSizes, itemFixes = fixItemSizes(items)
+            fixes += itemFixes
+            for item in items:
+                direct[item['folderId']] += itemSizes[item['_id']]
+        fixes += _setSizes(Folder(), level, direct)
+        for folder in level:
+            total = direct[folder['_id']] + totals.get(folder['_id'], 0)
+            totals[folder['_id']] = total
+            totals[folder['parentId']] = \
+                totals.get(folder['parentId'], 0) + total
+        done += len(level)
+        if progress:
+            progress(done, count)
+    return totals, fixes
+
+
+def updateSize(modelType, doc, progress=None):
+    """
+    Fix the stored size of a collection, folder or item and of everything
+    below it, following the same rules as the models' own ``updateSize``:
+    items and folders count their direct content, collections everything.
+
+    :returns: The number of documents that were fixed.
+    """
+    if modelType == 'item':
+        return fixItemSizes([doc])[1]
+    if modelType == 'folder':
+        levels = [[doc]] + _subtreeLevels('folder', [doc['_id']])
+        return fixFolderSizes(levels, progress)[1]
+
+    levels = _subtreeLevels('collection', [doc['_id']])
+    totals, fixes = fixFolderSizes(levels, progress)
+    return fixes + _setSizes(Collection(), [doc], {
+        doc['_id']: totals.get(doc['_id'], 0)})
+
+
+def runSizeCheck(job):
+    jobModel = Job()
+    modelType = job['kwargs']['modelType']
+    job = jobModel.updateJob(job, status=JobStatus.RUNNING, progressCurrent=0)
+    try:
+        doc = MODELS[modelType]().load(
+            ObjectId(job['kwargs']['id']), force=True)
+        if doc is None:
+            raise ValueError('No such %s.' % modelType)
+
+        def progress(done, count):
+            jobModel.updateJob(job, progressCurrent=done, progressTotal=count,
+                               progressMessage='Checked %d folders' % done)
+
+        fixes = updateSize(modelType, doc, progress)
+        jobModel.updateJob(job, status=JobStatus.SUCCESS,
+                           progressMessage='Fixed %d sizes' % fixes,
+                           log='Fixed %d sizes.\n' % fixes)
+    except Exception:
+        logger.exception('Size check of %s %s failed', modelType,
+                         job['kwargs']['id'])
+        jobModel.updateJob(job, status=JobStatus.ERROR,
+                           log=traceback.format_exc())
+
+
+def scheduleSizeCheck(modelType, doc, user):
+    """
+    Queue a job recomputing the size of a resource and of its content.
+
+    :returns: The job, which reports its progress through notifications.
+    """
+    jobModel = Job()
+    job = jobModel.createLocalJob(
+        title='Check the size of %s %s' % (modelType, doc['name']),
+        type='ythub.size_check', user=user,
+        module='girder.plugins.ythub.sizes', function='runSizeCheck',
+        kwargs={'modelType': modelType, 'id': str(doc['_id'])})
+    _sizeExecutor.submit(jobModel.scheduleJob, job)
+    return job
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+import cherrypy
+from girder.api.rest import setResponseHeader
+from girder.exceptions import RestException
+from girder.models.collection import Collection
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.user import User
+
+_MEMORY_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*$',
+                          re.IGNORECASE)
+_MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+# Maximum number of ids sent in a single ``$in`` query.
+BATCH_SIZE = 1000
+
+# Models of the resources of the data hierarchy, by type.
+MODELS = {
+    'user': User,
+    'collection': Collection,
+    'folder': Folder,
+    'item': Item
+}
+
+
+def batches(ids, size=BATCH_SIZE):
+    """Split a list of ids into lists of at most ``size`` ids."""
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def parseMemory(value):
+    """
+    Convert a docker style memory limit (e.g. ``1024m`` or ``2g``) to bytes.
+
+    :raises ValueError: if the value cannot be parsed.
+    """
+    match = _MEMORY_SIZE.match(str(value))
+    if match is None:
+        raise ValueError('Invalid memory size: %s' % value)
+    number, unit = match.groups()
+    return int(float(number) * _MEMORY_UNITS[unit.lower()])
+
+
+def parentFolderId(folder):
+    """The id of the parent of a folder, if that parent is a folder."""
+    if folder.get('parentCollection') == 'folder':
+        return folder.get('parentId')
+
+
+def checkNotModified(etag):
+    """
+    Send ``etag`` with the response, and answer with ``304 Not Modified``
+    right away if the client already holds that version.
+    """
+    setResponseHeader('ETag', etag)
+    ifNoneMatch = cherrypy.request.headers.get('If-None-Match', '')
+    if etag in [tag.strip() for tag in ifNoneMatch.split(',')]:
+        raise cherrypy.HTTPRedirect([], 304)
+
+
+def requestedRange(size, etag=None):
+    """
+    The byte range of a resource of ``size`` bytes asked for by the Range
+    header, as a (start, end) pair with ``end`` excluded, or None if the
+    whole resource should be sent. A Range whose If-Range does not match
+    ``etag`` is ignored, and so are multiple ranges.
+
+    :raises RestException: with a 416 status if the range is unsatisfiable.
+    """
+    header = cherrypy.request.headers.get('Range')
+    if not header:
+        return None
+    ifRange = cherrypy.request.headers.get('If-Range')
+    if ifRange is not None and ifRange.strip() != etag:
+        return None
+    try:
+        ranges = cherrypy.lib.httputil.get_ranges(header, size)
+    except ValueError:
+        return None
+    if ranges is None or len(ranges) > 1:
+        return None
+    if not ranges:
+        setResponseHeader('Content-Range', 'bytes */%d' % size)
+        raise RestException('Requested range not satisfiable.', code=416)
+    return ranges[0]
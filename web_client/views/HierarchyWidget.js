@@ -8,6 +8,7 @@ import { getCurrentUser } from 'girder/auth';
 import ytHubHierarchyWidget from '../templates/ytHubHierarchyWidget.pug';
 import ytHubFolderMenu from '../templates/ytHubFolderMenu.pug';
 import FrontendSelectorWidget from './widgets/FrontendSelectorWidget';
+import waitForNotebook from '../waitForNotebook';
 
 wrap(HierarchyWidget, 'render', function (render) {
     var widget = this;
@@ -112,7 +113,7 @@ function _startNb(e) {
                         folderId: folderId,
                         frontendId: frontends[0]['_id']
                     }
-                }).done(function (notebook) {
+                }).then((notebook) => waitForNotebook(notebook)).done(function (notebook) {
                     window.location.assign(notebook['url']);
                 });
             });
@@ -2,6 +2,7 @@ import View from 'girder/views/View';
 import { restRequest } from 'girder/rest';
 
 import template from '../templates/runNotebook.pug';
+import waitForNotebook from '../waitForNotebook';
 import '../stylesheets/runNotebook.styl';
 
 var RunNotebookView = View.extend({
@@ -22,10 +23,12 @@ var RunNotebookView = View.extend({
                     scripts: scripts
                 },
                 error: null
-            }).done((resp) => {
+            }).then((notebook) => waitForNotebook(notebook)).done((resp) => {
                 window.location.assign(resp['url']);
             }).fail((resp) => {
-                this.$('.g-validation-failed-message').text('Error: ' + resp.responseJSON.message);
+                var message = resp.responseJSON ? resp.responseJSON.message
+                    : 'notebook failed to start';
+                this.$('.g-validation-failed-message').text('Error: ' + message);
             });
             return resp;
         });
@@ -5,6 +5,7 @@ import { restRequest } from 'girder/rest';
 
 import FrontendSelectorTemplate from '../../templates/widgets/frontendSelector.pug';
 import FrontendCollection from '../../collections/FrontendCollection';
+import waitForNotebook from '../../waitForNotebook';
 
 import 'girder/utilities/jquery/girderModal';
 
@@ -54,7 +55,7 @@ var FrontendSelectorWidget = View.extend({
                 frontendId: frontendId
             },
             type: 'POST'
-        }).done(function (notebook) {
+        }).then((notebook) => waitForNotebook(notebook)).done(function (notebook) {
             window.location.assign(notebook['url']);
         });
     },
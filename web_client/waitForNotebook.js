@@ -0,0 +1,38 @@
+import $ from 'jquery';
+
+import { restRequest } from 'girder/rest';
+
+import NotebookStatus from './NotebookStatus';
+
+/**
+ * Notebooks are launched in the background, so a freshly created notebook
+ * does not have a url yet. Poll it until it leaves the STARTING state and
+ * resolve the returned promise with the final notebook document.
+ */
+function waitForNotebook(notebook, interval) {
+    var deferred = $.Deferred();
+    interval = typeof interval === 'number' && interval > 0 ? interval : 1000;
+
+    var poll = function (nb) {
+        if (nb.status !== NotebookStatus.STARTING) {
+            if (nb.status === NotebookStatus.ERROR) {
+                deferred.reject(nb);
+            } else {
+                deferred.resolve(nb);
+            }
+            return;
+        }
+        window.setTimeout(function () {
+            restRequest({
+                url: 'notebook/' + nb._id,
+                type: 'GET',
+                error: null
+            }).done(poll).fail(deferred.reject);
+        }, interval);
+    };
+    poll(notebook);
+
+    return deferred.promise();
+}
+
+export default waitForNotebook;